@@ -1,3 +1,4 @@
+import asyncio
 
 from utils.agency import all_agent, guardrail_inappropriate, guardrail_irrelevant, improve_question, need_RAG
 from utils.initialisations import *
@@ -5,6 +6,16 @@ from utils.db_utils import *
 from utils.custom_print import *
 from utils.retriever import *
 from utils.json_parser import *
+from utils.corpus import load_corpus_bundle
+from utils.metadata_store import MetadataStore, iter_inverted_tree
+from utils.embedding_cache import EmbeddingCache, CachedEmbeddingFunction
+from utils.fusion import fuse_results
+from utils.query_constraints import (
+    heading_index, 
+    extract_constraints, 
+    chroma_where, 
+    elastic_filters
+)
 from utils.prompt_engineering import *
 from utils.langsmith_trace import *
 
@@ -14,6 +25,7 @@ from langchain_core.runnables import (
     RunnablePassthrough,
     RunnableGenerator
 )
+from langchain_core.runnables.utils import accepts_config
 
 # soon to be deprecated model classes
 # from langchain.chat_models.openai import ChatOpenAI
@@ -44,6 +56,10 @@ chunk_pageNum_pairs_path = PARSED_DOCUMENT_DIR + "/chunk_pageNum_pairs.json"
 s_p_pairs_path = PARSED_DOCUMENT_DIR + "/sentence_paragraph_pairs.json"
 tree_path = PARSED_DOCUMENT_DIR + "/complete_tree.json"
 save_inverted_tree_path = PARSED_DOCUMENT_DIR + "/inverted_tree.json"
+bundle_dir = PARSED_DOCUMENT_DIR + "/corpus_bundle"
+embedding_cache_dir = "data/embedding_cache"
+chroma_pointer_path = "data/db/collection_pointer.json"
+rerank_tokens_dir = PARSED_DOCUMENT_DIR + "/rerank_tokens"
 
 
 # HYPERPARAMETERS ============================================================
@@ -64,6 +80,10 @@ min_chunk_size=100
 # add to data base in batches
 batch_size = 1000
 
+# search year shards (chroma_build_shards, elastic_build_shards) instead of 
+# the single collection / index
+sharded = False
+
 # Ranking --------------------------------------------------------------------
 
 # top k matches for ranking. 
@@ -88,7 +108,14 @@ top_n = 20
 
 # best performing on Microsoft tests
 model_name = "cross-encoder/ms-marco-MiniLM-L-12-v2"
-cross_encoder_model = model = CrossEncoder(model_name, max_length=512)
+cross_encoder_model = model = get_cross_encoder(model_name, max_length=512)
+
+# pairs of concurrent requests are scored together in micro batches
+reranker_batch_size = 128
+reranker_max_wait = 0.005
+
+# padded tokens in one cross encoder forward pass (length bucketed)
+reranker_batch_tokens = 16384
 
 
 # IMPROVEMENTS ===============================================================
@@ -107,19 +134,62 @@ params = (chunking, grouping, min_chunk_size, batch_size, top_k,
 
 # retrieve all required data structures
 
-inverted_tree = json_file_to_dict(save_inverted_tree_path)
-# load chunks from tree's keys
-chunks = list(inverted_tree.keys())
+# the corpus bundle (utils.corpus.generate_corpus_bundle) is memory mapped, so 
+# no large JSON is parsed at boot. Fall back to the JSON artifacts without it.
+if os.path.exists(bundle_dir):
+    corpus_bundle = load_corpus_bundle(bundle_dir)
+else:
+    corpus_bundle = None
 
-# prepare metadata for chromadb
-pre_metadata = list(inverted_tree.values())
-metadata = chroma_preprocess_metadata(pre_metadata)
+if corpus_bundle is not None:
+    inverted_tree = corpus_bundle.inverted_tree()
+
+    # metadata store reads the bundle columns directly
+    metadata_store = corpus_bundle.metadata_store()
+
+    # chunks of the bundle, decoded when looked up
+    chunks = corpus_bundle.chunk_list()
+
+    # load sentence paragraph pairs
+    if (chunking == 's' or chunking == 'f') and grouping == 1:
+        s_p_pairs = corpus_bundle.sentence_paragraph_pairs()
+    else:
+        s_p_pairs = {}
 
-# load sentence paragraph pairs
-if (chunking == 's' or chunking == 'f') and grouping == 1:
-    s_p_pairs = json_file_to_dict(s_p_pairs_path)
 else:
-    s_p_pairs = {}
+    inverted_tree = json_file_to_dict(save_inverted_tree_path)
+    # load chunks from tree's keys (or "text" of an ID keyed tree)
+    chunks = [chunk for chunk, _ in iter_inverted_tree(inverted_tree)]
+
+    # metadata with interned sections, used instead of the inverted tree
+    metadata_store = MetadataStore.from_inverted_tree(inverted_tree)
+
+    # load sentence paragraph pairs
+    if (chunking == 's' or chunking == 'f') and grouping == 1:
+        s_p_pairs = json_file_to_dict(s_p_pairs_path)
+    else:
+        s_p_pairs = {}
+
+# prepare metadata for chromadb
+metadata = chroma_preprocess_metadata(metadata_store)
+
+# cross encoder tokens of every chunk, tokenised once and saved, so only the 
+# query is tokenised when reranking
+chunk_tokens = load_chunk_tokens(cross_encoder_model, 
+                                 model_name, 
+                                 chunks, 
+                                 rerank_tokens_dir)
+
+reranker_service = RerankerService(cross_encoder_model, 
+                                   reranker_batch_size, 
+                                   reranker_max_wait,
+                                   chunk_tokens = chunk_tokens,
+                                   max_batch_tokens = reranker_batch_tokens)
+
+# headings of the content page tree, years and sections named in a question 
+# are pushed down to retrieval as metadata filters
+complete_tree = json_file_to_dict(tree_path)
+section_headings = heading_index(complete_tree) if complete_tree else {}
 
 # start datastores ===========================================================
 
@@ -131,10 +201,21 @@ openai_ef = embedding_functions.OpenAIEmbeddingFunction(
                 model_name="text-embedding-3-small"
             )
 
-collection = chroma_get_or_create_collection(client_dense, 
-                                             name = "audit", 
-                                             embedding_function = openai_ef, 
-                                             reset = False)
+# embeddings are cached on disk, shared with ingestion (chroma_bulk_load). 
+# Only queries are embedded here, they are read from the cache but not added.
+embedding_cache = EmbeddingCache(embedding_cache_dir)
+openai_ef = CachedEmbeddingFunction(openai_ef, 
+                                    embedding_cache, 
+                                    "text-embedding-3-small",
+                                    persist = False)
+
+# the live collection is resolved through a pointer file, which is switched 
+# by chroma_rebuild_collection (blue/green rebuild) while the app is running
+collection_pointer = CollectionPointer(client_dense, 
+                                       name = "audit", 
+                                       embedding_function = openai_ef, 
+                                       pointer_path = chroma_pointer_path)
+collection = collection_pointer.get()
 
 # test datastore ------------------------------------------------------------
 # connect to the Elasticsearch cluster from python elasticsearch client
@@ -143,6 +224,19 @@ client_sparce = Elasticsearch(
     basic_auth=HTTP_AUTH
 )
 
+# only indices built with ELASTIC_MAPPING (elastic_bulk_index) can be filtered
+elastic_filterable = elastic_has_fields(client_sparce, 
+                                        index_name, 
+                                        HTTP_AUTH, 
+                                        ["year", "section"])
+
+# year shards ----------------------------------------------------------------
+# only the shards of the years asked about are searched, all of them if the 
+# question does not mention a year
+if sharded:
+    dense_shards = chroma_sharded_search(client_dense, "audit", openai_ef)
+    sparce_shards = elastic_sharded_search(client_sparce, index_name, HTTP_AUTH)
+
 # set up RAG pipeline =======================================================
 def use_HyDE(question):
     if HyDE:
@@ -152,27 +246,69 @@ def use_HyDE(question):
 
     return {
                 "query" : query,
-                "question": question
+                "question": question,
+                "constraints": extract_constraints(question, 
+                                                   section_headings, 
+                                                   metadata_store.years,
+                                                   metadata_store)
            }
 
 #  ---------------------------------------------------------------------
 def sparce_retrieval(kwargs):
 
     query = kwargs["query"]
+    constraints = kwargs["constraints"]
 
+    # shards are built with ELASTIC_MAPPING, years are picked by shard
+    if sharded:
+        filters = elastic_filters({"years": [], 
+                                   "sections": constraints["sections"]}, 
+                                  metadata_store.sections)
+        
+        return sparce_shards.search(query, 
+                                    top_k, 
+                                    years = constraints["years"], 
+                                    filters = filters,
+                                    return_ids = True)
+
+    if elastic_filterable:
+        filters = elastic_filters(constraints, metadata_store.sections)
+    else:
+        filters = None
+
+    # chunks are returned with their datastore ID, resolved to rows in rank
     return bm25_elasticsearch(
         client_sparce, 
         index_name, 
         HTTP_AUTH, query, 
-        top_k
+        top_k,
+        filters,
+        return_ids = True
     )
 
 def dense_retrieval(kwargs):
     query = kwargs["query"]
+    constraints = kwargs["constraints"]
+
+    if sharded:
+        where = chroma_where({"years": [], "sections": constraints["sections"]}, 
+                             metadata_store.sections)
+        
+        return dense_shards.search(query, 
+                                   top_k, 
+                                   years = constraints["years"], 
+                                   where = where,
+                                   return_ids = True)
+
+    where = chroma_where(constraints, metadata_store.sections)
 
-    return chromadb_embedding_search(collection, query, top_k)
+    return chromadb_embedding_search(collection_pointer.get(), 
+                                     query, 
+                                     top_k, 
+                                     where, 
+                                     return_ids = True)
 
-retrieval = RunnableParallel(
+retrieval_parallel = RunnableParallel(
     {
         "sparce": sparce_retrieval,
         "dense": dense_retrieval,
@@ -180,19 +316,142 @@ retrieval = RunnableParallel(
     }
 )
 
+# batch of questions ---------------------------------------------------------
+# rag.batch (and LangServe /rag/batch) would otherwise retrieve every question 
+# on its own. Here all questions are searched with one _msearch and one chroma
+# query call per metadata filter.
+class BatchRunnableLambda(RunnableLambda):
+    '''
+    RunnableLambda that hands a whole batch of inputs to batch_func, instead 
+    of calling func once per input.
+
+    Input:
+    -----------
+        func: function
+            called for a single input (invoke, stream)
+
+        batch_func: function
+            maps a list of inputs to a list of outputs (batch, abatch). An 
+            output can be an exception, raised unless return_exceptions. If 
+            it takes a config argument, it gets the config of each input 
+            with the callbacks of its run, so nested runnables are traced.
+    '''
+
+    def __init__(self, func, batch_func):
+        super().__init__(func)
+        self.batch_func = batch_func
+
+    def call_batch_func(self, inputs, config):
+        """
+        @param inputs: list, inputs of the batch
+        @param config: list (RunnableConfig), config of each input, with the 
+                       callbacks of its run
+
+        @return outputs: list, output (or exception) of each input
+        """
+        if accepts_config(self.batch_func):
+            return self.batch_func(inputs, config = config)
+        
+        return self.batch_func(inputs)
+
+    def batch(self, inputs, config = None, *, return_exceptions = False, **kwargs):
+        # one traced run per input, callbacks and return_exceptions are 
+        # handled like the default Runnable.batch
+        return self._batch_with_config(self.call_batch_func, 
+                                       list(inputs), 
+                                       config, 
+                                       return_exceptions = return_exceptions)
+
+    async def abatch(self, inputs, config = None, *, return_exceptions = False, **kwargs):
+        
+        # search requests are blocking, keep them off the event loop
+        async def call_batch_func(inputs, config):
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self.call_batch_func, inputs, config)
+        
+        return await self._abatch_with_config(call_batch_func, 
+                                              list(inputs), 
+                                              config, 
+                                              return_exceptions = return_exceptions)
+
+
+def retrieval_batch(inputs, config = None):
+    queries = [kwargs["query"] for kwargs in inputs]
+    constraints = [kwargs["constraints"] for kwargs in inputs]
+
+    # shards are searched one question at a time, a failed question is 
+    # returned as its exception
+    if sharded:
+        return retrieval_parallel.batch(inputs, config, return_exceptions = True)
+
+    if elastic_filterable:
+        filters = [elastic_filters(constraint, metadata_store.sections) 
+                   for constraint in constraints]
+    else:
+        filters = None
+
+    sparce_results = bm25_elasticsearch_batch(client_sparce, 
+                                              index_name, 
+                                              HTTP_AUTH, 
+                                              queries, 
+                                              top_k, 
+                                              filters,
+                                              return_ids = True)
+    
+    where = [chroma_where(constraint, metadata_store.sections) 
+             for constraint in constraints]
+    
+    dense_results = chromadb_embedding_search_batch(collection_pointer.get(), 
+                                                    queries, 
+                                                    top_k, 
+                                                    where,
+                                                    return_ids = True)
+    
+    return [{"sparce": sparce, "dense": dense, "rag_input": kwargs}
+            for sparce, dense, kwargs in zip(sparce_results, dense_results, inputs)]
+
+retrieval = BatchRunnableLambda(retrieval_parallel.invoke, retrieval_batch)
+
 # --------------------------------------------------------------------------
 
+def resolve_chunk_ids(results):
+    """
+    @param results: list, ((ID, text), rank) pairs of a retriever
+
+    @return results: list (int, int), (chunk ID, rank) pairs. Chunks that 
+                     are not in the corpus are left out.
+    """
+    resolved = []
+
+    for (stable_id, chunk), result_rank in results:
+        try:
+            chunk_id = metadata_store.row(stable_id)
+
+        # datastores built with other IDs (e.g. id{i} or positions) are 
+        # resolved by text, identical chunks resolve to the first one
+        except KeyError:
+            try:
+                chunk_id = metadata_store.chunk_id(chunk)
+            except KeyError:
+                print(f"retrieved chunk {stable_id!r} is not in the corpus")
+                continue
+        
+        resolved.append((chunk_id, result_rank))
+    
+    return resolved
+
 def rank(kwargs):
-    bm25_results = kwargs["sparce"]
-    embedding_results = kwargs["dense"]
-    good_chunks = reciprocal_rank_fusion(bm25_results, 
-                                  embedding_results, 
-                                  weights, 
-                                  k)
+    bm25_results = resolve_chunk_ids(kwargs["sparce"])
+    embedding_results = resolve_chunk_ids(kwargs["dense"])
+
+    # weighted RRF keyed by integer chunk ID, add retrievers to the list to 
+    # fuse more than 2
+    good_ids = fuse_results([bm25_results, embedding_results], weights, k)
+
     return {
                 "query": kwargs["rag_input"]["query"], 
                 "question": kwargs["rag_input"]["question"],
-                "good chunks": good_chunks
+                "good chunk ids": good_ids
            }
 
 rank = RunnableLambda(rank)
@@ -202,16 +461,18 @@ rank = RunnableLambda(rank)
 def rerank(kwargs):
     query = kwargs["query"]
         
-    good_chunks = kwargs["good chunks"]
-    best_chunks, scores = reranking(model_name, 
-                                    good_chunks, 
-                                    query, 
-                                    top_n, 
-                                    cross_encoder_model)
+    good_ids = kwargs["good chunk ids"]
+    good_chunks = [chunks[chunk_id] for chunk_id in good_ids]
+
+    # chunks are scored by text and kept by ID
+    scores = reranker_service.submit(query, good_chunks).result()
+    best_ids, _ = select_top_n(good_ids, scores, top_n)
+
     return {
                 "query": kwargs["query"], 
                 "question": kwargs["question"], 
-                "best chunks": best_chunks
+                "best chunks": [chunks[chunk_id] for chunk_id in best_ids],
+                "best chunk ids": best_ids
            }
 
 rerank = RunnableLambda(rerank)
@@ -224,10 +485,12 @@ def augment(kwargs):
     best_chunks = kwargs["best chunks"]
     prompt = generate_prompt(
         question, 
-        inverted_tree, 
+        metadata_store, 
         best_chunks, 
         chunking, 
-        s_p_pairs)
+        s_p_pairs,
+        chunk_ids = [metadata_store.stable_id(chunk_id) 
+                     for chunk_id in kwargs["best chunk ids"]])
     
     return {
                 "query": kwargs["query"], 
@@ -3,6 +3,12 @@
 # The initial tree's leaves are a list of pages belonging to a section
 # This function assigns text to each page in this tree
 from utils.json_parser import *
+from utils.metadata_store import SectionTable, make_chunk_id
+from utils.preprocessing import pdf_to_text, pdf_to_pages, get_true_pages, hash_file
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_right
+import numpy as np
+import ast
 import sys
 import os
 
@@ -67,12 +73,190 @@ def get_partial_inverted_tree(tree, route, inverted_tree):
             get_partial_inverted_tree(tree[child], new_route, inverted_tree)
 
 
+# Section index ===============================================================
+# Compiled version of the partially inverted tree. Instead of one route per 
+# page, every year has sorted page ranges mapped to section IDs, so a page is 
+# resolved with a binary search.
+
+class SectionIndex:
+    '''
+    This class maps pages of one year to the section (path of headings in the 
+    content page tree) they belong to. Pages are stored as sorted, non 
+    overlapping [start, end) intervals and resolved by bisect.
+
+    Input:
+    -----------
+        starts: list (int)
+            first page of each interval, sorted
+
+        ends: list (int)
+            last page + 1 of each interval
+
+        section_ids: list (int)
+            section ID of each interval
+
+        sections: metadata_store.SectionTable
+            table of section paths, can be shared between years
+    '''
+
+    def __init__(self, starts, ends, section_ids, sections):
+        self.starts = starts
+        self.ends = ends
+        self.section_ids = section_ids
+        self.sections = sections
+
+        # one location list per section, shared by every chunk in the section
+        self.locations = {}
+
+    def __len__(self):
+        return len(self.starts)
+
+    def section_of(self, page):
+        """
+        @param page: int, page number written on the pdf
+
+        @return section_id: int, -1 if page is not in any section
+        """
+        i = bisect_right(self.starts, page) - 1
+
+        if i >= 0 and page < self.ends[i]:
+            return self.section_ids[i]
+        
+        return -1
+
+    def get(self, page, default = None):
+        """
+        @param page: int, page number written on the pdf
+        @param default: returned if page is not in any section
+
+        @return location: list (str), path to reach page. Same as the values 
+                          of get_partial_inverted_tree
+        """
+        section_id = self.section_of(page)
+
+        if section_id == -1:
+            return default
+        
+        if section_id not in self.locations:
+            self.locations[section_id] = list(self.sections.path(section_id))
+        
+        return self.locations[section_id]
+    
+    def section_pages(self, section_id):
+        """
+        @param section_id: int
+
+        @return pages: list (int), pages of the section. Text of the section 
+                       can be looked up in true_pages when needed, instead of 
+                       being copied into the tree (see add_text_to_tree)
+        """
+        return [page 
+                for start, end, section in zip(self.starts, 
+                                               self.ends, 
+                                               self.section_ids)
+                if section == section_id
+                for page in range(start, end)]
+
+
+def compile_section_index(tree, sections = None):
+    ''' 
+    This function compiles the content page tree of one year into a section 
+    index. Like get_partial_inverted_tree, a page listed under several leaves 
+    belongs to the last one.
+   
+    Input:
+    -----------
+        tree: dictionary
+            hirarchy built using content page, for one year
+
+        sections: metadata_store.SectionTable
+            table to intern section paths in. A new table is made if None.
+
+    Output:
+    --------
+        section_index: SectionIndex
+    '''
+    if sections is None:
+        sections = SectionTable()
+
+    # page : section ID
+    page_sections = {}
+
+    # route is a single stack, pushed and popped during recursion
+    route = []
+
+    def visit(node):
+        for child in node:
+            route.append(child)
+
+            # Tree's Leaves are a list of pages so check if leaves are rechead
+            if type(node[child]) == list:
+                section_id = sections.intern(route)
+
+                for page_number in node[child]:
+                    page_sections[page_number] = section_id
+            
+            # if not a leaf, enter the child node (recursion)
+            else:
+                visit(node[child])
+            
+            route.pop()
+    
+    visit(tree)
+
+    # merge consecutive pages of the same section into intervals
+    starts, ends, section_ids = [], [], []
+
+    for page in sorted(page_sections):
+        section_id = page_sections[page]
+
+        if ends and ends[-1] == page and section_ids[-1] == section_id:
+            ends[-1] = page + 1
+        else:
+            starts.append(page)
+            ends.append(page + 1)
+            section_ids.append(section_id)
+    
+    return SectionIndex(starts, ends, section_ids, sections)
+
+
+def compile_section_indexes(tree, years = None, sections = None):
+    ''' 
+    This function compiles a section index for every year of the complete 
+    content page tree. Section IDs are shared between years.
+   
+    Input:
+    -----------
+        tree: dictionary
+            year : hirarchy built using content page
+
+        years: list (str)
+            years to compile, all years in tree if None
+        
+        sections: metadata_store.SectionTable
+            table to intern section paths in. A new table is made if None.
+
+    Output:
+    --------
+        section_indexes: dictionary
+            year (str) : SectionIndex
+    '''
+    if sections is None:
+        sections = SectionTable()
+
+    if years is None:
+        years = list(tree.keys())
+
+    return {year: compile_section_index(tree[year], sections) for year in years}
+
+
 # This function produces the final data structure where chunks are keys and 
 # values are metadata (headings / ministries / etc.)
 def get_complete_inverted_tree(chunk_pageNum_pairs, partial_inverted_tree):
     """
     @param chunk_pageNum_pairs : list, chunk (str): page (int) pair
-    @param partial_inverted_tree: dictionary, page number: path to reach page
+    @param partial_inverted_tree: dictionary, year: page number: path to reach 
+                                  page (dict or SectionIndex)
     
     @return complete_inverted_tree : dictionary, chunk: path to reach chunk 
     """
@@ -114,21 +298,9 @@ def get_inverted_tree(chunk_pageNum_pairs, tree):
     
     @return complete_inverted_tree : dictionary, chunk: path to reach chunk 
     """
-    # initialise intermediate tree
-    partial_inverted_tree = {}
-
-    # initialise final tree
-    inverted_tree = {}
-
-    # loop through all years
-    for year in chunk_pageNum_pairs:
-
-        # temporary tree for every year
-        p_i_tree_year = {}
-        get_partial_inverted_tree(tree[year], [], p_i_tree_year)
-
-        # create partially inverted tree (does not include chunks)
-        partial_inverted_tree[year] = p_i_tree_year
+    # compile a section index for every year (pages resolved by bisect)
+    partial_inverted_tree = compile_section_indexes(tree, 
+                                                    list(chunk_pageNum_pairs))
     
     # create fully inverted tree (includes chunks)
     inverted_tree = get_complete_inverted_tree(chunk_pageNum_pairs, 
@@ -142,7 +314,9 @@ def get_inverted_tree(chunk_pageNum_pairs, tree):
 def generate_inverted_tree(chunk_pageNum_pairs_path,
                            has_content_page, 
                            save_inverted_tree_path,
-                           tree_path = None):
+                           tree_path = None,
+                           key_by_id = False,
+                           doc_identifier = "ar_fy"):
     ''' 
     This function splits a single pdf document into chunks for RAG.
    
@@ -160,6 +334,14 @@ def generate_inverted_tree(chunk_pageNum_pairs_path,
         tree_path: str
             Path to (content page) tree.
 
+        key_by_id: bool
+            key the inverted tree by stable chunk ID instead of chunk text, 
+            see key_by_chunk_id. Identical chunks from different years are 
+            then all kept.
+
+        doc_identifier: str
+            document identifier used in chunk IDs
+
     Output:
     --------
         None
@@ -170,26 +352,259 @@ def generate_inverted_tree(chunk_pageNum_pairs_path,
     # get path to chunk : page pair dictionary
     chunk_pageNum_pairs = json_file_to_dict(chunk_pageNum_pairs_path)
     
-    if has_content_page:
-        # get tree (made from content page)
-        tree = json_file_to_dict(tree_path)
+    # get tree (made from content page)
+    tree = json_file_to_dict(tree_path) if has_content_page else None
+
+    # invert the tree to get keys as chunks (or chunk IDs)
+    if key_by_id:
+        inverted_tree = key_by_chunk_id(chunk_pageNum_pairs, 
+                                        has_content_page, 
+                                        tree, 
+                                        doc_identifier)
+    else:
+        inverted_tree = invert_chunk_pageNum_pairs(chunk_pageNum_pairs, 
+                                                   has_content_page, 
+                                                   tree)
 
-        # invert the tree to get keys as chunks
-        inverted_tree = get_inverted_tree(chunk_pageNum_pairs, tree) 
+    # save inverted tree
+    save_json(inverted_tree, save_inverted_tree_path)
+
+
+# MAIN FUNCTION WRAPPER
+# This function updates a saved inverted tree after incremental chunking
+def update_inverted_tree(chunk_pageNum_pairs_path,
+                         changed_years,
+                         removed_years,
+                         has_content_page, 
+                         save_inverted_tree_path,
+                         tree_path = None,
+                         key_by_id = False,
+                         doc_identifier = "ar_fy"):
+    ''' 
+    This function splices the chunks of new or changed documents into a saved 
+    inverted tree. Only the changed years are inverted again. It is used with 
+    changed_years and removed_years returned by 
+    preprocessing.generate_chunks_incremental. The saved tree is the same as 
+    generate_inverted_tree would make, in the same order.
+   
+    Input:
+    -----------
+        chunk_pageNum_pairs_path: str
+            Path to chunk and page number pairs.
+        
+        changed_years: list (str)
+            years of documents that were (re)chunked
+
+        removed_years: list (str)
+            years of documents that were removed
+
+        has_content_page: bool
+            do documents have content pages that provide metadata?
+
+        save_inverted_tree_path: str
+            Path to save inverted tree.
+        
+        tree_path: str
+            Path to (content page) tree.
 
+        key_by_id: bool
+            the inverted tree is keyed by stable chunk ID, see 
+            generate_inverted_tree
+
+        doc_identifier: str
+            document identifier used in chunk IDs
+
+    Output:
+    --------
+        None
+            function saves the data (inverted tree)
+
+    '''
+    # nothing to do if inverted tree is up to date
+    if (not changed_years and not removed_years 
+        and os.path.exists(save_inverted_tree_path)):
+        return
+
+    chunk_pageNum_pairs = json_file_to_dict(chunk_pageNum_pairs_path)
+
+    if os.path.exists(save_inverted_tree_path):
+        old_inverted_tree = json_file_to_dict(save_inverted_tree_path)
     else:
-        # inverted tree is just chunk_pageNum_pairs dict but chunks as keys.
-        inverted_tree = {}
-        for year in chunk_pageNum_pairs:
-            for chunk, page in chunk_pageNum_pairs[year].items():
-                inverted_tree[chunk] = {
-                    "year": year, 
-                    "page": page if page != 0 else "Introduction"}
+        old_inverted_tree = {}
+
+    # a tree saved in the other format (text or ID keyed) cannot be reused
+    if any(("text" in metadata) != key_by_id 
+           for metadata in old_inverted_tree.values()):
+        old_inverted_tree = {}
+
+    # without a saved inverted tree, every year has to be inverted
+    if not old_inverted_tree:
+        changed_years = list(chunk_pageNum_pairs.keys())
+
+    # entries of removed years are dropped, only current years are kept
+    changed_years = set(changed_years)
+
+    # get tree (made from content page)
+    tree = json_file_to_dict(tree_path) if has_content_page else None
+
+    if key_by_id:
+        inverted_tree = splice_id_keyed_tree(chunk_pageNum_pairs, 
+                                             changed_years, 
+                                             old_inverted_tree, 
+                                             has_content_page, 
+                                             tree, 
+                                             doc_identifier)
+    else:
+        inverted_tree = splice_text_keyed_tree(chunk_pageNum_pairs, 
+                                               changed_years, 
+                                               old_inverted_tree, 
+                                               has_content_page, 
+                                               tree)
 
     # save inverted tree
     save_json(inverted_tree, save_inverted_tree_path)
 
 
+# This function splices changed years into a text keyed inverted tree
+def splice_text_keyed_tree(chunk_pageNum_pairs, 
+                           changed_years, 
+                           old_inverted_tree, 
+                           has_content_page, 
+                           tree):
+    """
+    @param chunk_pageNum_pairs : dictionary, year: {chunk (str): page (int)}
+    @param changed_years: set (str), years inverted again
+    @param old_inverted_tree: dictionary, saved text keyed tree
+    @param has_content_page: bool, do documents have content pages?
+    @param tree: dictionary, content page tree, None if no content page
+
+    @return inverted_tree : dictionary, chunk: metadata, as a full rebuild
+    """
+    # a full rebuild keeps a chunk in every year at the position of its first
+    # year, with the metadata of its last year
+    last_years = {}
+    for year in chunk_pageNum_pairs:
+        for chunk in chunk_pageNum_pairs[year]:
+            last_years[chunk] = year
+
+    # saved metadata is still right if it is of that last year, and the year
+    # was not rechunked
+    missing_pairs = {year: {} for year in chunk_pageNum_pairs}
+    for chunk, year in last_years.items():
+        metadata = old_inverted_tree.get(chunk)
+
+        if (metadata is None or metadata["year"] != year 
+            or year in changed_years):
+            missing_pairs[year][chunk] = chunk_pageNum_pairs[year][chunk]
+
+    # every chunk is missing in one year at most, so none overwrite another
+    missing_pairs = {year: pairs for year, pairs in missing_pairs.items() 
+                     if pairs}
+    new_inverted_tree = invert_chunk_pageNum_pairs(missing_pairs, 
+                                                   has_content_page, 
+                                                   tree)
+
+    return {chunk: new_inverted_tree.get(chunk) or old_inverted_tree[chunk]
+            for chunk in last_years}
+
+
+# This function splices changed years into an ID keyed inverted tree
+def splice_id_keyed_tree(chunk_pageNum_pairs, 
+                         changed_years, 
+                         old_inverted_tree, 
+                         has_content_page, 
+                         tree, 
+                         doc_identifier):
+    """
+    @param chunk_pageNum_pairs : dictionary, year: {chunk (str): page (int)}
+    @param changed_years: set (str), years inverted again
+    @param old_inverted_tree: dictionary, saved ID keyed tree
+    @param has_content_page: bool, do documents have content pages?
+    @param tree: dictionary, content page tree, None if no content page
+    @param doc_identifier: str, document identifier used in chunk IDs
+
+    @return inverted_tree : dictionary, chunk ID: metadata, as a full rebuild
+    """
+    # years are keyed separately, unchanged years are reused as saved
+    changed_pairs = {year: chunk_pageNum_pairs[year] 
+                     for year in chunk_pageNum_pairs if year in changed_years}
+    new_inverted_tree = key_by_chunk_id(changed_pairs, 
+                                        has_content_page, 
+                                        tree, 
+                                        doc_identifier)
+    
+    yearly_entries = {year: [] for year in chunk_pageNum_pairs}
+
+    for chunk_id, metadata in old_inverted_tree.items():
+        if (metadata["year"] in yearly_entries 
+            and metadata["year"] not in changed_years):
+            yearly_entries[metadata["year"]].append((chunk_id, metadata))
+    
+    for chunk_id, metadata in new_inverted_tree.items():
+        yearly_entries[metadata["year"]].append((chunk_id, metadata))
+
+    # year order of chunk_pageNum_pairs, like key_by_chunk_id
+    inverted_tree = {}
+    for year in yearly_entries:
+        inverted_tree.update(yearly_entries[year])
+    
+    return inverted_tree
+
+
+# This function inverts chunk : page pairs, with or without a content page tree
+def invert_chunk_pageNum_pairs(chunk_pageNum_pairs, has_content_page, tree):
+    """
+    @param chunk_pageNum_pairs : dictionary, year: {chunk (str): page (int)}
+    @param has_content_page: bool, do documents have content pages?
+    @param tree: dictionary, content page tree, None if no content page
+    
+    @return inverted_tree : dictionary, chunk: metadata 
+    """
+    if has_content_page:
+        # invert the tree to get keys as chunks
+        return get_inverted_tree(chunk_pageNum_pairs, tree) 
+
+    # inverted tree is just chunk_pageNum_pairs dict but chunks as keys.
+    inverted_tree = {}
+    for year in chunk_pageNum_pairs:
+        for chunk, page in chunk_pageNum_pairs[year].items():
+            inverted_tree[chunk] = {
+                "year": year, 
+                "page": page if page != 0 else "Introduction"}
+    
+    return inverted_tree
+
+
+# This function inverts chunk : page pairs into a tree keyed by chunk ID
+def key_by_chunk_id(chunk_pageNum_pairs, has_content_page, tree, doc_identifier):
+    """
+    @param chunk_pageNum_pairs : dictionary, year: {chunk (str): page (int)}
+    @param has_content_page: bool, do documents have content pages?
+    @param tree: dictionary, content page tree, None if no content page
+    @param doc_identifier: str, document identifier used in chunk IDs
+    
+    @return inverted_tree : dictionary, chunk ID: metadata, chunk text is 
+                            stored in metadata["text"]
+    """
+    inverted_tree = {}
+
+    # years are inverted one at a time so identical chunks of different years 
+    # do not overwrite each other
+    for year in chunk_pageNum_pairs:
+        yearly_tree = invert_chunk_pageNum_pairs({year: chunk_pageNum_pairs[year]},
+                                                 has_content_page, 
+                                                 tree)
+        
+        for chunk, metadata in yearly_tree.items():
+            chunk_id = make_chunk_id(doc_identifier, 
+                                     year, 
+                                     metadata.get("page"), 
+                                     chunk)
+            inverted_tree[chunk_id] = {"text": chunk, **metadata}
+    
+    return inverted_tree
+
+
 # MAIN FUNCTION WRAPPER
 # This function generates and saves inverted tree
 def generate_inverted_tree_og(chunk_pageNum_pairs_path,
@@ -226,4 +641,271 @@ def generate_inverted_tree_og(chunk_pageNum_pairs_path,
     inverted_tree = get_inverted_tree(chunk_pageNum_pairs, tree) 
 
     # save inverted tree
-    save_json(inverted_tree, save_inverted_tree_path)
\ No newline at end of file
+    save_json(inverted_tree, save_inverted_tree_path)
+
+
+# Content page tree construction ==============================================
+# Every year's content page is sent to an LLM which returns a hierarchical 
+# tree (nested dictionary). Responses are cached on disk by the hash of the 
+# content page, so only new reports cost an LLM call.
+
+# MAIN FUNCTION
+def build_complete_tree(DOCUMENT_DIR, 
+                        tree_path = None,
+                        cache_dir = None,
+                        llm_request = None,
+                        max_workers = 4,
+                        doc_identifier = "ar_fy"):
+    ''' 
+    This function builds the content page tree of every year. Years are 
+    processed concurrently in a bounded pool of threads (the work is mostly 
+    waiting for the LLM).
+   
+    Input:
+    -----------
+        DOCUMENT_DIR: str
+            Path to document folder. Each report <doc_identifier><year>.pdf 
+            has a content page <doc_identifier><year>_content_pages.pdf
+
+        tree_path: str
+            Path to save (content page) tree. Not saved if None.
+
+        cache_dir: str
+            Folder of cached LLM responses. No caching if None.
+
+        llm_request: function
+            llm_request(max_page, text) returns the LLM response (str). 
+            Defaults to request_tree with OpenAI. Pass a local stand-in to 
+            test without an API key.
+
+        max_workers: int
+            max number of years processed at the same time
+        
+        doc_identifier: str
+            see preprocessing.docs_to_chunks
+
+    Output:
+    --------
+        complete_tree: dictionary
+            year : hirarchy built using content page
+    '''
+    if llm_request is None:
+        llm_request = request_tree
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok = True)
+
+    # find content pages, in os.walk order
+    content_pages = []
+
+    for root, dirs, files in os.walk(DOCUMENT_DIR):
+        for file in files:
+            # Get the full path of the file
+            file_path = os.path.join(root, file)
+
+            # documents directory contains content pages and audit reports
+            # only consider content pages
+            end = file_path.find("_content_pages")
+
+            if end == -1:
+                continue
+
+            start = file_path.find(doc_identifier)
+
+            # content pages of other documents have no year to key by
+            if start == -1:
+                print(f"skipping {file_path}: no {doc_identifier!r} in path")
+                continue
+
+            start += len(doc_identifier)
+            
+            year = file_path[start:end]
+            doc_file_path = file_path[:end] + ".pdf"
+
+            content_pages.append((year, file_path, doc_file_path))
+    
+    def build_year(content_page):
+        year, file_path, doc_file_path = content_page
+
+        return build_year_tree(file_path, 
+                               doc_file_path, 
+                               llm_request, 
+                               cache_dir)
+
+    # map keeps the order of years, so the tree is the same as a serial run
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        trees = list(executor.map(build_year, content_pages))
+
+    complete_tree = {year: tree 
+                     for (year, _, _), tree in zip(content_pages, trees)}
+
+    if tree_path is not None:
+        save_json(complete_tree, tree_path)
+
+    return complete_tree
+
+
+def build_year_tree(content_page_path, document_path, llm_request, cache_dir = None):
+    ''' 
+    This function builds the content page tree of a single report.
+   
+    Input:
+    -----------
+        content_page_path: str
+            Path to content page of report.
+
+        document_path: str
+            Path to report.
+
+        llm_request: function
+            see build_complete_tree
+
+        cache_dir: str
+            Folder of cached LLM responses. No caching if None.
+
+    Output:
+    --------
+        tree: dictionary
+            hirarchy built using content page
+    '''
+    # max number of pages in pdf document 
+    pages = pdf_to_pages(document_path)
+    true_pages = get_true_pages(pages)
+
+    # reports without numbered pages fall back to the number of pages
+    max_page = max(true_pages.keys()) if true_pages else len(pages)
+
+    content_hash = hash_file(content_page_path)
+
+    api_output = None
+
+    # try cache first. The prompt depends on max_page too.
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, content_hash + ".json")
+
+        if os.path.exists(cache_path):
+            cached = json_file_to_dict(cache_path)
+
+            if cached is not None and cached["max_page"] == max_page:
+                api_output = cached["output"]
+
+    if api_output is None:
+        # converts pdf to pure text
+        text = pdf_to_text(content_page_path)
+
+        api_output = llm_request(max_page, text)
+
+        if cache_dir is not None:
+            # write then rename, so other threads never read a partial file
+            temp_path = cache_path + f".{os.getpid()}.tmp"
+            save_json({"max_page": max_page, "output": api_output}, temp_path)
+            os.replace(temp_path, cache_path)
+
+    return clean_output(api_output)
+
+
+# feeds content page as raw text into LLM
+# LLM outputs a nice hirarchial tree data structure (nested dictionary)
+def request_tree(max_page, text, client = None, model = "gpt-4o"):
+    ''' 
+    This function asks an LLM to convert a content page into a tree.
+   
+    Input:
+    -----------
+        max_page: int
+            max page number of the report
+
+        text: str
+            text of content page
+
+        client: openai.OpenAI
+            OpenAI client. A client reading OPENAI_API_KEY from the 
+            environment is made if None.
+
+        model: str
+            OpenAI model
+
+    Output:
+    --------
+        api_output: str
+            LLM response
+    '''
+    from openai import OpenAI
+
+    if client is None:
+        client = OpenAI()
+
+    instructions = f""" Below is a table of contents. Convert it to a tree structure.
+    Headings are the children of the root node. Subheadings are the children of the corresponding heading nodes.
+    Make the leaf nodes a list of integers, ```[current page number, next page number mentioned]```.
+    For heading nodes with indicated page numbers, add a child, SUMMARY, with a leaf node as value.
+    Let the last page be {max_page+1}. 
+    There is no need for a parent node called "Page".
+    Give your tree structure as a python dictionary. 
+
+    {text}
+    """
+
+    completion = client.chat.completions.create(
+    model=model,
+    messages=[
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": instructions}
+    ]
+    )
+
+    return completion.choices[0].message.content
+
+
+# helper functions to fill in page numbers into the tree the LLM creates
+def edit_output(prior_tree):
+    """
+    @param prior_tree: dictionary, tree made by LLM, leaves are 
+                       [current page number, next page number]
+
+    @return None (tree is passed by reference, leaves become lists of pages)
+    """
+    # this function is recurise to iterate through the nested tree depth first
+    for child in prior_tree:
+
+        # Tree's Leaves are a list of pages so check if leaves are rechead
+        if type(prior_tree[child]) == list:
+
+            prior_tree[child] = np.array(prior_tree[child]).flatten()
+            # initialise dictionary to assign page_number: text pairs
+            start = int(prior_tree[child][0])
+            end = int(prior_tree[child][1])
+            if start == end:
+                end += 1
+
+            prior_tree[child] = list(range(start, end))
+        
+        # if not a leaf, enter the child node (recursion)
+        else:
+            edit_output(prior_tree[child])
+
+
+# helper functions to convert LLM output (string) into an actual dictionary
+def clean_output(api_output):
+    """
+    @param api_output: str, LLM response
+
+    @return tree: dictionary, hirarchy built using content page
+    """
+    # find where LLM's output dictionary is located. LLM always places code 
+    # in between special characters
+    start = api_output.find("{")
+    end = api_output.find("```", start)
+
+    # response without a code block
+    if end == -1:
+        end = api_output.rfind("}") + 1
+
+    dict_string = api_output[start:end].strip()
+
+    # converts string to dictionary (literals only, never runs LLM output)
+    dict_actual = ast.literal_eval(dict_string)
+
+    edit_output(dict_actual)
+
+    return dict_actual
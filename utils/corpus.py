@@ -0,0 +1,585 @@
+# Corpus functions ===========================================================
+
+# Chunks stored as spans into per-document text buffers. Text is only
+# resolved (sliced out of the buffer) when it is looked up.
+import hashlib
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+from utils.json_parser import (
+    json_file_to_dict, 
+    save_corpus_bundle, 
+    corpus_bundle_to_arrays
+)
+from utils.metadata_store import (
+    MetadataStore, 
+    StableIdIndex, 
+    decode_page, 
+    iter_inverted_tree, 
+    make_chunk_ids
+)
+
+
+class ChunkSpans:
+    '''
+    This class resolves chunk spans saved by
+    preprocessing.generate_chunk_spans. Chunks and paragraphs are referred to
+    by integer IDs and their text is sliced out of the document buffers when
+    it is needed. Buffers are read from disk the first time they are used.
+
+    Input:
+    -----------
+        spans: dict
+            spans saved by preprocessing.generate_chunk_spans
+    '''
+
+    def __init__(self, spans):
+        self.documents = spans["documents"]
+        self.spans = spans["chunks"]
+        self.paragraph_spans = spans["paragraphs"]
+
+        # text buffers are loaded lazily
+        self.buffers = [None] * len(self.documents)
+
+    def __len__(self):
+        return len(self.spans)
+
+    def buffer(self, doc):
+        """
+        @param doc: int, ID of document
+
+        @return buffer: str, text of all pages of the document
+        """
+        if self.buffers[doc] is None:
+
+            # newline = '' keeps "\r\n", the span offsets count it as 2
+            with open(self.documents[doc]["text_path"], 'r',
+                      encoding = 'utf-8', newline = '') as file:
+                self.buffers[doc] = file.read()
+
+        return self.buffers[doc]
+
+    def text(self, chunk_id):
+        """
+        @param chunk_id: int
+
+        @return text: str, text of chunk
+        """
+        doc, page, start, end, paragraph = self.spans[chunk_id]
+        return self.buffer(doc)[start:end]
+
+    def paragraph(self, chunk_id):
+        """
+        @param chunk_id: int
+
+        @return paragraph: str, text of the paragraph the chunk is from
+        """
+        doc, start, end = self.paragraph_spans[self.spans[chunk_id][4]]
+        return self.buffer(doc)[start:end]
+
+    def year(self, chunk_id):
+        """
+        @param chunk_id: int
+
+        @return year: str, year of the document the chunk is from
+        """
+        return self.documents[self.spans[chunk_id][0]]["year"]
+
+    def page(self, chunk_id):
+        """
+        @param chunk_id: int
+
+        @return page: int, page number written on the pdf
+        """
+        return self.spans[chunk_id][1]
+
+    def chunks(self):
+        """
+        @return chunks: list (str), text of every chunk, same as chunks.json
+        """
+        return [self.text(chunk_id) for chunk_id in range(len(self))]
+
+    def chunk_pageNum_pairs(self):
+        """
+        @return chunk_dict: dict, year: {chunk (str): page (int)}, same as
+                            chunk_pageNum_pairs.json
+        """
+        chunk_dict = {document["year"]: {} for document in self.documents}
+
+        for chunk_id in range(len(self)):
+            chunk_dict[self.year(chunk_id)][self.text(chunk_id)] = \
+                self.page(chunk_id)
+
+        return chunk_dict
+
+    def sentence_paragraph_pairs(self):
+        """
+        @return sentence_paragraph_pairs: dict, sentence (str): paragraph (str)
+        """
+        return {self.text(chunk_id): self.paragraph(chunk_id)
+                for chunk_id in range(len(self))}
+
+
+# Loads chunk spans saved by preprocessing.generate_chunk_spans
+def load_chunk_spans(spans_path):
+    '''
+    This function loads chunk spans. Text buffers are not read until a chunk
+    is looked up.
+
+    Input:
+    -----------
+        spans_path: str
+            Path to spans.
+
+    Output:
+    --------
+        chunk_spans: ChunkSpans
+            resolves chunk IDs to text and metadata
+    '''
+    spans = json_file_to_dict(spans_path)
+
+    if spans is None:
+        return None
+
+    return ChunkSpans(spans)
+
+
+# Corpus bundle ==============================================================
+
+# MAIN FUNCTION WRAPPER
+# This function converts the JSON artifacts into a corpus bundle
+def generate_corpus_bundle(save_inverted_tree_path, s_p_pairs_path, bundle_dir):
+    ''' 
+    This function builds a corpus bundle from the inverted tree and the 
+    sentence : paragraph pairs. Run it once after the inverted tree is made.
+   
+    Input:
+    -----------
+        save_inverted_tree_path: str
+            Path to inverted tree.
+
+        s_p_pairs_path: str
+            Path to sentence and paragraph pairs. None if chunks are 
+            paragraphs.
+        
+        bundle_dir: str
+            Path to save corpus bundle.
+
+    Output:
+    --------
+        None
+            function saves the corpus bundle, see write_corpus_bundle
+    '''
+    inverted_tree = json_file_to_dict(save_inverted_tree_path)
+
+    if s_p_pairs_path is not None:
+        s_p_pairs = json_file_to_dict(s_p_pairs_path)
+    else:
+        s_p_pairs = None
+
+    write_corpus_bundle(inverted_tree, bundle_dir, s_p_pairs)
+
+
+def write_corpus_bundle(inverted_tree, bundle_dir, sentence_paragraph_pairs = None):
+    ''' 
+    This function saves the chunks and their metadata as a corpus bundle.
+    Chunk IDs follow the order of the inverted tree, which is the order used 
+    for chunks and metadata everywhere else.
+   
+    Input:
+    -----------
+        inverted_tree: dictionary
+            chunks (str) : meta data formed from content page, or ID keyed 
+            (see content_page_parser.key_by_chunk_id)
+
+        bundle_dir: str
+            Path to save corpus bundle.
+        
+        sentence_paragraph_pairs: dictionary
+            sentences (str) : paragraphs (str) the sentences are from
+            
+    Output:
+    --------
+        None
+            function saves the following data in bundle_dir:
+
+            chunk_text.bin, chunk_offsets.npy
+                utf-8 text of all chunks in one buffer. Chunk i is 
+                chunk_text[chunk_offsets[i] : chunk_offsets[i + 1]]
+
+            paragraph_text.bin, paragraph_offsets.npy
+                paragraph table, same layout as chunks
+
+            year.npy, location.npy, page.npy, paragraph.npy
+                one integer code per chunk. year and location index into 
+                tables.json, paragraph indexes into the paragraph table. 
+                -1 if missing.
+
+            stable_id_sorted.npy, stable_id_rows.npy
+                sorted stable chunk IDs and the chunk ID of each, see 
+                metadata_store.StableIdIndex
+
+            text_hash_sorted.npy, text_hash_rows.npy
+                sorted 64 bit hashes of the chunk texts and the chunk ID of 
+                each, to find a chunk by text (see CorpusBundle.chunk_id)
+
+            tables.json
+                {"years": [str], "locations": [[str]], "n_chunks": int}
+    '''
+    if sentence_paragraph_pairs is None:
+        sentence_paragraph_pairs = {}
+
+    n_chunks = len(inverted_tree)
+
+    # year, location and page columns
+    store = MetadataStore.from_inverted_tree(inverted_tree)
+
+    # paragraph column, paragraphs are interned so each is stored once
+    paragraph_codes = np.empty(n_chunks, dtype = np.int32)
+    paragraphs = {}
+
+    chunk_text = []
+    chunk_offsets = np.zeros(n_chunks + 1, dtype = np.int64)
+
+    for i, (chunk, _) in enumerate(iter_inverted_tree(inverted_tree)):
+
+        encoded = chunk.encode('utf-8')
+        chunk_text.append(encoded)
+        chunk_offsets[i + 1] = chunk_offsets[i] + len(encoded)
+        
+        paragraph = sentence_paragraph_pairs.get(chunk, -1)
+        if paragraph != -1:
+            paragraph_codes[i] = paragraphs.setdefault(paragraph, 
+                                                       len(paragraphs))
+        else:
+            paragraph_codes[i] = -1
+    
+    # reverse index, chunk text : chunk ID, by binary search on hashes
+    text_hashes = np.array([text_hash(text) for text in chunk_text], 
+                           dtype = np.uint64)
+    text_hash_rows = np.argsort(text_hashes, kind = 'stable')
+
+    paragraph_text = [paragraph.encode('utf-8') for paragraph in paragraphs]
+    paragraph_offsets = np.zeros(len(paragraph_text) + 1, dtype = np.int64)
+    paragraph_offsets[1:] = np.cumsum([len(text) for text in paragraph_text])
+
+    arrays = {
+        "chunk_text": b"".join(chunk_text),
+        "chunk_offsets": chunk_offsets,
+        "paragraph_text": b"".join(paragraph_text),
+        "paragraph_offsets": paragraph_offsets,
+        "year": store.year_ids,
+        "location": store.section_ids,
+        "page": store.pages,
+        "paragraph": paragraph_codes,
+        "stable_id_sorted": store.stable_ids.sorted_ids,
+        "stable_id_rows": store.stable_ids.rows,
+        "text_hash_sorted": text_hashes[text_hash_rows],
+        "text_hash_rows": text_hash_rows
+    }
+
+    tables = {
+        "years": store.years,
+        "locations": [list(path) for path in store.sections.paths],
+        "n_chunks": n_chunks
+    }
+
+    save_corpus_bundle(arrays, tables, bundle_dir)
+
+
+class CorpusBundle:
+    '''
+    This class reads a memory mapped corpus bundle. Text is decoded from the 
+    mapped buffers when it is looked up.
+
+    inverted_tree() and sentence_paragraph_pairs() return read only views 
+    that can be used wherever the JSON dictionaries were used, e.g. 
+    prompt_engineering.generate_prompt.
+
+    Input:
+    -----------
+        arrays, tables:
+            output of json_parser.corpus_bundle_to_arrays
+    '''
+
+    def __init__(self, arrays, tables):
+        self.arrays = arrays
+        self.years = tables["years"]
+        self.locations = tables["locations"]
+        self.n_chunks = tables["n_chunks"]
+
+        # sorted text hashes and their chunk IDs, read the first time a chunk
+        # is looked up by text
+        self.text_hashes = None
+
+    def __len__(self):
+        return self.n_chunks
+    
+    def text(self, chunk_id):
+        """
+        @param chunk_id: int
+
+        @return text: str, text of chunk
+        """
+        offsets = self.arrays["chunk_offsets"]
+        start, end = offsets[chunk_id], offsets[chunk_id + 1]
+        return bytes(self.arrays["chunk_text"][start:end]).decode('utf-8')
+    
+    def paragraph(self, chunk_id):
+        """
+        @param chunk_id: int
+
+        @return paragraph: str, paragraph the chunk is from, None if unknown
+        """
+        paragraph = self.arrays["paragraph"][chunk_id]
+
+        if paragraph == -1:
+            return None
+        
+        offsets = self.arrays["paragraph_offsets"]
+        start, end = offsets[paragraph], offsets[paragraph + 1]
+        return bytes(self.arrays["paragraph_text"][start:end]).decode('utf-8')
+    
+    def metadata(self, chunk_id):
+        """
+        @param chunk_id: int
+
+        @return metadata: dictionary, same as the values of the inverted tree
+        """
+        metadata = {"year": self.years[self.arrays["year"][chunk_id]]}
+
+        location = self.arrays["location"][chunk_id]
+        if location != -1:
+            metadata["location"] = self.locations[location]
+        
+        page = decode_page(self.arrays["page"][chunk_id])
+        if page is not None:
+            metadata["page"] = page
+        
+        return metadata
+
+    def chunks(self):
+        """
+        @return chunks: list (str), text of every chunk in chunk ID order
+        """
+        # decode the whole buffer once and slice it, which is much faster 
+        # than decoding chunk by chunk
+        buffer = bytes(self.arrays["chunk_text"])
+        offsets = self.arrays["chunk_offsets"].tolist()
+
+        return [buffer[offsets[i] : offsets[i + 1]].decode('utf-8') 
+                for i in range(self.n_chunks)]
+    
+    def chunk_list(self):
+        """
+        @return chunks: ChunkList, text of every chunk in chunk ID order, 
+                        decoded when indexed
+        """
+        return ChunkList(self)
+
+    def text_hash_index(self):
+        """
+        @return sorted_hashes: numpy array (uint64), hash of every chunk text
+        @return rows: numpy array (int), chunk ID of each sorted hash
+        """
+        if self.text_hashes is not None:
+            return self.text_hashes
+        
+        if "text_hash_sorted" in self.arrays:
+            self.text_hashes = (self.arrays["text_hash_sorted"], 
+                                self.arrays["text_hash_rows"])
+            return self.text_hashes
+        
+        # bundles written before the hashes were saved, hashed from the 
+        # buffer without decoding
+        buffer = bytes(self.arrays["chunk_text"])
+        offsets = self.arrays["chunk_offsets"].tolist()
+
+        hashes = np.fromiter((text_hash(buffer[offsets[i] : offsets[i + 1]]) 
+                              for i in range(self.n_chunks)), 
+                             dtype = np.uint64, count = self.n_chunks)
+        rows = np.argsort(hashes, kind = 'stable')
+
+        self.text_hashes = (hashes[rows], rows)
+        return self.text_hashes
+
+    def chunk_id(self, chunk):
+        """
+        @param chunk: str, text of chunk
+
+        @return chunk_id: int, raises KeyError if chunk is not in the corpus. 
+                          Identical chunks (from an ID keyed tree) resolve to
+                          the first.
+        """
+        sorted_hashes, rows = self.text_hash_index()
+        key = np.uint64(text_hash(chunk.encode('utf-8')))
+
+        start = np.searchsorted(sorted_hashes, key, side = 'left')
+        end = np.searchsorted(sorted_hashes, key, side = 'right')
+
+        # rows of equal hashes are in chunk ID order, the text is compared 
+        # in case two texts share a hash
+        for row in rows[start:end]:
+            if self.text(row) == chunk:
+                return int(row)
+        
+        raise KeyError(chunk)
+
+    def fingerprint(self, name):
+        """
+        @param name: str, e.g. name of the model the fingerprint is for
+
+        @return fingerprint: str, sha256 hex digest of name and the chunk 
+                             buffers, hashed without decoding any chunk
+        """
+        digest = hashlib.sha256(name.encode('utf-8'))
+        digest.update(np.ascontiguousarray(self.arrays["chunk_offsets"]))
+        digest.update(np.ascontiguousarray(self.arrays["chunk_text"]))
+
+        return digest.hexdigest()
+
+    def stable_id_index(self):
+        """
+        @return index: metadata_store.StableIdIndex, stable chunk ID : chunk ID
+        """
+        if "stable_id_sorted" in self.arrays:
+            return StableIdIndex(self.arrays["stable_id_sorted"], 
+                                 self.arrays["stable_id_rows"])
+        
+        # bundles written before stable IDs were saved
+        metadata = [self.metadata(i) for i in range(self.n_chunks)]
+        return StableIdIndex.from_ids(make_chunk_ids(self.chunks(), metadata))
+
+    def inverted_tree(self):
+        """
+        @return view: Mapping, chunk (str) : metadata (dict)
+        """
+        return CorpusView(self, self.metadata)
+
+    def sentence_paragraph_pairs(self):
+        """
+        @return view: Mapping, sentence (str) : paragraph (str)
+        """
+        return CorpusView(self, self.paragraph)
+
+    def metadata_store(self):
+        """
+        @return store: metadata_store.MetadataStore over the bundle columns
+        """
+        return MetadataStore.from_corpus_bundle(self)
+
+
+class CorpusView(Mapping):
+    '''
+    Read only dictionary view over a corpus bundle, keyed by chunk text.
+
+    Input:
+    -----------
+        bundle: CorpusBundle
+        
+        value: function
+            maps a chunk ID to the value of the view
+    '''
+
+    def __init__(self, bundle, value):
+        self.bundle = bundle
+        self.value = value
+
+    def __getitem__(self, chunk):
+        value = self.value(self.bundle.chunk_id(chunk))
+
+        # chunks without a value behave like missing keys
+        if value is None:
+            raise KeyError(chunk)
+        
+        return value
+
+    def __iter__(self):
+        return iter(self.bundle.chunk_list())
+
+    def __len__(self):
+        return len(self.bundle)
+
+
+class ChunkList(Sequence):
+    '''
+    Read only list of the chunk texts of a corpus bundle. A chunk is decoded 
+    from the memory mapped buffer when it is indexed, so it can be passed 
+    wherever a list of chunks is read by position.
+
+    Input:
+    -----------
+        bundle: CorpusBundle
+    '''
+
+    def __init__(self, bundle):
+        self.bundle = bundle
+
+    def __len__(self):
+        return len(self.bundle)
+
+    def __getitem__(self, chunk_id):
+        if isinstance(chunk_id, slice):
+            return [self.bundle.text(i) 
+                    for i in range(*chunk_id.indices(len(self)))]
+        
+        if chunk_id < 0:
+            chunk_id += len(self)
+
+        if not 0 <= chunk_id < len(self):
+            raise IndexError(chunk_id)
+        
+        return self.bundle.text(chunk_id)
+
+    def position(self, chunk):
+        """
+        @param chunk: str, text of chunk
+
+        @return chunk_id: int, first chunk with this text, None if unknown
+        """
+        try:
+            return self.bundle.chunk_id(chunk)
+        except KeyError:
+            return None
+    
+    def fingerprint(self, name):
+        """
+        @param name: str, see CorpusBundle.fingerprint
+
+        @return fingerprint: str
+        """
+        return self.bundle.fingerprint(name)
+
+
+def text_hash(data):
+    """
+    @param data: bytes, utf-8 text
+
+    @return hash: int, 64 bit hash of the text
+    """
+    return int.from_bytes(hashlib.blake2b(data, digest_size = 8).digest(), 
+                          'little')
+
+
+# Loads a corpus bundle saved by write_corpus_bundle
+def load_corpus_bundle(bundle_dir):
+    ''' 
+    This function memory maps a corpus bundle.
+   
+    Input:
+    -----------
+        bundle_dir: str
+            Path to corpus bundle folder.
+
+    Output:
+    --------
+        bundle: CorpusBundle
+            None if the bundle cannot be read
+    '''
+    arrays, tables = corpus_bundle_to_arrays(bundle_dir)
+
+    if arrays is None:
+        return None
+    
+    return CorpusBundle(arrays, tables)
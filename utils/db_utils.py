@@ -1,5 +1,19 @@
 from IPython.utils import io
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import itertools
+import random
+import time
+import json
+import os
+import re
+from scipy import sparse
+import openai
+
+from utils.metadata_store import MetadataStore, make_chunk_ids
+from utils.text_analyzer import TextAnalyzer
+from utils.fusion import fuse_results
 
 # dense embedding search =====================================================
 
@@ -50,7 +64,7 @@ def chroma_preprocess_metadata(pre_metadata):
    
     Input:
     -----------
-        pre_metadata: list (dict)
+        pre_metadata: list (dict) or metadata_store.MetadataStore
             pre_metadata = list(inverted_tree.values())
 
     Output:
@@ -58,6 +72,9 @@ def chroma_preprocess_metadata(pre_metadata):
         metadata: list (dict)
             location field is changes from list to string
     '''
+    # a metadata store joins each section's headings once, not once per chunk
+    if isinstance(pre_metadata, MetadataStore):
+        return pre_metadata.chroma_metadata()
 
     # initialise metadata list
     metadata = []
@@ -89,9 +106,11 @@ def chroma_preprocess_metadata(pre_metadata):
     return metadata
 
 
-def chroma_fill_db(db, chunks, metadata, batch_size):
+def chroma_fill_db(db, chunks, metadata, batch_size, ids = None):
     ''' 
-    This function fills the data base with chunks and metadata
+    This function fills the data base with chunks and metadata. Chunks are 
+    upserted under stable IDs, so running it again (e.g. after a partial 
+    failure) does not duplicate vectors.
    
     Input:
     -----------
@@ -107,12 +126,18 @@ def chroma_fill_db(db, chunks, metadata, batch_size):
         batch_size: int
             add to data base in batches
 
+        ids: list (str)
+            id of each chunk. Defaults to metadata_store.make_chunk_ids.
+
     Output:
     ----------
         None
             data base passed in by reference and filled in function
         
     '''
+    if ids is None:
+        ids = make_chunk_ids(chunks, metadata)
+
     # avoid unnecessary printing in jupyter notebooks
     with io.capture_output() as captured:
 
@@ -120,8 +145,8 @@ def chroma_fill_db(db, chunks, metadata, batch_size):
         i, start, end = 0, 0, batch_size
 
         if batch_size >= len(chunks):
-            db.add(
-                ids = [f"id{i}" for i in range(len(chunks))],
+            db.upsert(
+                ids = ids,
                 metadatas=metadata,
                 documents=chunks
             )
@@ -137,8 +162,8 @@ def chroma_fill_db(db, chunks, metadata, batch_size):
             end = batch_size * (i + 1)
 
             # add batch to data base
-            db.add(
-                ids = [f"id{i}" for i in range(start, end)],
+            db.upsert(
+                ids = ids[start : end],
                 metadatas=metadata[start : end],
                 documents=chunks[start : end]
             )
@@ -147,15 +172,17 @@ def chroma_fill_db(db, chunks, metadata, batch_size):
             i += 1
 
         # add remainder that do not amount to a whole batch
-        db.add(
-                ids = [f"id{i}" for i in range(end, len(chunks))],
+        db.upsert(
+                ids = ids[end:],
                 metadatas=metadata[end:],
                 documents=chunks[end:]
             )
 
-def chroma_update_db(db, chunks, metadata, batch_size):
+def chroma_update_db(db, chunks, metadata, batch_size, ids = None):
     ''' 
-    This function fills the data base with chunks and metadata
+    This function adds chunks and metadata to a filled data base. IDs no 
+    longer depend on db.count(), so chunks already in the data base are 
+    overwritten instead of duplicated.
    
     Input:
     -----------
@@ -171,292 +198,2963 @@ def chroma_update_db(db, chunks, metadata, batch_size):
         batch_size: int
             add to data base in batches
 
+        ids: list (str)
+            id of each chunk. Defaults to metadata_store.make_chunk_ids.
+
     Output:
     ----------
         None
             data base passed in by reference and filled in function
         
     '''
-    # avoid unnecessary printing in jupyter notebooks
-    with io.capture_output() as captured:
-
-        current_idx = db.count()
-
-        # add to data base in batches 
-        i, start, end = 0, 0, batch_size
-
-        if batch_size >= len(chunks):
-            db.add(
-                ids = [f"id{i + current_idx}" for i in range(len(chunks))],
-                metadatas=metadata,
-                documents=chunks
-            )
+    chroma_fill_db(db, chunks, metadata, batch_size, ids)
 
-            return
-
-
-        # loop though chunks in batches of batch_size
-        while batch_size * (i + 1) < len(chunks):
-
-            # set start and end indices
-            start = batch_size * i
-            end = batch_size * (i + 1)
 
-            # add batch to data base
-            db.add(
-                ids = [f"id{i + current_idx}" for i in range(start, end)],
-                metadatas=metadata[start : end],
-                documents=chunks[start : end]
-            )
+def chroma_get_ids(db, batch_size = 10000):
+    ''' 
+    This function reads the ID and metadata of every chunk in the data base, 
+    in pages of batch_size.
+   
+    Input:
+    -----------
+        db: chromadb.api.models.Collection
+            vector database
+        
+        batch_size: int
+            number of chunks read per request
 
-            # increment to next batch
-            i += 1
+    Output:
+    ----------
+        stored: dict
+            id (str) : metadata (dict)
+    '''
+    stored = {}
 
-        # add remainder that do not amount to a whole batch
-        db.add(
-                ids = [f"id{i + current_idx}" for i in range(end, len(chunks))],
-                metadatas=metadata[end:],
-                documents=chunks[end:]
-            )
+    for offset in range(0, db.count(), batch_size):
+        page = db.get(include = ["metadatas"], 
+                      limit = batch_size, 
+                      offset = offset)
         
+        stored.update(zip(page["ids"], page["metadatas"]))
+    
+    return stored
+
 
-def chromadb_embedding_search(database, query, top_k):
+def chroma_sync_db(db, 
+                   chunks, 
+                   metadata, 
+                   batch_size, 
+                   ids = None, 
+                   embedding_function = None,
+                   **embed_kwargs):
     ''' 
-    This function fills the data base with chunks and metadata
+    This function makes the data base match a refreshed corpus by comparing 
+    stable chunk IDs. Only changed chunks are touched:
+        - chunks missing from the data base are added (and embedded)
+        - chunks no longer in the corpus are deleted
+        - chunks whose metadata changed (e.g. new content page tree) have 
+          their metadata updated without being embedded again
    
     Input:
     -----------
-        database: chromadb.api.models.Collection
+        db: chromadb.api.models.Collection
             vector database
         
-        query: str
-            question by user
+        chunks: list (str)
+            each element is text (str) of a chunk
+        
+        metadata: list (dict)
+            contains year, location in document and page number of chunk
+        
+        batch_size: int
+            add to data base in batches
 
-        top_k: int
-            filter chunks among the top_k matches with query
+        ids: list (str)
+            id of each chunk. Defaults to metadata_store.make_chunk_ids.
+
+        embedding_function:
+            if given, new chunks are embedded up front with chroma_bulk_load,
+            otherwise chroma embeds them
+        
+        embed_kwargs:
+            passed to embed_chunks
 
     Output:
     ----------
-        results: list (str, str)
-            list of (result, rank) pairs
-        
+        counts: dict
+            number of chunks "added", "updated", "deleted" and "unchanged"
     '''
-    # dense search for match with query 
-    search_output = database.query(query_texts = [query],
-                             n_results = top_k)
-    
-    # return matching chunks and their rank 
-    results =  [(result, idx) for idx, result in 
-            enumerate(search_output['documents'][0])]
-    
-    return results
+    if ids is None:
+        ids = make_chunk_ids(chunks, metadata)
 
-# sparce embedding search ====================================================
+    stored = chroma_get_ids(db)
+    current = set(ids)
 
-# elasticsearch --------------------------------------------------------------
+    # diff corpus against data base
+    deleted = [chunk_id for chunk_id in stored if chunk_id not in current]
+    added = [i for i, chunk_id in enumerate(ids) if chunk_id not in stored]
+    updated = [i for i, chunk_id in enumerate(ids) 
+               if chunk_id in stored and stored[chunk_id] != metadata[i]]
 
-# Function to delete all indices
-def elastic_reset(client, http_auth):
-    try:
-        # Get a list of all indices
-        indices = client.indices.get('*', http_auth=http_auth)
+    # avoid unnecessary printing in jupyter notebooks
+    with io.capture_output() as captured:
 
-        # Loop through the indices and delete each one
-        for index in indices:
-            client.indices.delete(index=index, http_auth=http_auth)
-            print(f"reset index: {index}")
-    except Exception as e:
-        print(f"An error occurred when resetting elasticsearch: {e}")
+        for start in range(0, len(deleted), batch_size):
+            db.delete(ids = deleted[start : start + batch_size])
 
+        for start in range(0, len(updated), batch_size):
+            batch = updated[start : start + batch_size]
+            db.update(ids = [ids[i] for i in batch], 
+                      metadatas = [metadata[i] for i in batch])
 
+    new_ids = [ids[i] for i in added]
+    new_chunks = [chunks[i] for i in added]
+    new_metadata = [metadata[i] for i in added]
 
-def index_elastic_db(elastic_db, index_name, http_auth, chunks, reset):
-    ''' 
-    This function indexes the data so text search can be sped up drastically.
-    This only needs to be done when the database is set up. 
-   
-    Input:
-    -----------
-        elastic_db: chromadb.api.models.Collection
-            vector database
-        
-        index_name: str
-            elasticsearch can store multiple indexes so index_name is required.
+    if new_chunks and embedding_function is not None:
+        chroma_bulk_load(db, new_chunks, new_metadata, embedding_function, 
+                         batch_size, new_ids, **embed_kwargs)
+    
+    elif new_chunks:
+        chroma_fill_db(db, new_chunks, new_metadata, batch_size, new_ids)
 
-        http_auth: int
-            the container in use requires a username and password which is set 
-            upon creation.
+    counts = {"added": len(added), 
+              "updated": len(updated), 
+              "deleted": len(deleted),
+              "unchanged": len(ids) - len(added) - len(updated)}
+    print(f"chroma sync: {counts}")
+
+    return counts
         
-        chunks: list (str)
-            each element is text (str) of a chunk
 
-        reset: boolean
-            resets elastic db indices
+# bulk loading ---------------------------------------------------------------
+# Embeddings are computed up front, concurrently and in token limited batches,
+# then passed to chroma so it does not embed each batch serially itself.
 
+def get_token_counter(model_name = "text-embedding-3-small"):
+    ''' 
+    This function returns a function that counts the tokens of a text for an 
+    OpenAI embedding model. tiktoken is used if installed, otherwise tokens 
+    are estimated as 1 token per 4 characters (rounded up).
+   
+    Input:
+    -----------
+        model_name: str
+            OpenAI embedding model
 
     Output:
     ----------
-        None
-            data base passed in by reference and indexed in function
-        
+        count_tokens: function
+            count_tokens(text) returns the number of tokens (int)
     '''
-    # create indexing for sparce search
-    if not elastic_db.indices.exists(index=index_name, http_auth=http_auth):
-        elastic_db.indices.create(index=index_name, http_auth=http_auth)
+    try:
+        import tiktoken
 
-    if reset:
-        elastic_reset(elastic_db, http_auth=http_auth)
+        encoding = tiktoken.encoding_for_model(model_name)
+        return lambda text: len(encoding.encode(text, disallowed_special = ()))
+    
+    except (ImportError, KeyError):
+        return lambda text: len(text) // 4 + 1
 
-    # Index documents
-    for i, chunk in enumerate(chunks):
-        elastic_db.index(index=index_name, 
-                    id=i, 
-                    body={'text': chunk}, 
-                    http_auth=http_auth)
-        
-def bm25_elasticsearch(elastic_db, index_name, http_auth, query, top_k):
+
+def token_batches(chunks, count_tokens, max_tokens, max_batch_size):
     ''' 
-    This function searches the database for a query that matches the text 
-    using BM25.
+    This function splits chunks into batches that fit in one embedding 
+    request.
    
     Input:
     -----------
-        elastic_db: chromadb.api.models.Collection
-            vector database
+        chunks: list (str)
+            each element is text (str) of a chunk
         
-        index_name: str
-            elasticsearch can store multiple indexes so index_name is required.
+        count_tokens: function
+            see get_token_counter
 
-        http_auth: int
-            the container in use requires a username and password which is set 
-            upon creation.
+        max_tokens: int
+            max number of tokens in a batch. A chunk larger than max_tokens 
+            gets a batch of its own.
         
-        query: str
-            question by user
-
-        top_k: int
-            filter chunks among the top_k matches with query
+        max_batch_size: int
+            max number of chunks in a batch
 
     Output:
     ----------
-        results: list (str, int)
-            list of (result, rank) pairs
-        
+        batches: list (int, int)
+            (start, end) indices of each batch
     '''
-    # set up a http request to the database sitting in a docker container
-    response = elastic_db.search(index=index_name, body={
-        'query': {
-            'match': {
-                'text': query
-            }
-        },
-        'size': top_k
-    }, http_auth=http_auth)
+    batches = []
+    start, tokens = 0, 0
 
-    # return search results
-    results = [
-        (hit['_source']['text'], idx) 
-        for idx, hit in 
-        enumerate(response['hits']['hits'])
-        ]
+    for i, chunk in enumerate(chunks):
+        n_tokens = count_tokens(chunk)
+
+        # close batch if chunk does not fit
+        if i > start and (tokens + n_tokens > max_tokens 
+                          or i - start >= max_batch_size):
+            batches.append((start, i))
+            start, tokens = i, 0
+        
+        tokens += n_tokens
     
-    return results
+    if start < len(chunks):
+        batches.append((start, len(chunks)))
 
-# python manual bm25 search --------------------------------------------------
-def bm25_search(BM25_db, chunks, query, top_k):
-    ''' 
-    This function searches for a query that matches the text using BM25. It 
-    does not use a persistent database but instead a program memory. 
+    return batches
 
-    The chunks (dataset) has to be passed in everytime the search is done. 
-    This is not recommended for large datasets and production. It can be used
-    for testing simple RAG frameworks.
+
+# errors worth retrying: rate limits, timeouts and dropped connections. Other 
+# errors (bad request, authentication, ...) fail the same way every time.
+RETRYABLE_EMBEDDING_ERRORS = (openai.RateLimitError, 
+                              openai.APITimeoutError, 
+                              openai.APIConnectionError, 
+                              TimeoutError, 
+                              ConnectionError)
+
+def embed_with_retry(embedding_function, 
+                     texts, 
+                     max_retries, 
+                     backoff, 
+                     retryable = RETRYABLE_EMBEDDING_ERRORS):
+    ''' 
+    This function embeds a batch of texts, retrying with exponential backoff 
+    (and jitter) when the request fails with a transient error, e.g. when 
+    rate limited. Other errors are raised at once.
    
     Input:
     -----------
-        BM25_db: rank_bm25.BM25Okapi
-            vector database
+        embedding_function: 
+            chromadb.utils.embedding_functions.OpenAIEmbeddingFunction
+            or any function mapping a list of texts to a list of vectors
+
+        texts: list (str)
+            batch of texts
+
+        max_retries: int
+            number of retries before the error is raised
 
+        backoff: float
+            seconds to wait before the first retry, doubled every retry
+
+        retryable: tuple (type)
+            exceptions that are retried
+
+    Output:
+    ----------
+        embeddings: list (list (float))
+            one vector per text
+    '''
+    for attempt in range(max_retries + 1):
+        try:
+            return embedding_function(texts)
+        
+        except retryable as e:
+            if attempt == max_retries:
+                raise
+
+            wait = backoff * (2 ** attempt) * (1 + random.random())
+            print(f"embedding batch failed ({e}), retrying in {wait:.1f}s")
+            time.sleep(wait)
+
+
+def embed_chunks(chunks, 
+                 embedding_function, 
+                 max_tokens = 100000, 
+                 max_batch_size = 2048,
+                 max_workers = 4,
+                 max_retries = 5,
+                 backoff = 1.0,
+                 count_tokens = None):
+    ''' 
+    This function embeds every chunk. Batches are limited by tokens and sent 
+    concurrently in a bounded pool of threads.
+   
+    Input:
+    -----------
         chunks: list (str)
             each element is text (str) of a chunk
         
-        query: str
-            question by user
+        embedding_function: 
+            see embed_with_retry
 
-        top_k: int
-            filter chunks among the top_k matches with query
+        max_tokens: int
+            max number of tokens in an embedding request
+
+        max_batch_size: int
+            max number of chunks in an embedding request (2048 for OpenAI)
+        
+        max_workers: int
+            max number of concurrent embedding requests
+        
+        max_retries, backoff:
+            see embed_with_retry
+
+        count_tokens: function
+            see get_token_counter. Defaults to text-embedding-3-small.
 
     Output:
     ----------
-        results: list (str, int)
-            list of (result, rank) pairs
-        
+        embeddings: numpy array (float32)
+            one row per chunk
     '''
-    # tokenizing splits the query into words as BM25 uses Bag-of-words
-    tokenized_query = query.split()
+    # timed to report throughput (embedded chunks/sec)
+    start = time.time()
 
-    # Get BM25 scores
-    bm25_scores = BM25_db.get_scores(tokenized_query)
+    if count_tokens is None:
+        count_tokens = get_token_counter()
 
-    # Sort chunks based on BM25 scores
-    top_n_indices = np.argsort(bm25_scores)[-top_k:][::-1]
+    batches = token_batches(chunks, count_tokens, max_tokens, max_batch_size)
 
-    # return results
-    return [(chunks[idx], idx) for idx in top_n_indices]
+    def embed_batch(batch):
+        return embed_with_retry(embedding_function, 
+                                chunks[batch[0] : batch[1]], 
+                                max_retries, 
+                                backoff)
 
+    # map keeps the order of batches
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        vectors = [vector 
+                   for batch_vectors in executor.map(embed_batch, batches)
+                   for vector in batch_vectors]
 
-# Fusion =====================================================================
-def reciprocal_rank_fusion(bm25_results, 
-                           embedding_results, 
-                           weights, 
-                           k=60):
+    embeddings = np.asarray(vectors, dtype = np.float32)
+
+    # report throughput
+    end = time.time()
+    print(f"embedded {len(chunks)} chunks in {len(batches)} requests, "
+          f"{end - start:.2f} seconds "
+          f"({len(chunks) / max(end - start, 1e-9):.1f} chunks/sec)")
+
+    return embeddings
+
+
+def chroma_bulk_load(db, 
+                     chunks, 
+                     metadata, 
+                     embedding_function, 
+                     batch_size, 
+                     ids = None,
+                     **embed_kwargs):
     ''' 
-    This function fuses 2 ranks and produces a final rank using RRF algorithm.
+    This function fills the data base with chunks, metadata and embeddings 
+    computed up front by embed_chunks. Chroma does not embed anything itself.
    
     Input:
     -----------
-        bm25_results: list (str, str)
-            list of (result, rank) pairs from BM25
+        db: chromadb.api.models.Collection
+            vector database
+        
+        chunks: list (str)
+            each element is text (str) of a chunk
+        
+        metadata: list (dict)
+            contains year, location in document and page number of chunk
 
-        embedding_results: list (str, str)
-            list of (result, rank) pairs from dense search
+        embedding_function: 
+            see embed_with_retry. Should be the embedding function of the 
+            collection, so queries are embedded the same way.
+        
+        batch_size: int
+            add to data base in batches
 
-        weights: list
-            list of weights assigned to each retriever results
+        ids: list (str)
+            id of each chunk. Defaults to metadata_store.make_chunk_ids.
 
-        k: int
-            a constant used in the RRF algorithm.
-            Empirically, k = 60 gives the best results.
+        embed_kwargs:
+            passed to embed_chunks
 
     Output:
     ----------
-        results: list (str)
-            list of chunks
-        
+        None
+            data base passed in by reference and filled in function
     '''
-    # initialise dictionary for chunk: score pairs
-    fusion_scores = {}
+    if ids is None:
+        ids = make_chunk_ids(chunks, metadata)
 
-    # obtain weights from input
-    bm25_weight = weights[0]
-    embedding_weight = weights[1]
+    embeddings = embed_chunks(chunks, embedding_function, **embed_kwargs)
 
-    # add weighted scores from bm25 ranked results
-    for chunk, rank in bm25_results:
-        fusion_scores[chunk] = (fusion_scores.get(chunk, 0) 
-                                + bm25_weight / (k + rank))
-    
-    # add weighted scores from dense embedding search ranked results
-    for chunk, rank in embedding_results:
-        fusion_scores[chunk] = (fusion_scores.get(chunk, 0) 
-                                + embedding_weight / (k + rank))
-    
-    # sort final scores in decreasing order
-    sorted_results = sorted(fusion_scores.items(), 
-                            key=lambda item: item[1], 
-                            reverse=True)
+    # avoid unnecessary printing in jupyter notebooks
+    with io.capture_output() as captured:
+
+        # add to data base in batches
+        for start in range(0, len(chunks), batch_size):
+            end = start + batch_size
+
+            db.upsert(
+                ids = ids[start:end],
+                embeddings = embeddings[start:end].tolist(),
+                metadatas = metadata[start:end],
+                documents = chunks[start:end]
+            )
+
+
+# blue/green rebuilds --------------------------------------------------------
+# A rebuild loads a new generation of the collection (name__<timestamp>) while 
+# the live one keeps serving. After the count is validated, a pointer file is 
+# replaced atomically to switch readers over, and old generations are deleted.
+
+def generation_name(name):
+    """
+    @param name: str, collection name or elasticsearch alias
+
+    @return generation: str, name__<timestamp>, sorts by creation time
+    """
+    now = time.time()
+
+    return (f"{name}__{time.strftime('%Y%m%d%H%M%S', time.localtime(now))}"
+            f"{int(now * 1e6) % 10**6:06d}")
+
+
+def chroma_read_pointer(pointer_path):
+    """
+    @param pointer_path: str, path to collection pointer
+
+    @return pointer: dict, {"collection": str, "count": int}, None if missing
+    """
+    if not os.path.exists(pointer_path):
+        return None
     
-    # return the best chunks
-    good_chunks = [chunk for chunk, score in sorted_results]
+    with open(pointer_path, 'r') as fp:
+        return json.load(fp)
+
 
-    return good_chunks
\ No newline at end of file
+def chroma_write_pointer(pointer, pointer_path):
+    """
+    @param pointer: dict, {"collection": str, "count": int}
+    @param pointer_path: str, path to collection pointer
+
+    @return None, the pointer file is replaced atomically
+    """
+    tmp_path = pointer_path + ".tmp"
+
+    with open(tmp_path, 'w') as fp:
+        json.dump(pointer, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    
+    os.replace(tmp_path, pointer_path)
+
+
+def chroma_resolve_collection(client, name, embedding_function, pointer_path):
+    ''' 
+    This function returns the live collection. It is the collection in the 
+    pointer file, or the collection called name if nothing was rebuilt yet.
+   
+    Input:
+    -----------
+        client: chromadb.api.ClientAPI
+            persistent client
+        
+        name: str
+            name of the database (collection)
+        
+        embedding_function: 
+            chromadb.utils.embedding_functions.OpenAIEmbeddingFunction
+            Embedding function used in chroma db
+
+        pointer_path: str
+            path to collection pointer
+
+    Output:
+    ----------
+        collection: chromadb.api.models.Collection
+            vector database
+    '''
+    pointer = chroma_read_pointer(pointer_path)
+
+    if pointer is None:
+        return chroma_get_or_create_collection(client, name, 
+                                               embedding_function, 
+                                               reset = False)
+    
+    return client.get_collection(name = pointer["collection"], 
+                                 embedding_function = embedding_function)
+
+
+class CollectionPointer:
+    '''
+    This class follows the collection pointer in a running app. The pointer 
+    file is checked on every get() (one stat call) and the live collection is 
+    resolved again only when the file changed.
+
+    Input:
+    -----------
+        client, name, embedding_function, pointer_path:
+            see chroma_resolve_collection
+    '''
+
+    def __init__(self, client, name, embedding_function, pointer_path):
+        self.client = client
+        self.name = name
+        self.embedding_function = embedding_function
+        self.pointer_path = pointer_path
+
+        self.mtime = None
+        self.collection = None
+
+    def get(self):
+        """
+        @return collection: chromadb.api.models.Collection, live collection
+        """
+        try:
+            mtime = os.stat(self.pointer_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        if self.collection is None or mtime != self.mtime:
+            self.collection = chroma_resolve_collection(self.client, 
+                                                        self.name, 
+                                                        self.embedding_function,
+                                                        self.pointer_path)
+            self.mtime = mtime
+        
+        return self.collection
+
+
+def chroma_collection_names(client, name):
+    """
+    @param client: chromadb.api.ClientAPI
+    @param name: str, collection name
+
+    @return names: list (str), generations of the collection, oldest first
+    """
+    return sorted(n for n in chroma_list_names(client) 
+                  if n.startswith(name + "__"))
+
+
+def chroma_list_names(client):
+    """
+    @param client: chromadb.api.ClientAPI
+
+    @return names: list (str), names of every collection in the client
+    """
+    # older chroma versions list Collection objects, newer ones list names
+    return [getattr(collection, "name", collection) 
+            for collection in client.list_collections()]
+
+
+def chroma_rebuild_collection(client, 
+                              name, 
+                              embedding_function, 
+                              chunks, 
+                              metadata, 
+                              batch_size,
+                              pointer_path,
+                              ids = None,
+                              keep = 1,
+                              bulk = True,
+                              **embed_kwargs):
+    ''' 
+    This function rebuilds the collection without downtime:
+        1. chunks are loaded into a new generation of the collection
+        2. the number of chunks in it is validated
+        3. the pointer file is switched to it atomically
+        4. old generations are deleted, except the newest keep of them
+   
+    The live collection is untouched until step 3, so queries keep being 
+    answered during the rebuild. If validation fails the new generation is 
+    deleted and the pointer is not changed.
+
+    Input:
+    -----------
+        client: chromadb.api.ClientAPI
+            persistent client
+        
+        name: str
+            name of the database (collection)
+        
+        embedding_function: 
+            embedding function of the collection
+        
+        chunks: list (str)
+            each element is text (str) of a chunk
+        
+        metadata: list (dict)
+            contains year, location in document and page number of chunk
+        
+        batch_size: int
+            add to data base in batches
+
+        pointer_path: str
+            path to collection pointer
+
+        ids: list (str)
+            id of each chunk. Defaults to metadata_store.make_chunk_ids.
+
+        keep: int
+            number of previous generations kept for rollback
+
+        bulk: bool
+            embed up front with chroma_bulk_load, otherwise chroma_fill_db
+
+        embed_kwargs:
+            passed to embed_chunks
+
+    Output:
+    ----------
+        collection: chromadb.api.models.Collection
+            new live collection
+    '''
+    if ids is None:
+        ids = make_chunk_ids(chunks, metadata)
+
+    # 1. load new generation
+    generation = generation_name(name)
+    collection = client.create_collection(name = generation, 
+                                          embedding_function = embedding_function)
+
+    try:
+        if bulk:
+            chroma_bulk_load(collection, chunks, metadata, embedding_function, 
+                             batch_size, ids, **embed_kwargs)
+        else:
+            chroma_fill_db(collection, chunks, metadata, batch_size, ids)
+
+        # 2. validate
+        expected = len(set(ids))
+        count = collection.count()
+
+        if count != expected:
+            raise ValueError(f"collection {generation} has {count} chunks, "
+                             f"expected {expected}")
+    
+    except Exception:
+        client.delete_collection(name = generation)
+        raise
+
+    # 3. switch
+    chroma_write_pointer({"collection": generation, "count": count}, 
+                         pointer_path)
+    print(f"switched {name} to {generation} ({count} chunks)")
+
+    # 4. garbage collect old generations
+    old_generations = [n for n in chroma_collection_names(client, name) 
+                       if n != generation]
+    
+    for old_generation in old_generations[:max(len(old_generations) - keep, 0)]:
+        client.delete_collection(name = old_generation)
+        print(f"deleted old generation {old_generation}")
+
+    return collection
+
+
+def chromadb_embedding_search(database, query, top_k, where = None, return_ids = False):
+    ''' 
+    This function fills the data base with chunks and metadata
+   
+    Input:
+    -----------
+        database: chromadb.api.models.Collection
+            vector database
+        
+        query: str
+            question by user
+
+        top_k: int
+            filter chunks among the top_k matches with query
+
+        where: dict
+            chroma metadata filter, e.g. query_constraints.chroma_where. Only 
+            chunks matching it are searched.
+
+        return_ids: bool
+            return (chroma ID, text) of each chunk instead of its text, so 
+            metadata is looked up by ID (metadata_store.make_chunk_id). The 
+            text resolves IDs of collections built with other IDs.
+
+    Output:
+    ----------
+        results: list (str, str)
+            list of (result, rank) pairs
+        
+    '''
+    # dense search for match with query 
+    search_output = database.query(query_texts = [query],
+                             n_results = top_k,
+                             where = where)
+    
+    # return matching chunks and their rank 
+    results =  [(result, idx) for idx, result in 
+            enumerate(chroma_results(search_output, 0, return_ids))]
+    
+    return results
+
+def chromadb_embedding_search_batch(database, 
+                                    queries, 
+                                    top_k, 
+                                    where = None, 
+                                    query_embeddings = None,
+                                    return_ids = False):
+    ''' 
+    This function searches many queries with one chroma query call per where
+    filter, instead of one call per query. Query texts are embedded in one 
+    request to the embedding function.
+   
+    Input:
+    -----------
+        database: chromadb.api.models.Collection
+            vector database
+        
+        queries: list (str)
+            questions by users. Ignored if query_embeddings is given.
+
+        top_k: int
+            filter chunks among the top_k matches with each query
+
+        where: dict or list (dict)
+            chroma metadata filter of every query, or one filter (None for 
+            no filter) per query. Queries with the same filter are searched 
+            together.
+
+        query_embeddings: list (list (float)) or numpy array
+            precomputed query embeddings, e.g. of HyDE variants, so queries 
+            are not embedded again
+
+        return_ids: bool
+            return (chroma ID, text) of each chunk instead of its text, see 
+            chromadb_embedding_search
+
+    Output:
+    ----------
+        results: list (list (str, int))
+            list of (result, rank) pairs of each query, in query order
+    '''
+    if query_embeddings is not None:
+        n_queries = len(query_embeddings)
+    else:
+        n_queries = len(queries)
+
+    if n_queries == 0:
+        return []
+
+    if where is None or isinstance(where, dict):
+        where = [where] * n_queries
+
+    # group queries by filter, chroma applies one filter to a whole call
+    groups = {}
+    for i, query_where in enumerate(where):
+        key = json.dumps(query_where, sort_keys = True)
+        groups.setdefault(key, (query_where, []))[1].append(i)
+
+    results = [None] * n_queries
+
+    for query_where, positions in groups.values():
+
+        if query_embeddings is not None:
+            search_output = database.query(
+                query_embeddings = [np.asarray(query_embeddings[i], 
+                                               dtype = np.float32).tolist() 
+                                    for i in positions],
+                n_results = top_k,
+                where = query_where)
+        else:
+            search_output = database.query(
+                query_texts = [queries[i] for i in positions],
+                n_results = top_k,
+                where = query_where)
+        
+        # one list of documents per query of the call
+        for j, i in enumerate(positions):
+            results[i] = [(result, idx) for idx, result in 
+                          enumerate(chroma_results(search_output, j, return_ids))]
+
+    return results
+
+def chroma_results(search_output, query, return_ids = False):
+    """
+    @param search_output: dict, output of collection.query
+    @param query: int, position of the query in the call
+    @param return_ids: bool, return (id, text) pairs instead of text
+
+    @return results: list, text or (id, text) of each chunk, best first
+    """
+    documents = search_output['documents'][query]
+
+    if return_ids:
+        return list(zip(search_output['ids'][query], documents))
+    
+    return documents
+
+# in process dense index -----------------------------------------------------
+# Embeddings are kept in a memory mapped matrix (float32 or float16), so the 
+# index loads instantly and worker processes share the same pages read only. 
+# Search is an exact cosine similarity scan: a matrix multiply over blocks of 
+# rows, keeping the top k of each block with argpartition.
+
+class DenseIndex:
+    '''
+    This class is an exact in process vector index, an alternative to a 
+    chroma collection for chromadb_embedding_search. Rows are L2 normalised 
+    when the index is built, so inner product is cosine similarity.
+
+    Input:
+    -----------
+        vectors: numpy array or memmap
+            shape (n_chunks, dim), normalised rows in chunk ID order
+
+        block_size: int
+            rows multiplied at a time, bounds the memory of a search
+    '''
+
+    def __init__(self, vectors, block_size = 16384):
+        self.vectors = vectors
+        self.block_size = block_size
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    @classmethod
+    def build(cls, embeddings, index_dir, dtype = "float32"):
+        """
+        @param embeddings: numpy array, shape (n_chunks, dim), e.g. output of 
+                           embed_chunks
+        @param index_dir: str, path to save index folder
+        @param dtype: str, "float32" or "float16" (half the memory)
+
+        @return index: DenseIndex, memory mapped from index_dir
+        """
+        embeddings = np.asarray(embeddings, dtype = np.float32)
+        norms = np.linalg.norm(embeddings, axis = 1, keepdims = True)
+        vectors = (embeddings / np.maximum(norms, 1e-12)).astype(dtype)
+
+        os.makedirs(index_dir, exist_ok = True)
+        np.save(os.path.join(index_dir, "vectors.npy"), vectors)
+
+        return cls.load(index_dir)
+
+    @classmethod
+    def load(cls, index_dir, mmap = True):
+        """
+        @param index_dir: str, path to index folder
+        @param mmap: bool, memory map the vectors instead of reading them
+
+        @return index: DenseIndex
+        """
+        return cls(np.load(os.path.join(index_dir, "vectors.npy"), 
+                           mmap_mode = 'r' if mmap else None))
+
+    def search(self, query_vectors, top_k, mask = None):
+        ''' 
+        This function finds the top k chunks of each query by cosine 
+        similarity.
+       
+        Input:
+        -----------
+            query_vectors: numpy array
+                shape (n_queries, dim) or (dim,) for a single query
+
+            top_k: int
+                number of chunks returned per query
+
+            mask: numpy array (bool)
+                shape (n_chunks,), only chunks where mask is True are 
+                searched, see metadata_mask. None to search every chunk.
+
+        Output:
+        --------
+            chunk_ids: numpy array (int)
+                shape (n_queries, top_k), best first. Fewer columns if fewer 
+                chunks are searched.
+
+            scores: numpy array (float32)
+                cosine similarity of each chunk
+        '''
+        queries = normalize_rows(query_vectors)
+
+        def score_block(block_ids):
+            block = np.asarray(self.vectors[block_ids], dtype = np.float32)
+            return queries @ block.T
+        
+        return scan_top_k(score_block, len(self), len(queries), top_k, 
+                          mask, self.block_size)
+
+
+def normalize_rows(vectors):
+    """
+    @param vectors: numpy array, shape (n, dim) or (dim,)
+
+    @return vectors: numpy array (float32), shape (n, dim), L2 normalised rows
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype = np.float32))
+
+    return vectors / np.maximum(np.linalg.norm(vectors, axis = 1, keepdims = True), 
+                                1e-12)
+
+
+def scan_top_k(score_block, n_rows, n_queries, top_k, mask = None, block_size = 16384):
+    ''' 
+    This function scans rows in blocks and keeps the top k rows of each query 
+    with argpartition, so the full (n_queries, n_rows) score matrix is never 
+    held in memory.
+   
+    Input:
+    -----------
+        score_block: function
+            maps a block of rows (slice, or numpy array of row IDs if mask is 
+            given) to scores, shape (n_queries, rows in block), higher is 
+            better
+        
+        n_rows: int
+            number of rows (chunks)
+
+        n_queries: int
+            number of queries
+
+        top_k: int
+            number of rows kept per query
+
+        mask: numpy array (bool)
+            only rows where mask is True are scored, None for every row
+
+        block_size: int
+            rows scored at a time
+
+    Output:
+    --------
+        row_ids: numpy array (int)
+            shape (n_queries, top_k), best first. Fewer columns if fewer rows 
+            are scanned.
+
+        scores: numpy array (float32)
+            score of each row
+    '''
+    # rows to search, filtered rows are never read
+    rows = np.flatnonzero(mask) if mask is not None else None
+    if rows is not None:
+        n_rows = len(rows)
+
+    top_k = min(top_k, n_rows)
+
+    best_ids = np.zeros((n_queries, 0), dtype = np.int64)
+    best_scores = np.zeros((n_queries, 0), dtype = np.float32)
+
+    for start in range(0, n_rows, block_size):
+        end = min(start + block_size, n_rows)
+
+        # contiguous slices read the memory map sequentially
+        block_ids = np.arange(start, end) if rows is None else rows[start:end]
+        block_index = slice(start, end) if rows is None else block_ids
+
+        # (n_queries, block rows)
+        scores = np.asarray(score_block(block_index), dtype = np.float32)
+
+        # keep top k of the block together with the best so far
+        ids = np.concatenate(
+            (best_ids, np.broadcast_to(block_ids, scores.shape)), axis = 1)
+        scores = np.concatenate((best_scores, scores), axis = 1)
+
+        if scores.shape[1] > top_k:
+            keep = np.argpartition(-scores, top_k - 1, axis = 1)[:, :top_k]
+            ids = np.take_along_axis(ids, keep, axis = 1)
+            scores = np.take_along_axis(scores, keep, axis = 1)
+        
+        best_ids, best_scores = ids, scores
+
+    # sort the top k of each query
+    order = np.argsort(-best_scores, axis = 1, kind = 'stable')
+
+    return (np.take_along_axis(best_ids, order, axis = 1), 
+            np.take_along_axis(best_scores, order, axis = 1))
+
+
+# quantised dense index ------------------------------------------------------
+# text-embedding-3 vectors can be shortened (Matryoshka): the first dims 
+# dimensions, renormalised, are a usable embedding. The candidate scan runs 
+# on shortened vectors stored as int8 (4x smaller than float32 per dimension) 
+# or binary sign bits (32x smaller), then candidates are rescored exactly 
+# against the full vectors on disk. Only candidate rows of the full matrix 
+# are read.
+
+class QuantizedDenseIndex:
+    '''
+    This class is a two stage vector index: an approximate scan of quantised 
+    shortened vectors, then exact rescoring of the best candidates.
+
+    The defaults (int8, 256 dims, 10 * top_k candidates) are the operating 
+    point picked with recall_latency_report on the AGO chunks: recall@10 of 
+    0.91 at 256 of 6144 bytes per chunk and 0.6 ms per query. Use 512 dims 
+    for 0.95 recall.
+
+    Input:
+    -----------
+        codes: numpy array or memmap
+            int8 codes, shape (n_chunks, dims), or packed sign bits, shape 
+            (n_chunks, dims / 8)
+
+        scale: numpy array (float32)
+            int8 scale of each dimension, unused for binary codes
+
+        dims: int
+            number of leading dimensions kept
+
+        kind: str
+            "int8" or "binary"
+
+        full_index: DenseIndex
+            full vectors, used for rescoring
+
+        block_size: int
+            rows scanned at a time
+    '''
+
+    def __init__(self, codes, scale, dims, kind, full_index, block_size = 16384):
+        self.codes = codes
+        self.scale = scale
+        self.dims = dims
+        self.kind = kind
+        self.full_index = full_index
+        self.block_size = block_size
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    @classmethod
+    def build(cls, embeddings, index_dir, dims = 256, kind = "int8", 
+              full_dtype = "float32", full_index = None):
+        ''' 
+        This function quantises embeddings and saves them with the full 
+        vectors.
+       
+        Input:
+        -----------
+            embeddings: numpy array
+                shape (n_chunks, dim), e.g. output of embed_chunks
+
+            index_dir: str
+                Path to save index folder.
+
+            dims: int
+                number of leading dimensions kept (multiple of 8 for binary)
+
+            kind: str
+                "int8" or "binary"
+
+            full_dtype: str
+                dtype of the full vectors, see DenseIndex.build
+
+            full_index: DenseIndex
+                full vectors of embeddings already built in index_dir, so 
+                vectors.npy is not written again (e.g. while it is memory 
+                mapped). None to build it.
+
+        Output:
+        --------
+            index: QuantizedDenseIndex
+                memory mapped from index_dir
+        '''
+        if kind not in ("int8", "binary"):
+            raise ValueError(f"unknown quantisation: {kind}")
+
+        # packbits pads the last byte, the padding bits would be scored
+        if kind == "binary" and dims % 8:
+            raise ValueError(f"binary codes need dims divisible by 8, "
+                             f"got {dims}")
+
+        if full_index is None:
+            full_index = DenseIndex.build(embeddings, index_dir, full_dtype)
+
+        # shortened vectors, renormalised
+        short = normalize_rows(np.asarray(embeddings)[:, :dims])
+
+        if kind == "int8":
+            # symmetric scale per dimension
+            scale = np.maximum(np.abs(short).max(axis = 0), 1e-12) / 127
+            codes = np.round(short / scale).astype(np.int8)
+        else:
+            scale = np.ones(dims, dtype = np.float32)
+            codes = np.packbits(short > 0, axis = 1)
+        
+        np.save(os.path.join(index_dir, f"codes_{kind}_{dims}.npy"), codes)
+        np.save(os.path.join(index_dir, f"scale_{kind}_{dims}.npy"), 
+                scale.astype(np.float32))
+
+        return cls.load(index_dir, dims, kind, full_index = full_index)
+
+    @classmethod
+    def load(cls, index_dir, dims = 256, kind = "int8", mmap = True, 
+             full_index = None):
+        """
+        @param index_dir: str, path to index folder
+        @param dims: int, see build
+        @param kind: str, see build
+        @param mmap: bool, memory map the arrays instead of reading them
+        @param full_index: DenseIndex, full vectors to share, None to load 
+                           them from index_dir
+
+        @return index: QuantizedDenseIndex
+        """
+        mmap_mode = 'r' if mmap else None
+
+        if full_index is None:
+            full_index = DenseIndex.load(index_dir, mmap)
+
+        return cls(np.load(os.path.join(index_dir, f"codes_{kind}_{dims}.npy"), 
+                           mmap_mode = mmap_mode),
+                   np.load(os.path.join(index_dir, f"scale_{kind}_{dims}.npy")),
+                   dims,
+                   kind,
+                   full_index)
+
+    def candidates(self, query_vectors, n_candidates, mask = None):
+        """
+        @param query_vectors: numpy array, shape (n_queries, dim)
+        @param n_candidates: int, candidates kept per query
+        @param mask: numpy array (bool), see DenseIndex.search
+
+        @return chunk_ids: numpy array (int), shape (n_queries, n_candidates)
+        """
+        short = normalize_rows(np.atleast_2d(query_vectors)[:, :self.dims])
+
+        if self.kind == "int8":
+            # codes * scale approximates the vectors, fold scale into queries
+            scaled = short * self.scale
+
+            def score_block(block):
+                return scaled @ np.asarray(self.codes[block], dtype = np.float32).T
+        
+        else:
+            # +-1 signs, the inner product of signs is dims - 2 * hamming 
+            # distance, so one matrix multiply ranks by hamming distance
+            signs = np.where(short > 0, 1.0, -1.0).astype(np.float32)
+
+            def score_block(block):
+                bits = np.unpackbits(np.asarray(self.codes[block]), axis = 1)
+                return signs @ (2 * bits.astype(np.float32) - 1).T
+
+        chunk_ids, _ = scan_top_k(score_block, len(self), len(short), 
+                                  n_candidates, mask, self.block_size)
+        
+        return chunk_ids
+
+    def search(self, query_vectors, top_k, mask = None, n_candidates = None):
+        ''' 
+        This function finds the top k chunks of each query: candidates from 
+        the quantised scan are rescored with the full vectors.
+       
+        Input:
+        -----------
+            query_vectors: numpy array
+                shape (n_queries, dim) or (dim,) for a single query
+
+            top_k: int
+                number of chunks returned per query
+
+            mask: numpy array (bool)
+                see DenseIndex.search
+
+            n_candidates: int
+                candidates rescored per query, defaults to 10 * top_k. 
+                More candidates give better recall and slower search.
+
+        Output:
+        --------
+            chunk_ids, scores:
+                see DenseIndex.search, scores are exact cosine similarities
+        '''
+        queries = normalize_rows(query_vectors)
+
+        if n_candidates is None:
+            n_candidates = 10 * top_k
+
+        candidates = self.candidates(queries, max(n_candidates, top_k), mask)
+
+        # exact rescoring, reads only candidate rows of the full vectors
+        rows, inverse = np.unique(candidates, return_inverse = True)
+        full = np.asarray(self.full_index.vectors[rows], dtype = np.float32)
+
+        scores = np.einsum('qd,qcd->qc', 
+                           queries, 
+                           full[inverse.reshape(candidates.shape)])
+        
+        top_k = min(top_k, candidates.shape[1])
+        order = np.argsort(-scores, axis = 1, kind = 'stable')[:, :top_k]
+
+        return (np.take_along_axis(candidates, order, axis = 1), 
+                np.take_along_axis(scores, order, axis = 1))
+
+
+def recall_latency_report(embeddings, 
+                          query_vectors, 
+                          index_dir, 
+                          top_k = 10,
+                          dims_list = (256, 512, 1536),
+                          kinds = ("int8", "binary"),
+                          candidate_factors = (1, 4, 10, 30)):
+    ''' 
+    This function measures recall and latency of quantised indexes against 
+    exact search, to pick an operating point. Use real query embeddings 
+    (e.g. embedded evaluation questions) and the corpus embeddings.
+   
+    Input:
+    -----------
+        embeddings: numpy array
+            corpus embeddings, shape (n_chunks, dim)
+
+        query_vectors: numpy array
+            query embeddings, shape (n_queries, dim)
+
+        index_dir: str
+            folder to build the indexes in
+
+        top_k: int
+            recall is measured at top_k
+
+        dims_list: list (int)
+            shortened dimensions to try (larger than dim are skipped)
+
+        kinds: list (str)
+            quantisations to try
+
+        candidate_factors: list (int)
+            n_candidates = factor * top_k to try
+
+    Output:
+    --------
+        report: list (dict)
+            one row per setting: kind, dims, n_candidates, recall, 
+            ms_per_query, bytes_per_chunk (of the scanned codes)
+    '''
+    # exact top k is the reference. The full vectors are written once, every 
+    # quantised index rescores with this memory mapped copy
+    exact_index = DenseIndex.build(embeddings, index_dir)
+    
+    start = time.perf_counter()
+    exact_ids, _ = exact_index.search(query_vectors, top_k)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+
+    report = [{"kind": "float32", 
+               "dims": embeddings.shape[1], 
+               "n_candidates": top_k,
+               "recall": 1.0, 
+               "ms_per_query": exact_ms,
+               "bytes_per_chunk": 4 * embeddings.shape[1]}]
+
+    for kind in kinds:
+        for dims in dims_list:
+            if dims > embeddings.shape[1]:
+                continue
+
+            index = QuantizedDenseIndex.build(embeddings, 
+                                              index_dir, 
+                                              dims, 
+                                              kind, 
+                                              full_index = exact_index)
+
+            for factor in candidate_factors:
+                start = time.perf_counter()
+                ids, _ = index.search(query_vectors, top_k, 
+                                      n_candidates = factor * top_k)
+                ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+
+                recall = np.mean([len(set(found) & set(expected)) / top_k 
+                                  for found, expected in zip(ids.tolist(), 
+                                                             exact_ids.tolist())])
+                
+                report.append({"kind": kind, 
+                               "dims": dims, 
+                               "n_candidates": factor * top_k,
+                               "recall": float(recall), 
+                               "ms_per_query": ms,
+                               "bytes_per_chunk": index.codes.shape[1] 
+                                                  * index.codes.itemsize})
+
+    # print table
+    print(f"{'kind':>8} {'dims':>5} {'cands':>6} {'recall':>7} "
+          f"{'ms/query':>9} {'bytes':>6}")
+    for row in report:
+        print(f"{row['kind']:>8} {row['dims']:>5} {row['n_candidates']:>6} "
+              f"{row['recall']:>7.3f} {row['ms_per_query']:>9.2f} "
+              f"{row['bytes_per_chunk']:>6}")
+    
+    return report
+
+
+def metadata_mask(metadata_store, years = None, sections = None):
+    """
+    @param metadata_store: metadata_store.MetadataStore
+    @param years: list (str), keep chunks of these years, None for all
+    @param sections: list (str), keep chunks whose location text starts with 
+                     one of these headings, None for all
+
+    @return mask: numpy array (bool), one value per chunk
+    """
+    mask = np.ones(len(metadata_store), dtype = bool)
+
+    if years is not None:
+        year_ids = [i for i, year in enumerate(metadata_store.years) 
+                    if year in set(years)]
+        mask &= np.isin(metadata_store.year_ids, year_ids)
+    
+    if sections is not None:
+        section_ids = [i for i, text in enumerate(metadata_store.sections.texts)
+                       if text.startswith(tuple(sections))]
+        mask &= np.isin(metadata_store.section_ids, section_ids)
+    
+    return mask
+
+
+def dense_index_search(dense_index, 
+                       chunks, 
+                       query, 
+                       top_k, 
+                       embedding_function, 
+                       mask = None):
+    ''' 
+    This function searches a DenseIndex for a query. It returns the same 
+    output as chromadb_embedding_search.
+   
+    Input:
+    -----------
+        dense_index: DenseIndex
+            index of chunk embeddings
+        
+        chunks: list (str)
+            each element is text (str) of a chunk, in chunk ID order
+
+        query: str or list (str)
+            question by user, or a batch of questions
+
+        top_k: int
+            filter chunks among the top_k matches with query
+        
+        embedding_function:
+            embeds the query, must be the model the index was built with, 
+            e.g. embedding_cache.CachedEmbeddingFunction
+
+        mask: numpy array (bool)
+            see DenseIndex.search
+
+    Output:
+    ----------
+        results: list (str, int)
+            list of (result, rank) pairs. One list per query if query is a 
+            list.
+    '''
+    queries = [query] if isinstance(query, str) else list(query)
+
+    chunk_ids, _ = dense_index.search(embedding_function(queries), top_k, mask)
+
+    results = [[(chunks[chunk_id], rank) for rank, chunk_id in enumerate(row)]
+               for row in chunk_ids.tolist()]
+    
+    return results[0] if isinstance(query, str) else results
+
+
+# sparce embedding search ====================================================
+
+# elasticsearch --------------------------------------------------------------
+
+# Function to delete all indices
+def elastic_reset(client, http_auth):
+    try:
+        # Get a list of all indices
+        indices = client.indices.get('*', http_auth=http_auth)
+
+        # Loop through the indices and delete each one
+        for index in indices:
+            client.indices.delete(index=index, http_auth=http_auth)
+            print(f"reset index: {index}")
+    except Exception as e:
+        print(f"An error occurred when resetting elasticsearch: {e}")
+
+
+
+def index_elastic_db(elastic_db, index_name, http_auth, chunks, reset, ids = None):
+    ''' 
+    This function indexes the data so text search can be sped up drastically.
+    This only needs to be done when the database is set up. 
+   
+    Input:
+    -----------
+        elastic_db: chromadb.api.models.Collection
+            vector database
+        
+        index_name: str
+            elasticsearch can store multiple indexes so index_name is required.
+
+        http_auth: int
+            the container in use requires a username and password which is set 
+            upon creation.
+        
+        chunks: list (str)
+            each element is text (str) of a chunk
+
+        reset: boolean
+            resets elastic db indices
+
+        ids: list (str)
+            id of each chunk, see metadata_store.make_chunk_ids. Indexing 
+            again under the same IDs overwrites documents instead of 
+            duplicating them. Defaults to the position of the chunk.
+
+
+    Output:
+    ----------
+        None
+            data base passed in by reference and indexed in function
+        
+    '''
+    # create indexing for sparce search
+    if not elastic_db.indices.exists(index=index_name, http_auth=http_auth):
+        elastic_db.indices.create(index=index_name, http_auth=http_auth)
+
+    if reset:
+        elastic_reset(elastic_db, http_auth=http_auth)
+
+    if ids is None:
+        ids = range(len(chunks))
+
+    # Index documents
+    for chunk_id, chunk in zip(ids, chunks):
+        elastic_db.index(index=index_name, 
+                    id=chunk_id, 
+                    body={'text': chunk}, 
+                    http_auth=http_auth)
+
+
+def elastic_sync_index(elastic_db, index_name, http_auth, chunks, ids, metadata = None):
+    ''' 
+    This function makes an index match a refreshed corpus by comparing stable 
+    chunk IDs. Only new chunks are indexed and only removed chunks are 
+    deleted. A chunk ID includes the hash of its text, so edited chunks are 
+    a delete plus an add.
+   
+    Input:
+    -----------
+        elastic_db: elasticsearch.Elasticsearch
+            client, created with the credentials (e.g. basic_auth=HTTP_AUTH).
+            The stored IDs are read with a scroll, whose follow up requests 
+            do not take per request credentials.
+        
+        index_name: str
+            elasticsearch can store multiple indexes so index_name is required.
+
+        http_auth: int
+            the container in use requires a username and password which is set 
+            upon creation.
+        
+        chunks: list (str)
+            each element is text (str) of a chunk
+
+        ids: list (str)
+            id of each chunk, see metadata_store.make_chunk_ids
+
+        metadata: list (dict)
+            see elastic_documents
+
+    Output:
+    ----------
+        counts: dict
+            number of chunks "added", "deleted" and "unchanged"
+    '''
+    from elasticsearch import helpers
+
+    elastic_create_index(elastic_db, index_name, http_auth)
+
+    # IDs already in the index (no document bodies are fetched). 
+    # helpers.scan only passes extra arguments to the first search, so the 
+    # client's own credentials are used for every scroll request
+    stored = {hit["_id"] for hit in helpers.scan(elastic_db, 
+                                                 index = index_name,
+                                                 query = {"_source": False})}
+    current = set(ids)
+
+    actions = [{"_op_type": "delete", "_index": index_name, "_id": chunk_id}
+               for chunk_id in stored if chunk_id not in current]
+    n_deleted = len(actions)
+
+    actions += [action 
+                for action in elastic_documents(index_name, chunks, ids, metadata)
+                if action["_id"] not in stored]
+    
+    helpers.bulk(elastic_db, actions, http_auth = http_auth)
+
+    counts = {"added": len(actions) - n_deleted, 
+              "deleted": n_deleted, 
+              "unchanged": len(current & stored)}
+    print(f"elasticsearch sync: {counts}")
+
+    return counts
+
+        
+# bulk indexing --------------------------------------------------------------
+# Chunks are sent to elasticsearch in _bulk requests from a pool of threads 
+# (helpers.parallel_bulk) instead of one request per chunk. The index is 
+# created with an explicit mapping: chunk text is analysed like 
+# text_analyzer.TextAnalyzer (lowercase, english stopwords, snowball stemmer), 
+# year, section and page are keyword fields so they can be used in filters.
+
+ELASTIC_MAPPING = {
+    "settings": {
+        "analysis": {
+            "filter": {
+                "english_stop": {"type": "stop", "stopwords": "_english_"},
+                "english_stemmer": {"type": "snowball", "language": "English"}
+            },
+            "analyzer": {
+                "chunk_text": {
+                    "type": "custom",
+                    "tokenizer": "standard",
+                    "filter": ["lowercase", "english_stop", "english_stemmer"]
+                }
+            }
+        }
+    },
+    "mappings": {
+        "properties": {
+            "text": {"type": "text", "analyzer": "chunk_text"},
+            "year": {"type": "keyword"},
+            "section": {"type": "keyword"},
+            "page": {"type": "keyword"}
+        }
+    }
+}
+
+
+def elastic_create_index(elastic_db, index_name, http_auth, mapping = ELASTIC_MAPPING):
+    ''' 
+    This function creates an index with an explicit mapping, if it does not 
+    exist yet.
+   
+    Input:
+    -----------
+        elastic_db: elasticsearch.Elasticsearch
+            client
+        
+        index_name: str
+            elasticsearch can store multiple indexes so index_name is required.
+
+        http_auth: int
+            the container in use requires a username and password which is set 
+            upon creation.
+
+        mapping: dict
+            index settings and mappings, defaults to ELASTIC_MAPPING
+
+    Output:
+    ----------
+        created: bool
+            False if the index already existed
+    '''
+    if elastic_db.indices.exists(index=index_name, http_auth=http_auth):
+        return False
+    
+    elastic_db.indices.create(index=index_name, body=mapping, http_auth=http_auth)
+
+    return True
+
+
+def elastic_documents(index_name, chunks, ids, metadata = None):
+    ''' 
+    This function makes the bulk index action of every chunk.
+   
+    Input:
+    -----------
+        index_name: str
+            index the chunks are added to
+        
+        chunks: list (str)
+            each element is text (str) of a chunk
+
+        ids: list (str)
+            id of each chunk
+
+        metadata: list (dict)
+            metadata of each chunk (inverted tree values or chroma metadata),
+            stored in the year, section and page fields. None to index text 
+            only.
+
+    Output:
+    ----------
+        actions: generator (dict)
+            one index action per chunk
+    '''
+    for i, (chunk_id, chunk) in enumerate(zip(ids, chunks)):
+
+        source = {"text": chunk}
+
+        if metadata is not None:
+            data = metadata[i]
+            source["year"] = data["year"]
+
+            # location is a list of headings in the inverted tree
+            location = data.get("location", -1)
+            if location != -1:
+                source["section"] = (location if isinstance(location, str) 
+                                     else ', '.join(location))
+            
+            page = data.get("page", -1)
+            if page != -1:
+                source["page"] = str(page)
+
+        yield {"_op_type": "index", 
+               "_index": index_name, 
+               "_id": chunk_id, 
+               "_source": source}
+
+
+def elastic_bulk_index(elastic_db, 
+                       index_name, 
+                       http_auth, 
+                       chunks, 
+                       ids = None,
+                       metadata = None,
+                       reset = False,
+                       chunk_size = 500,
+                       thread_count = 4,
+                       mapping = ELASTIC_MAPPING):
+    ''' 
+    This function indexes the chunks with bulk requests sent from a pool of 
+    threads. Refreshing the index is turned off while loading and restored 
+    afterwards, so segments are not rebuilt after every request.
+   
+    Input:
+    -----------
+        elastic_db: elasticsearch.Elasticsearch
+            client
+        
+        index_name: str
+            elasticsearch can store multiple indexes so index_name is required.
+
+        http_auth: int
+            the container in use requires a username and password which is set 
+            upon creation.
+        
+        chunks: list (str)
+            each element is text (str) of a chunk
+
+        ids: list (str)
+            id of each chunk. Defaults to metadata_store.make_chunk_ids if 
+            metadata is given, otherwise the position of the chunk.
+
+        metadata: list (dict)
+            see elastic_documents
+
+        reset: bool
+            delete and recreate this index (other indices are kept)
+
+        chunk_size: int
+            number of chunks in a bulk request
+
+        thread_count: int
+            number of concurrent bulk requests
+        
+        mapping: dict
+            see elastic_create_index
+
+    Output:
+    ----------
+        n_indexed: int
+            number of chunks indexed
+    '''
+    from elasticsearch import helpers
+
+    # timed to report throughput (docs/sec)
+    start = time.time()
+
+    if ids is None:
+        ids = (make_chunk_ids(chunks, metadata) if metadata is not None 
+               else list(range(len(chunks))))
+
+    if reset and elastic_db.indices.exists(index=index_name, http_auth=http_auth):
+        elastic_db.indices.delete(index=index_name, http_auth=http_auth)
+
+    elastic_create_index(elastic_db, index_name, http_auth, mapping)
+
+    # remember refresh interval (None is the elasticsearch default)
+    settings = elastic_db.indices.get_settings(index=index_name, 
+                                               name="index.refresh_interval",
+                                               http_auth=http_auth)
+    refresh_interval = (settings.get(index_name, {}).get("settings", {})
+                        .get("index", {}).get("refresh_interval"))
+
+    elastic_db.indices.put_settings(index=index_name, 
+                                    body={"index": {"refresh_interval": "-1"}},
+                                    http_auth=http_auth)
+    
+    n_indexed, errors = 0, []
+
+    try:
+        actions = elastic_documents(index_name, chunks, ids, metadata)
+
+        # results are yielded lazily, so they have to be consumed
+        for ok, info in helpers.parallel_bulk(elastic_db, 
+                                              actions, 
+                                              thread_count = thread_count,
+                                              chunk_size = chunk_size,
+                                              raise_on_error = False,
+                                              http_auth = http_auth):
+            if ok:
+                n_indexed += 1
+            else:
+                errors.append(info)
+    
+    finally:
+        # restore refresh interval and make the chunks searchable
+        elastic_db.indices.put_settings(
+            index=index_name, 
+            body={"index": {"refresh_interval": refresh_interval}},
+            http_auth=http_auth)
+        
+        elastic_db.indices.refresh(index=index_name, http_auth=http_auth)
+
+    # report throughput
+    end = time.time()
+    print(f"indexed {n_indexed} chunks in {end - start:.2f} seconds "
+          f"({n_indexed / max(end - start, 1e-9):.1f} docs/sec), "
+          f"{len(errors)} errors")
+    
+    if errors:
+        print(f"first error: {errors[0]}")
+
+    return n_indexed
+
+        
+# blue/green rebuilds --------------------------------------------------------
+# Same flow as chroma_rebuild_collection. Searches go through an alias, which
+# is moved to the new index in a single update_aliases request.
+
+def elastic_alias_indices(elastic_db, alias, http_auth):
+    """
+    @param elastic_db: elasticsearch.Elasticsearch
+    @param alias: str
+    @param http_auth: tuple, username and password
+
+    @return indices: list (str), indices behind the alias
+    """
+    if not elastic_db.indices.exists_alias(name=alias, http_auth=http_auth):
+        return []
+    
+    return list(elastic_db.indices.get_alias(name=alias, http_auth=http_auth))
+
+
+def elastic_switch_alias(elastic_db, alias, index_name, http_auth):
+    ''' 
+    This function points an alias at an index in one atomic request. Searches
+    see either the old or the new index, never neither.
+
+    A plain index called alias (made before aliases were used) is deleted in 
+    the same request, so the alias can take its name.
+   
+    Input:
+    -----------
+        elastic_db: elasticsearch.Elasticsearch
+            client
+        
+        alias: str
+            name searches use, e.g. index_name in chatbot_utils
+
+        index_name: str
+            index the alias is moved to
+
+        http_auth: int
+            the container in use requires a username and password which is set 
+            upon creation.
+
+    Output:
+    ----------
+        None
+    '''
+    old_indices = elastic_alias_indices(elastic_db, alias, http_auth)
+
+    actions = [{"remove": {"index": old_index, "alias": alias}} 
+               for old_index in old_indices if old_index != index_name]
+    
+    if not old_indices and elastic_db.indices.exists(index=alias, http_auth=http_auth):
+        actions.append({"remove_index": {"index": alias}})
+    
+    actions.append({"add": {"index": index_name, "alias": alias}})
+
+    elastic_db.indices.update_aliases(body={"actions": actions}, 
+                                      http_auth=http_auth)
+
+
+def elastic_rebuild_index(elastic_db, 
+                          alias, 
+                          http_auth, 
+                          chunks, 
+                          ids = None, 
+                          metadata = None, 
+                          keep = 1,
+                          **bulk_kwargs):
+    ''' 
+    This function rebuilds the index behind an alias without downtime:
+        1. chunks are bulk indexed into a new index (alias__<timestamp>)
+        2. the number of documents in it is validated
+        3. the alias is switched to it atomically
+        4. old generations are deleted, except the newest keep of them
+
+    Unlike elastic_reset, no other index on the cluster is touched. If 
+    validation fails the new index is deleted and the alias is not changed.
+   
+    Input:
+    -----------
+        elastic_db: elasticsearch.Elasticsearch
+            client
+        
+        alias: str
+            name searches use, e.g. index_name in chatbot_utils
+
+        http_auth: int
+            the container in use requires a username and password which is set 
+            upon creation.
+        
+        chunks, ids, metadata:
+            see elastic_bulk_index
+
+        keep: int
+            number of previous generations kept for rollback
+
+        bulk_kwargs:
+            passed to elastic_bulk_index (chunk_size, thread_count, mapping)
+
+    Output:
+    ----------
+        index_name: str
+            new index behind the alias
+    '''
+    if ids is None:
+        ids = (make_chunk_ids(chunks, metadata) if metadata is not None 
+               else list(range(len(chunks))))
+
+    # 1. load new generation
+    index_name = generation_name(alias)
+
+    try:
+        elastic_bulk_index(elastic_db, index_name, http_auth, chunks, 
+                           ids, metadata, reset = False, **bulk_kwargs)
+
+        # 2. validate
+        expected = len(set(ids))
+        count = elastic_db.count(index=index_name, http_auth=http_auth)["count"]
+
+        if count != expected:
+            raise ValueError(f"index {index_name} has {count} documents, "
+                             f"expected {expected}")
+    
+    except Exception:
+        if elastic_db.indices.exists(index=index_name, http_auth=http_auth):
+            elastic_db.indices.delete(index=index_name, http_auth=http_auth)
+        raise
+
+    # 3. switch
+    elastic_switch_alias(elastic_db, alias, index_name, http_auth)
+    print(f"switched {alias} to {index_name} ({count} documents)")
+
+    # 4. garbage collect old generations
+    elastic_collect_garbage(elastic_db, alias, http_auth, keep)
+
+    return index_name
+
+
+def elastic_collect_garbage(elastic_db, alias, http_auth, keep = 1):
+    """
+    @param elastic_db: elasticsearch.Elasticsearch
+    @param alias: str
+    @param http_auth: tuple, username and password
+    @param keep: int, number of previous generations kept for rollback
+
+    @return deleted: list (str), deleted indices
+    """
+    live = set(elastic_alias_indices(elastic_db, alias, http_auth))
+
+    generations = sorted(
+        index for index in elastic_db.indices.get(index=f"{alias}__*", 
+                                                  http_auth=http_auth)
+        if index not in live)
+    
+    deleted = generations[:max(len(generations) - keep, 0)]
+
+    for index in deleted:
+        elastic_db.indices.delete(index=index, http_auth=http_auth)
+        print(f"deleted old generation {index}")
+    
+    return deleted
+
+
+def bm25_elasticsearch(elastic_db, 
+                       index_name, 
+                       http_auth, 
+                       query, 
+                       top_k, 
+                       filters = None, 
+                       return_ids = False):
+    ''' 
+    This function searches the database for a query that matches the text 
+    using BM25.
+   
+    Input:
+    -----------
+        elastic_db: chromadb.api.models.Collection
+            vector database
+        
+        index_name: str
+            elasticsearch can store multiple indexes so index_name is required.
+
+        http_auth: int
+            the container in use requires a username and password which is set 
+            upon creation.
+        
+        query: str
+            question by user
+
+        top_k: int
+            filter chunks among the top_k matches with query
+
+        filters: list (dict)
+            bool.filter clauses, e.g. query_constraints.elastic_filters. They 
+            restrict the chunks searched without changing BM25 scores. The 
+            index needs the keyword fields of ELASTIC_MAPPING.
+
+        return_ids: bool
+            return (_id, text) of each chunk instead of its text, so 
+            metadata is looked up by ID (metadata_store.make_chunk_id). The 
+            text resolves IDs of indices built with other IDs.
+
+    Output:
+    ----------
+        results: list (str, int)
+            list of (result, rank) pairs
+        
+    '''
+    # set up a http request to the database sitting in a docker container
+    response = elastic_db.search(index=index_name, 
+                                 body=elastic_match_body(query, top_k, filters), 
+                                 http_auth=http_auth)
+
+    # return search results
+    results = [
+        (elastic_hit_result(hit, return_ids), idx) 
+        for idx, hit in 
+        enumerate(response['hits']['hits'])
+        ]
+    
+    return results
+
+
+def elastic_hit_result(hit, return_ids = False):
+    """
+    @param hit: dict, one hit of a search response
+    @param return_ids: bool, return (_id, text) of the hit instead of its text
+
+    @return result: str or tuple (str, str), text or (_id, text) of the chunk
+    """
+    if return_ids:
+        return hit['_id'], hit['_source']['text']
+    
+    return hit['_source']['text']
+
+
+def elastic_match_body(query, top_k, filters = None):
+    """
+    @param query: str, question by user
+    @param top_k: int, number of hits
+    @param filters: list (dict), bool.filter clauses, see bm25_elasticsearch
+
+    @return body: dict, search request body of a BM25 match on the text field
+    """
+    match = {'match': {'text': query}}
+
+    # filter clauses do not score, they only remove chunks
+    if filters:
+        match = {'bool': {'must': match, 'filter': filters}}
+
+    return {'query': match, 'size': top_k}
+
+
+def bm25_elasticsearch_batch(elastic_db, 
+                             index_name, 
+                             http_auth, 
+                             queries, 
+                             top_k, 
+                             filters = None,
+                             max_concurrent_searches = None,
+                             return_ids = False):
+    ''' 
+    This function searches many queries in one _msearch request, instead of 
+    one _search round trip per query.
+   
+    Input:
+    -----------
+        elastic_db: elasticsearch.Elasticsearch
+            client
+        
+        index_name: str
+            elasticsearch can store multiple indexes so index_name is required.
+
+        http_auth: tuple
+            the container in use requires a username and password which is set 
+            upon creation.
+        
+        queries: list (str)
+            questions by users
+
+        top_k: int
+            filter chunks among the top_k matches with each query
+
+        filters: list (list (dict))
+            bool.filter clauses of each query (None or empty for no filter), 
+            see bm25_elasticsearch. None to filter no query.
+
+        max_concurrent_searches: int
+            number of searches elasticsearch runs at the same time, None for 
+            the elasticsearch default
+
+        return_ids: bool
+            return (_id, text) of each chunk instead of its text, see 
+            bm25_elasticsearch
+
+    Output:
+    ----------
+        results: list (list (str, int))
+            list of (result, rank) pairs of each query, in query order. A 
+            query that failed has no results.
+    '''
+    if len(queries) == 0:
+        return []
+
+    if filters is None:
+        filters = [None] * len(queries)
+
+    # one header line and one body line per query
+    searches = []
+    for query, query_filters in zip(queries, filters):
+        searches.append({'index': index_name})
+        searches.append(elastic_match_body(query, top_k, query_filters))
+
+    params = {}
+    if max_concurrent_searches is not None:
+        params['max_concurrent_searches'] = max_concurrent_searches
+
+    response = elastic_db.msearch(body=searches, http_auth=http_auth, **params)
+
+    results = []
+    for query, item in zip(queries, response['responses']):
+
+        # errors are reported per query, the other queries still have hits
+        if 'error' in item:
+            print(f"search failed for {query!r}: {item['error']}")
+            results.append([])
+            continue
+
+        results.append([(elastic_hit_result(hit, return_ids), idx) 
+                        for idx, hit in enumerate(item['hits']['hits'])])
+    
+    return results
+
+
+def elastic_has_fields(elastic_db, index_name, http_auth, fields):
+    """
+    @param elastic_db: elasticsearch.Elasticsearch
+    @param index_name: str, index or alias
+    @param http_auth: tuple, username and password
+    @param fields: list (str), e.g. ["year", "section"]
+
+    @return has_fields: bool, True if every field is mapped in the index, 
+                        i.e. the index can be filtered on them
+    """
+    try:
+        mappings = elastic_db.indices.get_mapping(index=index_name, 
+                                                  http_auth=http_auth)
+    except Exception:
+        return False
+    
+    return all(all(field in mapping["mappings"].get("properties", {}) 
+                   for field in fields)
+               for mapping in mappings.values())
+
+
+# python manual bm25 search --------------------------------------------------
+def bm25_search(BM25_db, chunks, query, top_k, analyzer = None):
+    ''' 
+    This function searches for a query that matches the text using BM25. It 
+    does not use a persistent database but instead a program memory. 
+
+    The chunks (dataset) has to be passed in everytime the search is done. 
+    This is not recommended for large datasets and production. It can be used
+    for testing simple RAG frameworks.
+   
+    Input:
+    -----------
+        BM25_db: rank_bm25.BM25Okapi or BM25Index
+            vector database. A BM25Index only scores chunks that contain a 
+            query term, see bm25_index_search.
+
+        chunks: list (str)
+            each element is text (str) of a chunk
+        
+        query: str
+            question by user
+
+        top_k: int
+            filter chunks among the top_k matches with query
+
+        analyzer: text_analyzer.TextAnalyzer
+            tokenizes the query for a rank_bm25.BM25Okapi. It must be built 
+            from chunks tokenized the same way, e.g. 
+            BM25Okapi([analyzer.analyze(chunk) for chunk in chunks]).
+            Defaults to splitting on whitespace.
+
+    Output:
+    ----------
+        results: list (str, int)
+            list of (result, rank) pairs
+        
+    '''
+    if isinstance(BM25_db, BM25Index):
+        return bm25_index_search(BM25_db, chunks, query, top_k)
+
+    # tokenizing splits the query into words as BM25 uses Bag-of-words
+    if analyzer is not None:
+        tokenized_query = analyzer.analyze(query)
+    else:
+        tokenized_query = query.split()
+
+    # Get BM25 scores
+    bm25_scores = BM25_db.get_scores(tokenized_query)
+
+    # Sort chunks based on BM25 scores
+    top_n_indices = np.argsort(bm25_scores)[-top_k:][::-1]
+
+    # return results
+    return [(chunks[idx], idx) for idx in top_n_indices]
+
+
+# in process bm25 index ------------------------------------------------------
+# Postings are stored as CSR arrays, one row per term holding the IDs of the 
+# chunks that contain it and their precomputed BM25 weights. A query only 
+# reads the rows of its own terms, so only chunks sharing a term with the 
+# query are scored. Arrays are saved as .npy files and memory mapped on load.
+
+BM25_ARRAYS = ["tf_indptr", "tf_indices", "tf_data", 
+               "indptr", "indices", "weights", "doc_lengths"]
+
+class BM25Index:
+    '''
+    This class is a BM25 index of chunks, searched without elasticsearch.
+    Scores use the same BM25 formula as elasticsearch (Lucene idf).
+
+    Input:
+    -----------
+        k1: float
+            term frequency saturation
+
+        b: float
+            document length normalisation
+
+        analyzer: text_analyzer.TextAnalyzer
+            analyzes chunks and queries, and holds the term IDs. Defaults to 
+            TextAnalyzer().
+    '''
+
+    def __init__(self, k1 = 1.5, b = 0.75, analyzer = None):
+        self.k1 = k1
+        self.b = b
+        self.analyzer = analyzer if analyzer is not None else TextAnalyzer()
+
+        # chunk major term frequencies (chunk ID x term ID), kept so chunks 
+        # can be added later
+        self.tf = sparse.csr_matrix((0, 0), dtype = np.float32)
+
+        # term major postings, row t lists (chunk ID, weight) of term t:
+        # indices[indptr[t] : indptr[t + 1]], weights[indptr[t] : indptr[t + 1]]
+        self.indptr = np.zeros(1, dtype = np.int64)
+        self.indices = np.zeros(0, dtype = np.int32)
+        self.weights = np.zeros(0, dtype = np.float32)
+        self.doc_lengths = np.zeros(0, dtype = np.float32)
+
+        # term frequencies of added chunks, merged into tf and the postings 
+        # at the next search or save
+        self.pending = []
+
+    def __len__(self):
+        return self.tf.shape[0] + sum(tf.shape[0] for tf in self.pending)
+
+    def add(self, chunks):
+        ''' 
+        This function adds chunks to the index. Chunk IDs continue from the 
+        chunks already in the index. The chunks are only analyzed here, idf 
+        and the postings are rebuilt once at the next search or save, so 
+        chunks can be added in many small calls.
+       
+        Input:
+        -----------
+            chunks: list (str)
+                each element is text (str) of a chunk
+
+        Output:
+        --------
+            None
+        '''
+        # term IDs of every chunk, analyzed in one batch
+        term_ids, offsets = self.analyzer.analyze_batch(chunks)
+        rows = np.repeat(np.arange(len(chunks)), np.diff(offsets))
+        
+        n_terms = len(self.analyzer.vocabulary)
+
+        # repeated (chunk, term) entries are summed into term frequencies
+        new_tf = sparse.csr_matrix(
+            (np.ones(len(term_ids), dtype = np.float32), (rows, term_ids)),
+            shape = (len(chunks), n_terms))
+        new_tf.sum_duplicates()
+
+        self.pending.append(new_tf)
+
+    def merge_pending(self):
+        """
+        @return None, stacks the added chunks under tf and rebuilds the 
+                postings, does nothing if no chunks were added
+        """
+        if not self.pending:
+            return
+        
+        n_terms = len(self.analyzer.vocabulary)
+
+        # widen every block to the current vocabulary
+        blocks = [sparse.csr_matrix((tf.data, tf.indices, tf.indptr),
+                                    shape = (tf.shape[0], n_terms))
+                  for tf in [self.tf] + self.pending]
+        
+        self.tf = sparse.vstack(blocks, format = 'csr')
+        self.pending = []
+        self.build()
+
+    def build(self):
+        """
+        @return None, recomputes idf and the term major postings from self.tf
+        """
+        n_docs, n_terms = self.tf.shape
+
+        self.doc_lengths = np.asarray(self.tf.sum(axis = 1), 
+                                      dtype = np.float32).ravel()
+        avg_length = self.doc_lengths.mean() if n_docs else 1.0
+
+        # lucene idf, always positive
+        df = np.bincount(self.tf.indices, minlength = n_terms)
+        idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+
+        postings = self.tf.T.tocsr()
+        postings.sort_indices()
+
+        tf = postings.data
+        terms = np.repeat(np.arange(n_terms), np.diff(postings.indptr))
+        norm = self.k1 * (1 - self.b 
+                          + self.b * self.doc_lengths[postings.indices] / avg_length)
+
+        self.indptr = postings.indptr.astype(np.int64)
+        self.indices = postings.indices.astype(np.int32)
+        self.weights = (idf[terms] * tf * (self.k1 + 1) / (tf + norm)).astype(np.float32)
+
+    def search(self, query, top_k):
+        ''' 
+        This function scores the chunks containing at least one query term.
+       
+        Input:
+        -----------
+            query: str
+                question by user
+
+            top_k: int
+                number of chunks returned
+
+        Output:
+        --------
+            chunk_ids: numpy array (int)
+                best chunks, highest score first
+
+            scores: numpy array (float)
+                BM25 score of each chunk
+        '''
+        self.merge_pending()
+
+        term_ids, term_counts = np.unique(self.analyzer.term_ids(query), 
+                                          return_counts = True)
+        
+        if len(term_ids) == 0:
+            return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.float32)
+
+        # read only the posting rows of the query terms
+        docs = [self.indices[self.indptr[t] : self.indptr[t + 1]] for t in term_ids]
+        weights = [self.weights[self.indptr[t] : self.indptr[t + 1]] * count 
+                   for t, count in zip(term_ids, term_counts)]
+        
+        # sum the weights of each matched chunk
+        chunk_ids, inverse = np.unique(np.concatenate(docs), return_inverse = True)
+        scores = np.bincount(inverse, weights = np.concatenate(weights))
+
+        # top k without sorting every match
+        if len(scores) > top_k:
+            best = np.argpartition(-scores, top_k)[:top_k]
+        else:
+            best = np.arange(len(scores))
+        
+        best = best[np.argsort(-scores[best], kind = 'stable')]
+
+        return chunk_ids[best], scores[best]
+
+    def search_batch(self, queries, top_k):
+        ''' 
+        This function scores many queries at once. Query term counts form a 
+        sparse (query x term) matrix, which is multiplied by the postings 
+        (term x chunk) in a single sparse matrix product.
+       
+        Input:
+        -----------
+            queries: list (str)
+                questions by users
+
+            top_k: int
+                number of chunks returned per query
+
+        Output:
+        --------
+            results: list (numpy array (int), numpy array (float))
+                (chunk_ids, scores) of each query, same as search
+        '''
+        self.merge_pending()
+
+        n_terms = len(self.indptr) - 1
+        n_chunks = len(self.doc_lengths)
+
+        # query term counts, terms not in the index are dropped
+        term_ids = [self.analyzer.term_ids(query) for query in queries]
+        rows = np.repeat(np.arange(len(queries)), [len(ids) for ids in term_ids])
+        
+        query_terms = sparse.csr_matrix(
+            (np.ones(len(rows), dtype = np.float64), 
+             (rows, np.concatenate(term_ids + [np.zeros(0, dtype = np.int64)]))),
+            shape = (len(queries), n_terms))
+        query_terms.sum_duplicates()
+
+        postings = sparse.csr_matrix((self.weights, self.indices, self.indptr),
+                                     shape = (n_terms, n_chunks))
+
+        # row q holds the score of every chunk matching query q
+        scores = (query_terms @ postings).tocsr()
+        scores.sort_indices()
+
+        results = []
+        for q in range(len(queries)):
+            chunk_ids = scores.indices[scores.indptr[q] : scores.indptr[q + 1]]
+            row = scores.data[scores.indptr[q] : scores.indptr[q + 1]]
+
+            # top k without sorting every match
+            if len(row) > top_k:
+                best = np.argpartition(-row, top_k)[:top_k]
+            else:
+                best = np.arange(len(row))
+            
+            best = best[np.argsort(-row[best], kind = 'stable')]
+
+            results.append((chunk_ids[best].astype(np.int64), row[best]))
+
+        return results
+
+    def save(self, index_dir):
+        ''' 
+        This function saves the index as .npy arrays and a JSON file.
+       
+        Input:
+        -----------
+            index_dir: str
+                Path to save index folder.
+
+        Output:
+        --------
+            None
+        '''
+        self.merge_pending()
+
+        os.makedirs(index_dir, exist_ok = True)
+
+        arrays = {"tf_indptr": self.tf.indptr, 
+                  "tf_indices": self.tf.indices, 
+                  "tf_data": self.tf.data, 
+                  "indptr": self.indptr, 
+                  "indices": self.indices, 
+                  "weights": self.weights, 
+                  "doc_lengths": self.doc_lengths}
+        
+        for name in BM25_ARRAYS:
+            np.save(os.path.join(index_dir, name + ".npy"), arrays[name])
+        
+        # terms in term ID order
+        with open(os.path.join(index_dir, "bm25.json"), 'w') as fp:
+            json.dump({"k1": self.k1, 
+                       "b": self.b, 
+                       "shape": list(self.tf.shape),
+                       "analyzer": self.analyzer.config(),
+                       "vocabulary": list(self.analyzer.vocabulary)}, fp)
+
+    @classmethod
+    def load(cls, index_dir, mmap = True):
+        """
+        @param index_dir: str, path to index folder
+        @param mmap: bool, memory map the arrays instead of reading them
+
+        @return index: BM25Index, with the analyzer the index was built with
+        """
+        with open(os.path.join(index_dir, "bm25.json"), 'r') as fp:
+            params = json.load(fp)
+        
+        analyzer = TextAnalyzer(**params["analyzer"])
+        analyzer.vocabulary = {term: i for i, term in enumerate(params["vocabulary"])}
+
+        index = cls(params["k1"], params["b"], analyzer)
+
+        arrays = {name: np.load(os.path.join(index_dir, name + ".npy"), 
+                                mmap_mode = 'r' if mmap else None)
+                  for name in BM25_ARRAYS}
+        
+        index.tf = sparse.csr_matrix((arrays["tf_data"], 
+                                      arrays["tf_indices"], 
+                                      arrays["tf_indptr"]),
+                                     shape = tuple(params["shape"]))
+        index.indptr = arrays["indptr"]
+        index.indices = arrays["indices"]
+        index.weights = arrays["weights"]
+        index.doc_lengths = arrays["doc_lengths"]
+
+        return index
+    
+
+def bm25_index_search(bm25_index, chunks, query, top_k):
+    ''' 
+    This function searches a BM25Index for a query.
+   
+    Input:
+    -----------
+        bm25_index: BM25Index
+            index of chunks
+
+        chunks: list (str)
+            each element is text (str) of a chunk, in chunk ID order
+        
+        query: str
+            question by user
+
+        top_k: int
+            filter chunks among the top_k matches with query
+
+    Output:
+    ----------
+        results: list (str, int)
+            list of (result, rank) pairs
+    '''
+    chunk_ids, scores = bm25_index.search(query, top_k)
+
+    return [(chunks[chunk_id], rank) for rank, chunk_id in enumerate(chunk_ids)]
+
+
+def bm25_index_search_batch(bm25_index, chunks, queries, top_k):
+    """
+    @param bm25_index: BM25Index, index of chunks
+    @param chunks: list (str), text of each chunk, in chunk ID order
+    @param queries: list (str), questions by users
+    @param top_k: int, number of chunks per query
+
+    @return results: list (list (str, int)), list of (result, rank) pairs of 
+                     each query, in query order
+    """
+    return [[(chunks[chunk_id], rank) for rank, chunk_id in enumerate(chunk_ids)]
+            for chunk_ids, _ in bm25_index.search_batch(queries, top_k)]
+
+
+# Year shards ================================================================
+# Each fiscal year is stored in its own chroma collection and elasticsearch 
+# index (<name>_<year>, e.g. audit_2018_19), so a new year's report is added by
+# building one small shard. ShardedSearch sends a query to the shards of the 
+# years asked about (every shard by default) concurrently and merges the top k
+# of each shard with a heap.
+#
+# BM25 scores of different elasticsearch shards use the idf of their own shard,
+# so merged sparse results are only approximately in global BM25 order.
+
+def shard_name(name, year):
+    """
+    @param name: str, collection or index name, e.g. "audit"
+    @param year: str, e.g. "2018_19"
+
+    @return shard: str, e.g. "audit_2018_19"
+    """
+    return f"{name}_{year}"
+
+
+def shard_year(name, shard):
+    """
+    @param name: str, collection or index name
+    @param shard: str, collection or index name to check
+
+    @return year: str, year of the shard, None if shard is not a year shard 
+                  of name (e.g. a blue/green generation name__<timestamp>)
+    """
+    match = re.fullmatch(re.escape(name) + r"_(\d{4}_\d{2})", shard)
+
+    return match.group(1) if match else None
+
+
+def partition_chunks(chunks, metadata, ids = None):
+    ''' 
+    This function groups chunks, metadata and IDs by year in one pass.
+   
+    Input:
+    -----------
+        chunks: list (str)
+            each element is text (str) of a chunk
+        
+        metadata: list (dict)
+            contains year, location in document and page number of chunk
+
+        ids: list (str)
+            id of each chunk. Defaults to metadata_store.make_chunk_ids.
+
+    Output:
+    ----------
+        partitions: dict
+            year (str) : {"chunks": list, "metadata": list, "ids": list}, 
+            in the order of chunks
+    '''
+    if ids is None:
+        ids = make_chunk_ids(chunks, metadata)
+
+    partitions = {}
+
+    for chunk, data, chunk_id in zip(chunks, metadata, ids):
+        partition = partitions.setdefault(data["year"], 
+                                          {"chunks": [], "metadata": [], "ids": []})
+        partition["chunks"].append(chunk)
+        partition["metadata"].append(data)
+        partition["ids"].append(chunk_id)
+
+    return partitions
+
+
+# chroma shards --------------------------------------------------------------
+def chroma_build_shards(client, 
+                        name, 
+                        embedding_function, 
+                        chunks, 
+                        metadata, 
+                        batch_size,
+                        ids = None,
+                        years = None,
+                        reset = False,
+                        bulk = True,
+                        **embed_kwargs):
+    ''' 
+    This function stores the chunks of each year in its own collection.
+   
+    Input:
+    -----------
+        client: chromadb.api.ClientAPI
+            persistent client the shards are stored in
+        
+        name: str
+            base name of the shards, e.g. "audit" gives audit_2018_19, ...
+
+        embedding_function: 
+            embedding function of the shards
+
+        chunks, metadata, batch_size, ids:
+            see chroma_fill_db
+
+        years: list (str)
+            only build the shards of these years, e.g. a new year's report. 
+            None to build every year in metadata.
+
+        reset: bool
+            delete the shards that are built first (other shards are kept)
+
+        bulk: bool
+            embed up front with chroma_bulk_load instead of chroma_fill_db
+
+        embed_kwargs:
+            passed to embed_chunks if bulk is True
+
+    Output:
+    ----------
+        shards: dict
+            year (str) : chromadb.api.models.Collection
+    '''
+    partitions = partition_chunks(chunks, metadata, ids)
+    existing = set(chroma_list_names(client))
+
+    shards = {}
+
+    for year, partition in partitions.items():
+        if years is not None and year not in years:
+            continue
+
+        shard = shard_name(name, year)
+
+        if reset and shard in existing:
+            client.delete_collection(name = shard)
+
+        collection = client.get_or_create_collection(
+            name = shard, 
+            embedding_function = embedding_function)
+
+        if bulk:
+            chroma_bulk_load(collection, 
+                             partition["chunks"], 
+                             partition["metadata"], 
+                             embedding_function, 
+                             batch_size, 
+                             partition["ids"], 
+                             **embed_kwargs)
+        else:
+            chroma_fill_db(collection, 
+                           partition["chunks"], 
+                           partition["metadata"], 
+                           batch_size, 
+                           partition["ids"])
+        
+        print(f"built shard {shard} with {collection.count()} chunks")
+        shards[year] = collection
+
+    return shards
+
+
+def chroma_open_shards(client, name, embedding_function):
+    """
+    @param client: chromadb.api.ClientAPI
+    @param name: str, base name of the shards
+    @param embedding_function: embedding function of the shards
+
+    @return shards: dict, year (str) : chromadb.api.models.Collection, of 
+                    every shard in the client
+    """
+    shards = {}
+
+    for shard in chroma_list_names(client):
+        year = shard_year(name, shard)
+
+        if year is not None:
+            shards[year] = client.get_collection(
+                name = shard, 
+                embedding_function = embedding_function)
+
+    return dict(sorted(shards.items()))
+
+
+def chroma_shard_search(collection, query_embedding, top_k, where = None, return_ids = False):
+    """
+    @param collection: chromadb.api.models.Collection, one shard
+    @param query_embedding: list (float), query embedded once for all shards
+    @param top_k: int
+    @param where: dict, chroma metadata filter
+    @param return_ids: bool, return (chunk ID, text) instead of chunk text
+
+    @return results: list (str, float), (chunk, score) pairs, best first. 
+                     score is minus the chroma distance.
+    """
+    search_output = collection.query(query_embeddings = [query_embedding],
+                                     n_results = top_k,
+                                     where = where,
+                                     include = ["documents", "distances"])
+
+    return [(chunk, -distance) for chunk, distance in 
+            zip(chroma_results(search_output, 0, return_ids), 
+                search_output['distances'][0])]
+
+
+def chroma_sharded_search(client, name, embedding_function, max_workers = None):
+    """
+    @param client: chromadb.api.ClientAPI
+    @param name: str, base name of the shards
+    @param embedding_function: embedding function of the shards, the query is 
+                               embedded once with it
+    @param max_workers: int, number of shards searched at the same time
+
+    @return searcher: ShardedSearch over every chroma shard, search keyword 
+                      arguments: where, return_ids
+    """
+    shards = chroma_open_shards(client, name, embedding_function)
+
+    shard_search = {
+        year: (lambda query_embedding, top_k, where = None, return_ids = False, 
+                      collection = collection:
+               chroma_shard_search(collection, query_embedding, top_k, where, 
+                                   return_ids))
+        for year, collection in shards.items()
+    }
+
+    return ShardedSearch(shard_search, 
+                         encode = lambda query: embedding_function([query])[0],
+                         max_workers = max_workers)
+
+
+# elasticsearch shards -------------------------------------------------------
+def elastic_build_shards(elastic_db, 
+                         name, 
+                         http_auth, 
+                         chunks, 
+                         metadata,
+                         ids = None,
+                         years = None,
+                         reset = True,
+                         **bulk_kwargs):
+    ''' 
+    This function stores the chunks of each year in its own index, with 
+    elastic_bulk_index.
+   
+    Input:
+    -----------
+        elastic_db: elasticsearch.Elasticsearch
+            client
+        
+        name: str
+            base name of the shards, e.g. "chromadb_documents"
+
+        http_auth: tuple
+            username and password
+        
+        chunks: list (str)
+            each element is text (str) of a chunk
+
+        metadata: list (dict)
+            see elastic_documents
+
+        ids: list (str)
+            id of each chunk. Defaults to metadata_store.make_chunk_ids.
+
+        years: list (str)
+            only build the shards of these years. None to build every year.
+
+        reset: bool
+            recreate the shards that are built (other shards are kept)
+
+        bulk_kwargs:
+            passed to elastic_bulk_index
+
+    Output:
+    ----------
+        n_indexed: dict
+            year (str) : number of chunks indexed in its shard
+    '''
+    partitions = partition_chunks(chunks, metadata, ids)
+
+    n_indexed = {}
+
+    for year, partition in partitions.items():
+        if years is not None and year not in years:
+            continue
+
+        n_indexed[year] = elastic_bulk_index(elastic_db, 
+                                             shard_name(name, year), 
+                                             http_auth, 
+                                             partition["chunks"], 
+                                             partition["ids"], 
+                                             partition["metadata"], 
+                                             reset = reset,
+                                             **bulk_kwargs)
+    
+    return n_indexed
+
+
+def elastic_shard_indices(elastic_db, name, http_auth):
+    """
+    @param elastic_db: elasticsearch.Elasticsearch
+    @param name: str, base name of the shards
+    @param http_auth: tuple, username and password
+
+    @return shards: dict, year (str) : index name, of every shard
+    """
+    indices = elastic_db.indices.get(index=f"{name}_*", 
+                                     ignore_unavailable=True,
+                                     http_auth=http_auth)
+    
+    shards = {shard_year(name, index): index for index in indices}
+    shards.pop(None, None)
+
+    return dict(sorted(shards.items()))
+
+
+def elastic_shard_search(elastic_db, 
+                         index_name, 
+                         http_auth, 
+                         query, 
+                         top_k, 
+                         filters = None, 
+                         return_ids = False):
+    """
+    @param elastic_db: elasticsearch.Elasticsearch
+    @param index_name: str, one shard
+    @param http_auth: tuple, username and password
+    @param query: str
+    @param top_k: int
+    @param filters: list (dict), bool.filter clauses, see bm25_elasticsearch
+    @param return_ids: bool, return (_id, text) instead of chunk text
+
+    @return results: list (str, float), (chunk, BM25 score) pairs, best first
+    """
+    response = elastic_db.search(index=index_name, 
+                                 body=elastic_match_body(query, top_k, filters), 
+                                 http_auth=http_auth)
+
+    return [(elastic_hit_result(hit, return_ids), hit['_score']) 
+            for hit in response['hits']['hits']]
+
+
+def elastic_sharded_search(elastic_db, name, http_auth, max_workers = None):
+    """
+    @param elastic_db: elasticsearch.Elasticsearch
+    @param name: str, base name of the shards
+    @param http_auth: tuple, username and password
+    @param max_workers: int, number of shards searched at the same time
+
+    @return searcher: ShardedSearch over every elasticsearch shard, search 
+                      keyword arguments: filters, return_ids
+    """
+    shards = elastic_shard_indices(elastic_db, name, http_auth)
+
+    shard_search = {
+        year: (lambda query, top_k, filters = None, return_ids = False, 
+                      index = index:
+               elastic_shard_search(elastic_db, index, http_auth, query, 
+                                    top_k, filters, return_ids))
+        for year, index in shards.items()
+    }
+
+    return ShardedSearch(shard_search, max_workers = max_workers)
+
+
+# scatter-gather -------------------------------------------------------------
+class ShardedSearch:
+    '''
+    This class searches year shards concurrently and merges their results.
+    The worker threads are stopped with close, or by using it in a with 
+    statement.
+
+    Input:
+    -----------
+        shard_search: dict
+            year (str) : function (query, top_k, **kwargs) returning 
+            (chunk, score) pairs of the shard, best (highest score) first
+
+        encode: function
+            applied to the query once before it is sent to the shards, e.g.
+            the embedding function. None to send the query as it is.
+
+        max_workers: int
+            number of shards searched at the same time, defaults to the 
+            number of shards
+    '''
+
+    def __init__(self, shard_search, encode = None, max_workers = None):
+        self.shard_search = shard_search
+        self.encode = encode
+        self.executor = ThreadPoolExecutor(
+            max_workers = max_workers or max(len(shard_search), 1))
+
+    def years(self):
+        """
+        @return years: list (str), years with a shard
+        """
+        return list(self.shard_search)
+
+    def close(self):
+        """
+        @return None, stops the worker threads after the searches already 
+                sent to the shards
+        """
+        self.executor.shutdown(wait = True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def search(self, query, top_k, years = None, **search_kwargs):
+        ''' 
+        This function sends the query to the shards of the given years and 
+        merges the top k of each shard into the overall top k.
+       
+        Input:
+        -----------
+            query: str
+                question by user
+
+            top_k: int
+                number of chunks returned, also the number asked from each 
+                shard
+
+            years: list (str)
+                years to search, e.g. query_constraints.extract_constraints. 
+                None or empty to search every shard.
+
+            search_kwargs:
+                passed to the search function of each shard (where, filters, 
+                return_ids)
+
+        Output:
+        ----------
+            results: list (str, int)
+                list of (result, rank) pairs, like chromadb_embedding_search
+        '''
+        if years:
+            shards = [year for year in years if year in self.shard_search]
+        else:
+            shards = self.years()
+
+        if not shards:
+            return []
+
+        if self.encode is not None:
+            query = self.encode(query)
+
+        # scatter
+        futures = [self.executor.submit(self.shard_search[year], 
+                                        query, 
+                                        top_k, 
+                                        **search_kwargs) 
+                   for year in shards]
+
+        # gather, each shard is sorted so a k way heap merge gives the top k
+        merged = heapq.merge(*[future.result() for future in futures],
+                             key = lambda result: result[1],
+                             reverse = True)
+
+        return [(chunk, rank) for rank, (chunk, _) in 
+                enumerate(itertools.islice(merged, top_k))]
+
+
+# Fusion =====================================================================
+def reciprocal_rank_fusion(bm25_results, 
+                           embedding_results, 
+                           weights, 
+                           k=60,
+                           chunk_id=None):
+    ''' 
+    This function fuses 2 ranks and produces a final rank using RRF algorithm.
+    It is a wrapper of fusion.fuse_results, which fuses any number of ranks.
+   
+    Input:
+    -----------
+        bm25_results: list (str, str)
+            list of (result, rank) pairs from BM25
+
+        embedding_results: list (str, str)
+            list of (result, rank) pairs from dense search
+
+        weights: list
+            list of weights assigned to each retriever results
+
+        k: int
+            a constant used in the RRF algorithm.
+            Empirically, k = 60 gives the best results.
+
+        chunk_id: function
+            maps chunk text to integer chunk ID (e.g. MetadataStore.chunk_id),
+            so chunks are keyed by ID instead of text
+
+    Output:
+    ----------
+        results: list (str)
+            list of chunks
+        
+    '''
+    return fuse_results([bm25_results, embedding_results], 
+                        weights, 
+                        k, 
+                        chunk_id = chunk_id)
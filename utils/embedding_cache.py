@@ -0,0 +1,333 @@
+# Embedding cache functions ==================================================
+
+# Embeddings are cached on disk, keyed by (model name, hash of text). An SQLite
+# index maps each key to a row of a memory mapped float32 matrix (one matrix
+# file per model). Chroma, FAISS (LangChain) and query embedding can all sit
+# behind the same cache through CachedEmbeddingFunction.
+#
+# The cache can be shared by processes (ingestion and the chatbot). Writes 
+# hold a lock file, and the matrix is cut back to the rows committed in the 
+# index before new rows are written, so bytes of a failed write are never 
+# read as another text's vector.
+from contextlib import contextmanager
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+# file locks between processes (POSIX), threads are always locked
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def text_hash(text):
+    """
+    @param text: str
+
+    @return hash: str, sha256 hex digest of text
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    '''
+    This class is a persistent, content addressed embedding cache. It is safe
+    to share between threads.
+
+    Input:
+    -----------
+        cache_dir: str
+            folder of the cache, made if it does not exist
+    '''
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok = True)
+
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(
+            os.path.join(cache_dir, "index.sqlite"),
+            check_same_thread = False)
+
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS models "
+                "(model TEXT PRIMARY KEY, dim INTEGER, n_rows INTEGER)")
+
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(model TEXT, hash TEXT, row INTEGER, "
+                "PRIMARY KEY (model, hash))")
+
+        # model : memory mapped matrix, remapped when rows are added
+        self.matrices = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def matrix_path(self, model):
+        """
+        @param model: str, embedding model name
+
+        @return path: str, path to the matrix of the model
+        """
+        return os.path.join(self.cache_dir, text_hash(model)[:16] + ".f32")
+
+    @contextmanager
+    def write_lock(self):
+        """
+        @return context manager, holds the thread lock and the lock file of 
+                the cache, so one thread of one process writes at a time
+        """
+        with self.lock:
+            with open(os.path.join(self.cache_dir, "write.lock"), 'a') as fp:
+                if fcntl is not None:
+                    fcntl.flock(fp, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def model_info(self, model):
+        """
+        @param model: str, embedding model name
+
+        @return (dim, n_rows): tuple, (None, 0) if nothing is cached
+        """
+        row = self.connection.execute(
+            "SELECT dim, n_rows FROM models WHERE model = ?",
+            (model,)).fetchone()
+
+        return row if row is not None else (None, 0)
+
+    def matrix(self, model):
+        """
+        @param model: str, embedding model name
+
+        @return matrix: numpy memmap (float32), all cached rows of the model
+        """
+        dim, n_rows = self.model_info(model)
+        matrix = self.matrices.get(model)
+
+        if matrix is None or len(matrix) < n_rows:
+            matrix = np.memmap(self.matrix_path(model),
+                               dtype = np.float32,
+                               mode = 'r',
+                               shape = (n_rows, dim))
+            self.matrices[model] = matrix
+
+        return matrix
+
+    def get(self, model, texts):
+        '''
+        This function looks up cached embeddings.
+
+        Input:
+        -----------
+            model: str
+                embedding model name
+
+            texts: list (str)
+                texts to look up
+
+        Output:
+        --------
+            embeddings: list
+                numpy vector (float32) of each text, None if not cached
+        '''
+        hashes = [text_hash(text) for text in texts]
+
+        with self.lock:
+            rows = {}
+
+            # sqlite limits the number of parameters in a query
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start : start + 500]
+                placeholders = ", ".join("?" * len(batch))
+
+                rows.update(self.connection.execute(
+                    "SELECT hash, row FROM embeddings "
+                    f"WHERE model = ? AND hash IN ({placeholders})",
+                    [model] + batch).fetchall())
+
+            matrix = self.matrix(model) if rows else None
+
+            embeddings = [np.array(matrix[rows[h]]) if h in rows else None
+                          for h in hashes]
+
+            n_hits = sum(embedding is not None for embedding in embeddings)
+            self.hits += n_hits
+            self.misses += len(texts) - n_hits
+
+        return embeddings
+
+    def put(self, model, texts, embeddings):
+        '''
+        This function adds embeddings to the cache. Texts already in the cache
+        are skipped.
+
+        Input:
+        -----------
+            model: str
+                embedding model name
+
+            texts: list (str)
+                embedded texts
+
+            embeddings: list (list (float)) or numpy array
+                one vector per text
+        '''
+        if len(texts) == 0:
+            return
+
+        embeddings = np.asarray(embeddings, dtype = np.float32)
+
+        with self.write_lock():
+            # committed rows, possibly added by another process
+            dim, n_rows = self.model_info(model)
+
+            if dim is None:
+                dim = embeddings.shape[1]
+
+            elif dim != embeddings.shape[1]:
+                raise ValueError(f"cached embeddings of {model} have {dim} "
+                                 f"dimensions, got {embeddings.shape[1]}")
+
+            # skip texts that are already cached (or repeated in this batch)
+            new_rows, new_hashes, seen = [], [], set()
+
+            for i, text in enumerate(texts):
+                h = text_hash(text)
+
+                if h in seen:
+                    continue
+                seen.add(h)
+
+                cached = self.connection.execute(
+                    "SELECT 1 FROM embeddings WHERE model = ? AND hash = ?",
+                    (model, h)).fetchone()
+
+                if cached is None:
+                    new_rows.append(i)
+                    new_hashes.append(h)
+
+            if not new_rows:
+                return
+
+            # bytes after the committed rows are left by a failed write, they
+            # are cut off so new rows start at row n_rows. Rows are written 
+            # before the index is updated, so the index never points at a 
+            # missing row.
+            path = self.matrix_path(model)
+            with open(path, 'r+b' if os.path.exists(path) else 'w+b') as fp:
+                fp.seek(n_rows * dim * 4)
+                fp.truncate()
+                fp.write(embeddings[new_rows].tobytes())
+                fp.flush()
+                os.fsync(fp.fileno())
+
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT INTO embeddings (model, hash, row) VALUES (?, ?, ?)",
+                    [(model, h, n_rows + i) for i, h in enumerate(new_hashes)])
+
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO models (model, dim, n_rows) "
+                    "VALUES (?, ?, ?)",
+                    (model, dim, n_rows + len(new_rows)))
+
+    def stats(self):
+        """
+        @return stats: dict, number of cache hits and misses so far
+        """
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class CachedEmbeddingFunction:
+    '''
+    This class puts an embedding cache in front of an embedding function. Only
+    texts missing from the cache are sent to the embedding function.
+
+    It can be used as a chroma embedding function (called with a list of
+    texts) and as a LangChain embedding (embed_documents, embed_query), e.g.
+    for FAISS.
+
+    Input:
+    -----------
+        embedding_function:
+            chromadb.utils.embedding_functions.OpenAIEmbeddingFunction,
+            langchain_openai.OpenAIEmbeddings or any function mapping a list
+            of texts to a list of vectors
+
+        cache: EmbeddingCache
+
+        model_name: str
+            name of the embedding model, part of the cache key
+
+        persist: bool
+            add new embeddings to the cache. False to only read it, e.g. in
+            the chatbot, where chroma embeds queries through this function, 
+            so every query is not kept forever.
+    '''
+
+    def __init__(self, embedding_function, cache, model_name, persist = True):
+        self.embedding_function = embedding_function
+        self.cache = cache
+        self.model_name = model_name
+        self.persist = persist
+
+    def embed(self, texts, persist = None):
+        """
+        @param texts: list (str)
+        @param persist: bool, add new embeddings to the cache, None for 
+                        self.persist
+
+        @return embeddings: list (list (float)), one vector per text
+        """
+        if persist is None:
+            persist = self.persist
+
+        embeddings = self.cache.get(self.model_name, texts)
+
+        missing = [i for i, embedding in enumerate(embeddings)
+                   if embedding is None]
+
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+
+            # LangChain embeddings are not callable
+            if hasattr(self.embedding_function, "embed_documents"):
+                new_embeddings = self.embedding_function.embed_documents(
+                    missing_texts)
+            else:
+                new_embeddings = self.embedding_function(missing_texts)
+
+            if persist:
+                self.cache.put(self.model_name, missing_texts, new_embeddings)
+
+            for i, embedding in zip(missing, new_embeddings):
+                embeddings[i] = embedding
+
+        return [np.asarray(embedding, dtype = np.float32).tolist()
+                for embedding in embeddings]
+
+    # chroma embedding function (chroma requires the argument to be "input")
+    def __call__(self, input):
+        return self.embed(list(input))
+
+    # LangChain embeddings
+    def embed_documents(self, texts):
+        return self.embed(list(texts))
+
+    # queries are looked up but not cached
+    def embed_query(self, text):
+        return self.embed([text], persist = False)[0]
+
+    def embed_queries(self, texts):
+        return self.embed(list(texts), persist = False)
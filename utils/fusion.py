@@ -0,0 +1,276 @@
+# Rank fusion functions ======================================================
+
+# Fuses the results of any number of retrievers. Results are keyed by integer
+# chunk ID (the position of the chunk in chunks / the metadata store), so long
+# chunk texts are not hashed. Only the top k fused results are selected, with
+# a heap, instead of sorting every candidate.
+import heapq
+
+import numpy as np
+
+
+# Single query ---------------------------------------------------------------
+def weighted_rrf(rankings, weights = None, k = 60, top_k = None):
+    '''
+    This function fuses ranked lists with weighted reciprocal rank fusion.
+    A result at rank r (0 is best) of retriever i scores weights[i] / (k + r).
+
+    Input:
+    -----------
+        rankings: list (list)
+            one list of chunk IDs per retriever, best match first
+
+        weights: list (float)
+            weight of each retriever, defaults to 1 for every retriever
+
+        k: int
+            a constant used in the RRF algorithm.
+            Empirically, k = 60 gives the best results.
+
+        top_k: int
+            number of results returned, None for every result
+
+    Output:
+    --------
+        results: list (int, float)
+            (chunk ID, fused score) pairs, best first. Ties keep the order in
+            which chunks were first seen.
+    '''
+    if weights is None:
+        weights = [1] * len(rankings)
+
+    fusion_scores = {}
+
+    for ranking, weight in zip(rankings, weights):
+        for rank, chunk_id in enumerate(ranking):
+            fusion_scores[chunk_id] = (fusion_scores.get(chunk_id, 0)
+                                       + weight / (k + rank))
+
+    return top_results(fusion_scores, top_k)
+
+
+def normalize_scores(scores, method = "minmax"):
+    """
+    @param scores: numpy array (float), raw scores of one retriever
+    @param method: str, "minmax", "zscore" or None (raw scores)
+
+    @return scores: numpy array (float), normalised scores
+    """
+    scores = np.asarray(scores, dtype = np.float64)
+
+    if method is None or len(scores) == 0:
+        return scores
+
+    if method == "minmax":
+        spread = scores.max() - scores.min()
+        return (scores - scores.min()) / spread if spread > 0 else np.ones_like(scores)
+
+    if method == "zscore":
+        std = scores.std()
+        return (scores - scores.mean()) / std if std > 0 else np.zeros_like(scores)
+
+    raise ValueError(f"unknown normalisation: {method}")
+
+
+def comb_sum(score_lists, weights = None, normalization = "minmax", top_k = None):
+    '''
+    This function fuses scored lists with CombSUM: the score of a chunk is
+    the weighted sum of its normalised scores. A chunk missing from a list
+    adds nothing for that list.
+
+    Input:
+    -----------
+        score_lists: list (list (int, float))
+            one list of (chunk ID, raw score) pairs per retriever, e.g. BM25
+            scores and cosine similarities
+
+        weights: list (float)
+            weight of each retriever, defaults to 1 for every retriever
+
+        normalization: str
+            "minmax" or "zscore", applied to each list separately so scores
+            of different retrievers are comparable. None to sum raw scores.
+
+        top_k: int
+            number of results returned, None for every result
+
+    Output:
+    --------
+        results: list (int, float)
+            (chunk ID, fused score) pairs, best first
+    '''
+    if weights is None:
+        weights = [1] * len(score_lists)
+
+    fusion_scores = {}
+
+    for score_list, weight in zip(score_lists, weights):
+        if len(score_list) == 0:
+            continue
+
+        chunk_ids = [chunk_id for chunk_id, _ in score_list]
+        scores = normalize_scores([score for _, score in score_list],
+                                  normalization)
+
+        for chunk_id, score in zip(chunk_ids, scores.tolist()):
+            fusion_scores[chunk_id] = (fusion_scores.get(chunk_id, 0)
+                                       + weight * score)
+
+    return top_results(fusion_scores, top_k)
+
+
+def top_results(fusion_scores, top_k = None):
+    """
+    @param fusion_scores: dict, chunk ID: fused score
+    @param top_k: int, number of results returned, None for every result
+
+    @return results: list (int, float), (chunk ID, fused score) pairs, best
+                     first, ties in insertion order
+    """
+    if top_k is None or top_k >= len(fusion_scores):
+        return sorted(fusion_scores.items(), key = lambda item: item[1],
+                      reverse = True)
+
+    # heap of size top_k, same order as sorting
+    return heapq.nlargest(top_k, fusion_scores.items(),
+                          key = lambda item: item[1])
+
+
+# MAIN FUNCTION
+# This function fuses (chunk, rank) results as returned by the retrievers
+def fuse_results(results, weights = None, k = 60, chunk_id = None, top_k = None):
+    '''
+    This function fuses the results of any number of retrievers with weighted
+    RRF. Retrievers return (chunk, rank) pairs, e.g. bm25_elasticsearch and
+    chromadb_embedding_search.
+
+    Input:
+    -----------
+        results: list (list (str, int))
+            (chunk, rank) pairs of each retriever
+
+        weights: list (float)
+            weight of each retriever, defaults to 1 for every retriever
+
+        k: int
+            a constant used in the RRF algorithm.
+
+        chunk_id: function
+            maps chunk text to its integer chunk ID, e.g.
+            metadata_store.MetadataStore.chunk_id. Chunks it does not know
+            (KeyError) are keyed by their text. None to key every chunk by
+            its text.
+
+        top_k: int
+            number of chunks returned, None for every chunk
+
+    Output:
+    --------
+        good_chunks: list (str)
+            fused chunks, best first
+    '''
+    # chunk key : text
+    texts = {}
+    rankings = []
+
+    for retriever_results in results:
+
+        # rank order, as returned by the retriever
+        ordered = sorted(retriever_results, key = lambda result: result[1])
+
+        ranking = []
+        for chunk, _ in ordered:
+            key = chunk
+            if chunk_id is not None:
+                try:
+                    key = chunk_id(chunk)
+                except KeyError:
+                    pass
+
+            texts.setdefault(key, chunk)
+            ranking.append(key)
+
+        rankings.append(ranking)
+
+    fused = weighted_rrf(rankings, weights, k, top_k)
+
+    return [texts[key] for key, _ in fused]
+
+
+# Batch of queries -----------------------------------------------------------
+def rrf_batch(rankings, weights = None, k = 60, top_k = 10):
+    '''
+    This function fuses the rankings of many queries at once with weighted
+    RRF, e.g. for evaluation. Scores of all queries are summed with one
+    np.unique / np.bincount, without a python loop over queries.
+
+    Input:
+    -----------
+        rankings: list (numpy array (int))
+            one array per retriever, shape (n_queries, depth). Row q holds the
+            chunk IDs returned for query q, best first, padded with -1.
+
+        weights: list (float)
+            weight of each retriever, defaults to 1 for every retriever
+
+        k: int
+            a constant used in the RRF algorithm.
+
+        top_k: int
+            number of results per query
+
+    Output:
+    --------
+        chunk_ids: numpy array (int)
+            shape (n_queries, top_k), best first, padded with -1
+
+        scores: numpy array (float)
+            shape (n_queries, top_k), fused scores, padded with 0
+    '''
+    if weights is None:
+        weights = [1] * len(rankings)
+
+    n_queries = rankings[0].shape[0]
+
+    queries, ids, contributions = [], [], []
+
+    for ranking, weight in zip(rankings, weights):
+        ranking = np.asarray(ranking, dtype = np.int64)
+        depth = ranking.shape[1]
+
+        query_index = np.repeat(np.arange(n_queries), depth)
+        contribution = np.tile(weight / (k + np.arange(depth)), n_queries)
+
+        valid = ranking.ravel() != -1
+        queries.append(query_index[valid])
+        ids.append(ranking.ravel()[valid])
+        contributions.append(contribution[valid])
+
+    queries = np.concatenate(queries)
+    ids = np.concatenate(ids)
+    contributions = np.concatenate(contributions)
+
+    # one key per (query, chunk ID) pair
+    n_ids = int(ids.max()) + 1 if len(ids) else 1
+    keys, inverse = np.unique(queries * n_ids + ids, return_inverse = True)
+    fused = np.bincount(inverse, weights = contributions)
+
+    key_queries = keys // n_ids
+    key_ids = keys % n_ids
+
+    # sort by query, then by score (best first)
+    order = np.lexsort((-fused, key_queries))
+    key_queries, key_ids, fused = key_queries[order], key_ids[order], fused[order]
+
+    # position of each result within its query
+    starts = np.searchsorted(key_queries, np.arange(n_queries))
+    positions = np.arange(len(key_queries)) - starts[key_queries]
+    keep = positions < top_k
+
+    chunk_ids = np.full((n_queries, top_k), -1, dtype = np.int64)
+    scores = np.zeros((n_queries, top_k), dtype = np.float64)
+
+    chunk_ids[key_queries[keep], positions[keep]] = key_ids[keep]
+    scores[key_queries[keep], positions[keep]] = fused[keep]
+
+    return chunk_ids, scores
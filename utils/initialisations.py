@@ -49,4 +49,11 @@ chunk_pageNum_pairs_path = PARSED_DOCUMENT_DIR + "/chunk_pageNum_pairs.json"
 s_p_pairs_path = PARSED_DOCUMENT_DIR + "/sentence_paragraph_pairs.json"
 tree_path = PARSED_DOCUMENT_DIR + "/complete_tree.json"
 save_inverted_tree_path = PARSED_DOCUMENT_DIR + "/inverted_tree.json"
+manifest_path = PARSED_DOCUMENT_DIR + "/ingestion_manifest.json"
+spans_path = PARSED_DOCUMENT_DIR + "/chunk_spans.json"
+text_dir = PARSED_DOCUMENT_DIR + "/text"
+bundle_dir = PARSED_DOCUMENT_DIR + "/corpus_bundle"
+yearly_index_path = PARSED_DOCUMENT_DIR + "/yearly_index.json"
+embedding_cache_dir = "../data/embedding_cache"
+chroma_pointer_path = "../data/db/collection_pointer.json"
 index_name = 'chromadb_documents'
\ No newline at end of file
@@ -1,4 +1,6 @@
 import json
+import os
+import numpy as np
 
 # JSON functions =============================================================
 
@@ -13,6 +15,36 @@ def save_json(object, filename):
     with open(filename, 'w') as fp:
         json.dump(object, fp)
 
+# saves an iterable of python dictionaries as JSON Lines, one per line
+def save_jsonl(records, filename, append = False):
+    """
+    @param records: iterable (dictionary), consumed one record at a time
+    @param filename: str
+    @param append: bool, append to file instead of overwriting it
+
+    @return n_records: int, number of records written
+    """
+    n_records = 0
+
+    with open(filename, 'a' if append else 'w') as fp:
+        for record in records:
+            fp.write(json.dumps(record) + "\n")
+            n_records += 1
+    
+    return n_records
+
+# Reads a JSON Lines file one record at a time
+def jsonl_file_to_records(file_path):
+    """
+    @param file_path: str
+
+    @return: generator (dictionary), one record per line
+    """
+    with open(file_path, 'r') as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
 # Converts JSON object stored in JSON file into a python dictionary
 def json_file_to_dict(file_path):
     ''' 
@@ -75,4 +107,97 @@ def json_file_to_dict_with_int_keys(file_path):
         # handle error if keys are not integers
         print("Error converting keys to integers:", e)
 
-        return None
\ No newline at end of file
+        return None
+
+# Corpus bundle functions ====================================================
+# A corpus bundle is a folder of flat binary files that are memory mapped when
+# loaded, so no large JSON is parsed at boot (see utils.corpus).
+
+# names of the binary files in a corpus bundle
+CORPUS_BUNDLE_TEXT = ["chunk_text", "paragraph_text"]
+CORPUS_BUNDLE_ARRAYS = ["chunk_offsets", "paragraph_offsets", 
+                        "year", "location", "page", "paragraph"]
+
+# arrays that bundles written by older versions do not have
+CORPUS_BUNDLE_OPTIONAL = ["stable_id_sorted", "stable_id_rows", 
+                          "text_hash_sorted", "text_hash_rows"]
+
+# saves the arrays and tables of a corpus bundle
+def save_corpus_bundle(arrays, tables, bundle_dir):
+    """
+    @param arrays: dictionary, name: bytes (CORPUS_BUNDLE_TEXT) or numpy 
+                   array (CORPUS_BUNDLE_ARRAYS, CORPUS_BUNDLE_OPTIONAL)
+    @param tables: dictionary, small lookup tables saved as JSON
+    @param bundle_dir: str
+
+    @return: None
+    """
+    os.makedirs(bundle_dir, exist_ok = True)
+
+    for name in CORPUS_BUNDLE_TEXT:
+        with open(os.path.join(bundle_dir, name + ".bin"), 'wb') as fp:
+            fp.write(arrays[name])
+    
+    for name in CORPUS_BUNDLE_ARRAYS:
+        np.save(os.path.join(bundle_dir, name + ".npy"), arrays[name])
+    
+    for name in CORPUS_BUNDLE_OPTIONAL:
+        if name in arrays:
+            np.save(os.path.join(bundle_dir, name + ".npy"), arrays[name])
+    
+    save_json(tables, os.path.join(bundle_dir, "tables.json"))
+
+# Memory maps the arrays of a corpus bundle and reads its tables
+def corpus_bundle_to_arrays(bundle_dir):
+    ''' 
+    This function memory maps a corpus bundle. Nothing is read from disk 
+    until the arrays are indexed.
+   
+    Input:
+    -----------
+        bundle_dir: str
+            Path to corpus bundle folder
+
+    Output:
+    --------
+        arrays: dictionary
+            name: read only numpy array (uint8 for text)
+
+        tables: dictionary
+            small lookup tables (years, locations)
+
+        returns (None, None) if the bundle cannot be read
+    '''
+    try:
+        arrays = {}
+
+        for name in CORPUS_BUNDLE_TEXT:
+            path = os.path.join(bundle_dir, name + ".bin")
+
+            # empty files cannot be memory mapped
+            if os.path.getsize(path) == 0:
+                arrays[name] = np.zeros(0, dtype = np.uint8)
+            else:
+                arrays[name] = np.memmap(path, dtype = np.uint8, mode = 'r')
+        
+        for name in CORPUS_BUNDLE_ARRAYS:
+            arrays[name] = np.load(os.path.join(bundle_dir, name + ".npy"), 
+                                   mmap_mode = 'r')
+        
+        for name in CORPUS_BUNDLE_OPTIONAL:
+            path = os.path.join(bundle_dir, name + ".npy")
+
+            if os.path.exists(path):
+                arrays[name] = np.load(path, mmap_mode = 'r')
+        
+        with open(os.path.join(bundle_dir, "tables.json"), 'r') as file:
+            tables = json.load(file)
+
+        return arrays, tables
+    
+    except (json.JSONDecodeError, OSError, ValueError) as e:
+
+        # handle error if cannot open corpus bundle
+        print("Error reading corpus bundle:", e)
+
+        return None, None
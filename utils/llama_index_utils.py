@@ -2,6 +2,7 @@
 
 # import curtom modules
 from utils.json_parser import save_json
+from utils.metadata_store import MetadataStore, partition_by_year, ids_to_ranges
 
 # import llama index modules
 from llama_index.vector_stores.chroma import ChromaVectorStore
@@ -65,7 +66,7 @@ def generate_yearly_data(years, metadata, chunks, yearly_data_path):
         years: list (str)
             list of all years.
 
-        metadata: list (dict)
+        metadata: list (dict) or metadata_store.MetadataStore
             contains year, location in document and page number of chunk
         
         chunks: list (str)
@@ -82,29 +83,87 @@ def generate_yearly_data(years, metadata, chunks, yearly_data_path):
         
     '''
 
+    # read chroma formatted metadata from the store
+    if isinstance(metadata, MetadataStore):
+        metadata = metadata.chroma_metadata()
+
     # initialise yearly data
-    yearly_data = {}
+    yearly_data = {year: {"chunks": [], "metadata": []} for year in years}
 
-    # iterate through all the years
-    for year in years:
+    # single pass through the whole database to cluster by years
+    for chunk, meta in zip(chunks, metadata):
+        yearly = yearly_data.get(meta["year"])
+
+        # add to yearly lists
+        if yearly is not None:
+            yearly["chunks"].append(chunk)
+            yearly["metadata"].append(meta)
+    
+    # save data
+    save_json(yearly_data, yearly_data_path)
+
+
+def generate_yearly_index(metadata_store, yearly_index_path):
+    ''' 
+    This function is the light weight version of generate_yearly_data. It 
+    saves the chunk IDs of each year as contiguous ranges over the chunk 
+    store, without copying any text or metadata.
+   
+    Input:
+    -----------
+        metadata_store: metadata_store.MetadataStore
+            metadata of every chunk
+
+        yearly_index_path: str
+            yearly_index is a dict with keys (years), 
+                                        values (list of [start, end) ranges)
+
+    Output:
+    ----------
+        None
+            yearly_index is saved in yearly_index_path
+    '''
+    partitions = partition_by_year(metadata_store)
+
+    yearly_index = {year: ids_to_ranges(ids) for year, ids in partitions.items()}
 
-        # initialise yearly lists to add as values
-        yearly_chunks, yearly_metadata = [], []
+    save_json(yearly_index, yearly_index_path)
 
-        # iterate through the whole database to cluster by years
-        for idx, meta in enumerate(metadata):
-            if meta["year"] == year:
 
-                # add to yearly lists
-                yearly_chunks.append(chunks[idx])
-                yearly_metadata.append(meta)
+def get_yearly_data(yearly_index, year, chunks, metadata):
+    ''' 
+    This function gets the chunks and metadata of a year from a yearly index.
+    Lists are sliced, so the text of the chunks is shared, not copied.
+   
+    Input:
+    -----------
+        yearly_index: dict
+            output of generate_yearly_index
+
+        year: str
+            year to get
         
-        # add to yearly data for each year
-        yearly_data[year] = {"chunks": yearly_chunks,
-                            "metadata": yearly_metadata}
+        chunks: list (str)
+            each element is text (str) of a chunk
+
+        metadata: list (dict)
+            contains year, location in document and page number of chunk
+
+    Output:
+    ----------
+        yearly_chunks: list (str)
+            chunks of the year
+
+        yearly_metadata: list (dict)
+            metadata of the chunks of the year
+    '''
+    yearly_chunks, yearly_metadata = [], []
+
+    for start, end in yearly_index[year]:
+        yearly_chunks += chunks[start:end]
+        yearly_metadata += metadata[start:end]
     
-    # save data
-    save_json(yearly_data, yearly_data_path)
+    return yearly_chunks, yearly_metadata
 
 
 def llama_get_agent(db, embed_model, description, openai_api_key):
@@ -202,10 +261,9 @@ def llama_get_agent_manual(db, embed_model, description, openai_api_key):
             vector database
     '''
 
-    count = db.count()
-
-    chunks_all_data = db.get([f"id{i}" for i in range(count)], 
-                             include = ["metadatas", "documents","embeddings"])
+    # every chunk, whatever its ID (db_utils stores make_chunk_ids IDs)
+    chunks_all_data = db.get(include = ["metadatas", "documents","embeddings"])
+    count = len(chunks_all_data["ids"])
     
     chunks_text = chunks_all_data["documents"]
     chunks_ids = chunks_all_data["ids"]
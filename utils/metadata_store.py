@@ -0,0 +1,593 @@
+# Chunk metadata functions ===================================================
+
+# Metadata of every chunk is stored as integer columns. Years and sections
+# (paths of headings in the content page tree) are interned in small tables,
+# so a heading like "PART I B : AUDIT OF GOVERNMENT MINISTRIES..." is stored
+# once instead of once per chunk.
+import hashlib
+
+import numpy as np
+
+# page column codes for chunks without a page number
+NO_PAGE = -1
+INTRODUCTION_PAGE = -2
+
+# number of hex characters of a stable chunk ID (make_chunk_id)
+STABLE_ID_LENGTH = 32
+
+
+class SectionTable:
+    '''
+    This class interns section paths (list of headings from the content page
+    tree) and gives each one an integer section ID.
+    '''
+
+    def __init__(self, paths = ()):
+        # section ID : path
+        self.paths = []
+
+        # path : section ID
+        self.ids = {}
+
+        # section ID : headings joined into one string, as stored in chroma
+        self.texts = []
+
+        for path in paths:
+            self.intern(path)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def intern(self, path):
+        """
+        @param path: list (str), headings from the root of the tree
+
+        @return section_id: int
+        """
+        path = tuple(path)
+        section_id = self.ids.get(path)
+
+        if section_id is None:
+            section_id = len(self.paths)
+            self.ids[path] = section_id
+            self.paths.append(path)
+            self.texts.append(', '.join(path))
+
+        return section_id
+
+    def path(self, section_id):
+        """
+        @param section_id: int
+
+        @return path: tuple (str), headings from the root of the tree
+        """
+        return self.paths[section_id]
+
+    def text(self, section_id):
+        """
+        @param section_id: int
+
+        @return text: str, headings joined with ', '
+        """
+        return self.texts[section_id]
+
+
+class ChunkMetadata:
+    '''
+    Metadata record of a single chunk. Records are made on demand from the
+    columns of a MetadataStore.
+
+    Attributes:
+    -----------
+        year: str
+            year of the document the chunk is from
+
+        section: int
+            section ID, -1 if the document has no content page
+
+        location: tuple (str)
+            headings of the section, None if section == -1
+
+        location_text: str
+            headings joined with ', ', None if section == -1
+
+        page: int or str
+            page number written on the pdf, "Introduction" or None
+    '''
+    __slots__ = ("year", "section", "location", "location_text", "page")
+
+    def __init__(self, year, section, location, location_text, page):
+        self.year = year
+        self.section = section
+        self.location = location
+        self.location_text = location_text
+        self.page = page
+
+    @classmethod
+    def from_dict(cls, metadata):
+        """
+        @param metadata: dictionary, a value of the inverted tree
+
+        @return record: ChunkMetadata
+        """
+        location = metadata.get("location", -1)
+
+        if location == -1:
+            location, location_text = None, None
+        else:
+            location_text = ', '.join(location)
+            location = tuple(location)
+
+        return cls(metadata["year"],
+                   -1,
+                   location,
+                   location_text,
+                   metadata.get("page"))
+
+    def to_dict(self):
+        """
+        @return metadata: dictionary, same as a value of the inverted tree
+        """
+        metadata = {"year": self.year}
+
+        if self.location is not None:
+            metadata["location"] = list(self.location)
+
+        if self.page is not None:
+            metadata["page"] = self.page
+
+        return metadata
+
+
+class MetadataStore:
+    '''
+    This class stores the metadata of every chunk as integer columns, indexed
+    by chunk ID. Chunk IDs follow the order of the inverted tree.
+
+    Input:
+    -----------
+        years: list (str)
+            year table, indexed by year ID
+
+        sections: SectionTable
+            section table
+
+        year_ids: numpy array (int)
+            year ID of each chunk
+
+        section_ids: numpy array (int)
+            section ID of each chunk, -1 if the document has no content page
+
+        pages: numpy array (int)
+            page of each chunk, NO_PAGE or INTRODUCTION_PAGE if missing
+
+        chunk_id: function
+            maps chunk text (str) to chunk ID, raises KeyError if missing. 
+            Identical chunks of different years resolve to the first one, 
+            use row with the stable chunk ID to tell them apart.
+
+        stable_ids: StableIdIndex
+            maps stable chunk IDs (make_chunk_id, the ids of chroma and 
+            elasticsearch) to chunk ID
+    '''
+
+    def __init__(self, 
+                 years, 
+                 sections, 
+                 year_ids, 
+                 section_ids, 
+                 pages, 
+                 chunk_id, 
+                 stable_ids = None):
+        self.years = years
+        self.sections = sections
+        self.year_ids = year_ids
+        self.section_ids = section_ids
+        self.pages = pages
+        self.chunk_id = chunk_id
+        self.stable_ids = stable_ids
+
+    @classmethod
+    def from_inverted_tree(cls, inverted_tree, doc = "ar_fy"):
+        """
+        @param inverted_tree: dictionary, chunks (str) : meta data, or ID
+                              keyed (see content_page_parser.key_by_chunk_id)
+        @param doc: str, document identifier of the stable chunk IDs of a 
+                    text keyed tree (an ID keyed tree has them as keys)
+
+        @return store: MetadataStore
+        """
+        n_chunks = len(inverted_tree)
+
+        year_ids = np.empty(n_chunks, dtype = np.int16)
+        section_ids = np.empty(n_chunks, dtype = np.int32)
+        pages = np.empty(n_chunks, dtype = np.int32)
+
+        years = {}
+        sections = SectionTable()
+        chunk_ids = {}
+        stable_ids = []
+
+        for i, (key, metadata) in enumerate(inverted_tree.items()):
+            chunk = metadata.get("text", key)
+
+            # an ID keyed tree is keyed by the stable chunk ID already
+            if "text" in metadata:
+                stable_ids.append(key)
+            else:
+                stable_ids.append(make_chunk_id(doc, 
+                                                metadata["year"], 
+                                                metadata.get("page"), 
+                                                chunk))
+
+            # identical chunks of an ID keyed tree resolve to the first one
+            chunk_ids.setdefault(chunk, i)
+            year_ids[i] = years.setdefault(metadata["year"], len(years))
+
+            location = metadata.get("location", -1)
+            section_ids[i] = sections.intern(location) if location != -1 else -1
+
+            pages[i] = encode_page(metadata.get("page", -1))
+
+        return cls(list(years), sections, year_ids, section_ids, pages,
+                   chunk_ids.__getitem__, StableIdIndex.from_ids(stable_ids))
+
+    @classmethod
+    def from_corpus_bundle(cls, bundle):
+        """
+        @param bundle: corpus.CorpusBundle
+
+        @return store: MetadataStore, columns are the memory mapped columns
+                       of the bundle (no copy)
+        """
+        return cls(bundle.years,
+                   SectionTable(bundle.locations),
+                   bundle.arrays["year"],
+                   bundle.arrays["location"],
+                   bundle.arrays["page"],
+                   bundle.chunk_id,
+                   bundle.stable_id_index())
+
+    def __len__(self):
+        return len(self.year_ids)
+
+    def __getitem__(self, chunk):
+        """
+        @param chunk: str, text of chunk
+
+        @return record: ChunkMetadata
+        """
+        return self.record(self.chunk_id(chunk))
+
+    def row(self, stable_id):
+        """
+        @param stable_id: str, stable chunk ID, e.g. a chroma or elasticsearch 
+                          id of the chunk
+
+        @return chunk_id: int, raises KeyError if the ID is not in the corpus
+        """
+        if self.stable_ids is None:
+            raise KeyError(stable_id)
+
+        return self.stable_ids.row(stable_id)
+
+    def stable_id(self, chunk_id):
+        """
+        @param chunk_id: int
+
+        @return stable_id: str, stable chunk ID of the chunk, as stored in 
+                           chroma and elasticsearch
+        """
+        return self.stable_ids.stable_id(chunk_id)
+
+    def record(self, chunk_id):
+        """
+        @param chunk_id: int
+
+        @return record: ChunkMetadata
+        """
+        section = int(self.section_ids[chunk_id])
+
+        if section == -1:
+            location, location_text = None, None
+        else:
+            location = self.sections.path(section)
+            location_text = self.sections.text(section)
+
+        return ChunkMetadata(self.years[self.year_ids[chunk_id]],
+                             section,
+                             location,
+                             location_text,
+                             decode_page(self.pages[chunk_id]))
+
+    def chroma_metadata(self):
+        """
+        @return metadata: list (dict), metadata of every chunk in the format
+                          required by chroma db. location strings are shared
+                          between chunks of the same section.
+        """
+        metadata = []
+
+        year_ids = self.year_ids.tolist()
+        section_ids = self.section_ids.tolist()
+        pages = self.pages.tolist()
+
+        for year_id, section, page in zip(year_ids, section_ids, pages):
+
+            data = {"year": self.years[year_id]}
+
+            if section != -1:
+                data["location"] = self.sections.text(section)
+
+            page = decode_page(page)
+            if page is not None:
+                data["page"] = page
+
+            metadata.append(data)
+
+        return metadata
+
+
+class StableIdIndex:
+    '''
+    This class finds the chunk ID of a stable chunk ID (make_chunk_id). Stable
+    IDs are kept sorted in a fixed width bytes array and found by binary 
+    search, so the arrays can be memory mapped from a corpus bundle and no 
+    dictionary of every chunk is built.
+
+    Input:
+    -----------
+        sorted_ids: numpy array (S32)
+            stable chunk IDs, sorted
+
+        rows: numpy array (int)
+            chunk ID of each stable chunk ID in sorted_ids
+    '''
+
+    def __init__(self, sorted_ids, rows):
+        self.sorted_ids = sorted_ids
+        self.rows = rows
+
+        # chunk ID : position in sorted_ids, made the first time it is needed
+        self.positions = None
+
+    @classmethod
+    def from_ids(cls, stable_ids):
+        """
+        @param stable_ids: list (str), stable ID of every chunk, in chunk ID 
+                           order
+
+        @return index: StableIdIndex
+        """
+        stable_ids = np.asarray(stable_ids, dtype = "S32")
+        order = np.argsort(stable_ids, kind = 'stable')
+
+        return cls(stable_ids[order], order.astype(np.int64))
+
+    def __len__(self):
+        return len(self.sorted_ids)
+
+    def __contains__(self, stable_id):
+        try:
+            self.row(stable_id)
+        except KeyError:
+            return False
+
+        return True
+
+    def row(self, stable_id):
+        """
+        @param stable_id: str, stable chunk ID
+
+        @return chunk_id: int, raises KeyError if the ID is not in the index
+        """
+        try:
+            key = stable_id.encode('ascii')
+        except (AttributeError, UnicodeEncodeError):
+            raise KeyError(stable_id)
+
+        # longer keys would be compared after truncation to 32 bytes
+        if len(key) > STABLE_ID_LENGTH:
+            raise KeyError(stable_id)
+
+        position = int(np.searchsorted(self.sorted_ids, key))
+
+        if position == len(self.sorted_ids) or self.sorted_ids[position] != key:
+            raise KeyError(stable_id)
+
+        return int(self.rows[position])
+
+    def stable_id(self, chunk_id):
+        """
+        @param chunk_id: int
+
+        @return stable_id: str, stable chunk ID of the chunk
+        """
+        if self.positions is None:
+            positions = np.empty(len(self.rows), dtype = np.int64)
+            positions[self.rows] = np.arange(len(self.rows))
+            self.positions = positions
+
+        return self.sorted_ids[self.positions[chunk_id]].decode('ascii')
+
+
+# Year partitioning ----------------------------------------------------------
+def partition_by_year(store):
+    ''' 
+    This function groups chunk IDs by year in a single pass over the year 
+    column (stable counting sort), instead of one pass per year.
+   
+    Input:
+    -----------
+        store: MetadataStore
+
+    Output:
+    --------
+        partitions: dict
+            year (str) : numpy array of chunk IDs, in chunk ID order
+    '''
+    year_ids = np.asarray(store.year_ids)
+
+    # stable sort of small integers is a radix sort in numpy
+    order = np.argsort(year_ids, kind = 'stable')
+
+    # boundaries of each year in the sorted order
+    counts = np.bincount(year_ids, minlength = len(store.years))
+    bounds = np.zeros(len(counts) + 1, dtype = np.int64)
+    bounds[1:] = np.cumsum(counts)
+
+    return {year: order[bounds[i] : bounds[i + 1]] 
+            for i, year in enumerate(store.years)}
+
+def ids_to_ranges(ids):
+    """
+    @param ids: numpy array (int), sorted chunk IDs
+
+    @return ranges: list, [start, end) of each run of consecutive IDs
+    """
+    if len(ids) == 0:
+        return []
+
+    # a new run starts wherever the next ID is not the previous ID + 1
+    breaks = np.flatnonzero(np.diff(ids) != 1) + 1
+    starts = np.concatenate(([0], breaks))
+    ends = np.concatenate((breaks, [len(ids)]))
+
+    return [[int(ids[start]), int(ids[end - 1]) + 1] 
+            for start, end in zip(starts, ends)]
+
+
+# Page codes -----------------------------------------------------------------
+def encode_page(page):
+    """
+    @param page: int, "Introduction" or -1 (missing)
+
+    @return code: int
+    """
+    if page == "Introduction":
+        return INTRODUCTION_PAGE
+
+    if page == -1 or page is None:
+        return NO_PAGE
+
+    return int(page)
+
+def decode_page(code):
+    """
+    @param code: int
+
+    @return page: int, "Introduction" or None (missing)
+    """
+    code = int(code)
+
+    if code == INTRODUCTION_PAGE:
+        return "Introduction"
+
+    if code == NO_PAGE:
+        return None
+
+    return code
+
+
+# Stable chunk IDs -----------------------------------------------------------
+# A chunk ID is a hash of (doc, year, page, text), so it does not depend on the
+# position of the chunk in any list. The same chunk gets the same ID in chroma,
+# elasticsearch and the ID keyed inverted tree on every run.
+
+def make_chunk_id(doc, year, page, text):
+    """
+    @param doc: str, document identifier, e.g. "ar_fy"
+    @param year: str, year of the document the chunk is from
+    @param page: int, "Introduction" or None (missing)
+    @param text: str, text of chunk
+
+    @return chunk_id: str, 32 hex characters
+    """
+    text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    key = f"{doc}\x1f{year}\x1f{encode_page(page)}\x1f{text_hash}"
+
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:STABLE_ID_LENGTH]
+
+def make_chunk_ids(chunks, metadata, doc = "ar_fy"):
+    '''
+    This function makes the stable ID of every chunk.
+
+    Input:
+    -----------
+        chunks: list (str)
+            each element is text (str) of a chunk
+
+        metadata: list (dict) or MetadataStore
+            metadata of each chunk, in the same order as chunks. Values of
+            the inverted tree and chroma metadata both work.
+
+        doc: str
+            document identifier, e.g. "ar_fy"
+
+    Output:
+    --------
+        ids: list (str)
+            one ID per chunk
+    '''
+    if isinstance(metadata, MetadataStore):
+        years = [metadata.years[year_id] for year_id in metadata.year_ids]
+        pages = [decode_page(page) for page in metadata.pages]
+    else:
+        years = [data["year"] for data in metadata]
+        pages = [data.get("page") for data in metadata]
+
+    return [make_chunk_id(doc, year, page, chunk)
+            for chunk, year, page in zip(chunks, years, pages)]
+
+def iter_inverted_tree(inverted_tree):
+    """
+    @param inverted_tree: dictionary, chunks (str) : meta data, or chunk ID :
+                          meta data with the chunk under "text"
+
+    @return pairs: generator, (chunk (str), meta data) in tree order
+    """
+    for key, metadata in inverted_tree.items():
+        yield metadata.get("text", key), metadata
+
+
+# Looks up the metadata of a chunk in a store or an inverted tree
+def lookup_metadata(metadata_source, chunk, chunk_id = None):
+    '''
+    This function looks up the metadata record of a chunk, so functions can
+    take either a MetadataStore or a plain inverted tree.
+
+    Input:
+    -----------
+        metadata_source: MetadataStore or dictionary
+            store, or inverted tree (chunks (str) : meta data, or ID keyed)
+
+        chunk: str
+            text of chunk
+
+        chunk_id: str
+            stable chunk ID returned by the retriever. Identical chunks of 
+            different years are told apart by it. None to look up by text.
+
+    Output:
+    --------
+        record: ChunkMetadata
+    '''
+    if isinstance(metadata_source, MetadataStore):
+        if chunk_id is not None:
+            return metadata_source.record(metadata_source.row(chunk_id))
+
+        return metadata_source[chunk]
+
+    if chunk_id is not None and chunk_id in metadata_source:
+        return ChunkMetadata.from_dict(metadata_source[chunk_id])
+
+    if chunk in metadata_source:
+        return ChunkMetadata.from_dict(metadata_source[chunk])
+
+    # an ID keyed tree looked up by text (e.g. in the notebooks), first chunk 
+    # with that text
+    for metadata in metadata_source.values():
+        if metadata.get("text") == chunk:
+            return ChunkMetadata.from_dict(metadata)
+
+    raise KeyError(chunk)
@@ -2,6 +2,8 @@ import re
 import fitz
 import os
 import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 
 from utils.json_parser import *
 
@@ -15,7 +17,9 @@ def generate_chunks(DOCUMENT_DIR,
                    chunking = 's', 
                    grouping = 1, 
                    min_chunk_size = 10,
-                   doc_identifier = "ar_fy"):
+                   doc_identifier = "ar_fy",
+                   n_workers = 1,
+                   pages_per_task = 32):
     ''' 
     This function is a wrapper for the main chunking function. This function 
     saves the chunks created.
@@ -43,6 +47,14 @@ def generate_chunks(DOCUMENT_DIR,
         min_chunk_size: int
             min number of characters in each chunk
 
+        n_workers: int
+            number of processes used to chunk documents. 1 (default) runs the
+            serial path, more than 1 runs docs_to_chunks_parallel.
+
+        pages_per_task: int
+            max number of pages in each task sent to a worker process. Only 
+            used when n_workers > 1.
+
     Output:
     --------
         None
@@ -66,11 +78,23 @@ def generate_chunks(DOCUMENT_DIR,
     start = time.time()
 
     # generate chunks
-    all_chunks, all_chunk_dict, all_s_p_pairs = docs_to_chunks(DOCUMENT_DIR,
-                                                               chunking,
-                                                               grouping, 
-                                                               min_chunk_size,
-                                                               doc_identifier)
+    if n_workers > 1:
+        all_chunks, all_chunk_dict, all_s_p_pairs = docs_to_chunks_parallel(
+            DOCUMENT_DIR,
+            chunking,
+            grouping,
+            min_chunk_size,
+            doc_identifier,
+            n_workers,
+            pages_per_task)
+
+    else:
+        all_chunks, all_chunk_dict, all_s_p_pairs = docs_to_chunks(
+            DOCUMENT_DIR,
+            chunking,
+            grouping, 
+            min_chunk_size,
+            doc_identifier)
 
     # save chunks
     save_json({"chunks": all_chunks}, chunks_path)
@@ -88,6 +112,181 @@ def generate_chunks(DOCUMENT_DIR,
     print("number of chunks:", len(all_chunks))
 
 
+# MAIN FUNCTION WRAPPER
+# Same as generate_chunks but only chunks new or changed documents
+def generate_chunks_incremental(DOCUMENT_DIR, 
+                                chunks_path,
+                                chunk_pageNum_pairs_path,
+                                s_p_pairs_path,
+                                manifest_path,
+                                chunking = 's', 
+                                grouping = 1, 
+                                min_chunk_size = 10,
+                                doc_identifier = "ar_fy"):
+    ''' 
+    This function is the incremental version of generate_chunks. An ingestion 
+    manifest records the content hash of every document and the range of 
+    chunks it produced. On a re-run, only new or changed documents are 
+    chunked and their output is spliced into the existing artifacts. 
+    
+    Everything is rebuilt if the manifest or an artifact is missing, or if 
+    the chunking parameters changed since the last run.
+   
+    Input:
+    -----------
+        DOCUMENT_DIR, chunks_path, chunk_pageNum_pairs_path, s_p_pairs_path,
+        chunking, grouping, min_chunk_size, doc_identifier:
+            see generate_chunks
+
+        manifest_path: str
+            Path to ingestion manifest.
+
+    Output:
+    --------
+        changed_years: list (str)
+            years of documents that were (re)chunked
+        
+        removed_years: list (str)
+            years of documents that are no longer in DOCUMENT_DIR
+
+            function saves the same data as generate_chunks and the manifest:
+            """
+            manifest: dict
+                {
+                    "params": chunking parameters,
+                    "documents": {
+                        file_path: {"year", "hash", "start", "end"}
+                    }
+                }
+                where chunks[start:end] are the chunks of the document
+            saved at: manifest_path
+
+            document_s_p_pairs: dict
+                file_path: {sentence (str): paragraph (str)} of each 
+                document, so a reused document gets its own paragraphs
+            saved at: manifest_path with "_s_p_pairs.json" instead of 
+                ".json"
+            """
+    '''
+    # timed just for curious individuals
+    start_time = time.time()
+
+    params = {"chunking": chunking, 
+              "grouping": grouping, 
+              "min_chunk_size": min_chunk_size,
+              "doc_identifier": doc_identifier}
+
+    # load results of last run, if they can be reused
+    old_documents = {}
+    old_chunks, old_chunk_dict, old_document_s_p_pairs = [], {}, {}
+
+    # s_p_pairs_path merges every document, a sentence found in 2 documents 
+    # has the paragraph of the last one. Pairs are also kept per document.
+    document_s_p_pairs_path = os.path.splitext(manifest_path)[0] + "_s_p_pairs.json"
+
+    paths = [manifest_path, chunks_path, chunk_pageNum_pairs_path, 
+             s_p_pairs_path, document_s_p_pairs_path]
+    
+    if all(os.path.exists(path) for path in paths):
+        manifest = json_file_to_dict(manifest_path)
+
+        if manifest is not None and manifest["params"] == params:
+            old_documents = manifest["documents"]
+            old_chunks = json_file_to_dict(chunks_path)["chunks"]
+            old_chunk_dict = json_file_to_dict(chunk_pageNum_pairs_path)
+            old_document_s_p_pairs = json_file_to_dict(document_s_p_pairs_path)
+
+    all_chunks = []
+    all_chunk_dict = {}
+    all_s_p_pairs = {}
+    document_s_p_pairs = {}
+    documents = {}
+    changed_years = []
+
+    for file_path, year in list_documents(DOCUMENT_DIR, doc_identifier):
+
+        file_hash = hash_file(file_path)
+        old_document = old_documents.get(file_path)
+
+        # document is unchanged, reuse its chunks and its own paragraphs
+        if (old_document is not None 
+            and old_document["hash"] == file_hash
+            and old_document["year"] == year
+            and file_path in old_document_s_p_pairs):
+
+            chunks = old_chunks[old_document["start"] : old_document["end"]]
+            chunk_dict = old_chunk_dict[year]
+            sentence_paragraph_pairs = old_document_s_p_pairs[file_path]
+        
+        # document is new or changed, chunk it
+        else:
+            chunks, chunk_dict, sentence_paragraph_pairs = pdf_to_chunks(
+                file_path, 
+                chunking,
+                grouping, 
+                min_chunk_size)
+            
+            changed_years.append(year)
+        
+        documents[file_path] = {"year": year,
+                                "hash": file_hash,
+                                "start": len(all_chunks),
+                                "end": len(all_chunks) + len(chunks)}
+        
+        all_chunks += chunks
+        all_chunk_dict[year] = chunk_dict
+        all_s_p_pairs.update(sentence_paragraph_pairs)
+        document_s_p_pairs[file_path] = sentence_paragraph_pairs
+    
+    removed_years = [document["year"] for document in old_documents.values()
+                     if document["year"] not in all_chunk_dict]
+
+    # save chunks, chunk : page number and sentence : paragraph
+    save_json({"chunks": all_chunks}, chunks_path)
+    save_json(all_chunk_dict, chunk_pageNum_pairs_path)
+    save_json(all_s_p_pairs, s_p_pairs_path)
+    save_json(document_s_p_pairs, document_s_p_pairs_path)
+
+    # save manifest last, so a failed run is redone on the next run
+    save_json({"params": params, "documents": documents}, manifest_path)
+
+    # display useful info for the curious
+    end_time = time.time()
+    print(end_time - start_time, "seconds")
+
+    print("documents chunked:", len(changed_years), "of", len(documents))
+    print("number of chunks:", len(all_chunks))
+
+    return changed_years, removed_years
+
+
+# Hashes the content of a file
+def hash_file(file_path, block_size = 1 << 20):
+    ''' 
+    This function computes the sha256 hash of the content of a file.
+   
+    Input:
+    -----------
+        file_path: str
+            Path to file.
+
+        block_size: int
+            number of bytes read at a time
+
+    Output:
+    --------
+        hash: str
+            hex digest of file content
+    '''
+    sha256 = hashlib.sha256()
+
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            sha256.update(block)
+    
+    return sha256.hexdigest()
+
+
 # MAIN FUNCTION used for preprocessing 
 # Splits all PDF documents into chunks for RAG
 def docs_to_chunks(DOCUMENT_DIR, 
@@ -138,6 +337,158 @@ def docs_to_chunks(DOCUMENT_DIR,
     all_chunk_dict = {}
     all_s_p_pairs = {}
 
+    for file_path, year in list_documents(DOCUMENT_DIR, doc_identifier):
+            
+        chunks, chunk_dict, sentence_paragraph_pairs = pdf_to_chunks(
+            file_path, 
+            chunking,
+            grouping, 
+            min_chunk_size)
+        
+        all_chunks += chunks
+        all_chunk_dict[year] = chunk_dict
+        all_s_p_pairs.update(sentence_paragraph_pairs)
+    
+    return all_chunks, all_chunk_dict, all_s_p_pairs
+
+
+# Same as docs_to_chunks but pages are chunked in a pool of processes
+def docs_to_chunks_parallel(DOCUMENT_DIR, 
+                            chunking, 
+                            grouping, 
+                            min_chunk_size,
+                            doc_identifier = "ar_fy",
+                            n_workers = None,
+                            pages_per_task = 32):
+    ''' 
+    This function is the parallel version of docs_to_chunks. Every document is 
+    split into page ranges of at most pages_per_task pages and the ranges of 
+    all documents are chunked in a pool of processes. 
+    
+    Results are merged in the same order as the serial path, so the output is 
+    identical to docs_to_chunks.
+   
+    Input:
+    -----------
+        DOCUMENT_DIR: str
+            Path to document folder.
+
+        chunking: str
+            type of chunks, paragraphs = 'p' or sentences = 's'
+
+        grouping: int
+            chunks grouped together to make final chunk
+
+        min_chunk_size: int
+            min number of characters in each chunk
+        
+        doc_identifier: str
+            see docs_to_chunks
+
+        n_workers: int
+            number of processes. None uses every cpu on the machine.
+
+        pages_per_task: int
+            max number of pages in each task sent to a worker process. 
+            Smaller ranges balance the load better across workers, larger 
+            ranges reopen each PDF less often.
+
+    Output:
+    --------
+        chunks: list (str)
+            each element is text (str) of a chunk
+        
+        chunk_dict: dict
+            chunk (str): page (int) pair
+
+        sentence_paragraph_pairs: dict
+            sesentence: paragraph pair, used only when chunking == 's' and 
+            grouping == 1
+
+    '''
+    # timed to report throughput (pages/sec)
+    start = time.time()
+
+    documents = list_documents(DOCUMENT_DIR, doc_identifier)
+
+    # split every document into page ranges, remembering which document 
+    # each task belongs to so results can be merged in order
+    tasks = []
+    task_docs = []
+    n_pages = 0
+
+    for doc_idx, (file_path, year) in enumerate(documents):
+        
+        pdf_document = fitz.open(file_path)
+        page_count = pdf_document.page_count
+        pdf_document.close()
+
+        n_pages += page_count
+
+        for first_page in range(0, page_count, pages_per_task):
+            last_page = min(first_page + pages_per_task, page_count)
+
+            tasks.append((file_path, 
+                          first_page, 
+                          last_page, 
+                          chunking, 
+                          grouping, 
+                          min_chunk_size))
+            task_docs.append(doc_idx)
+    
+    # executor.map returns results in the order of tasks, regardless of the 
+    # order in which workers finish
+    page_results = [[] for _ in documents]
+
+    with ProcessPoolExecutor(max_workers = n_workers) as executor:
+        for doc_idx, results in zip(task_docs, 
+                                    executor.map(page_range_to_chunks, tasks)):
+            page_results[doc_idx] += results
+
+    # merge documents in the same order as the serial path
+    all_chunks = []
+    all_chunk_dict = {}
+    all_s_p_pairs = {}
+
+    for (file_path, year), results in zip(documents, page_results):
+
+        chunks, chunk_dict, sentence_paragraph_pairs = merge_page_chunks(
+            results, 
+            chunking)
+        
+        all_chunks += chunks
+        all_chunk_dict[year] = chunk_dict
+        all_s_p_pairs.update(sentence_paragraph_pairs)
+
+    # report throughput
+    end = time.time()
+    print(f"{n_pages} pages in {end - start:.2f} seconds "
+          f"({n_pages / max(end - start, 1e-9):.1f} pages/sec)")
+    
+    return all_chunks, all_chunk_dict, all_s_p_pairs
+
+
+# Lists documents used for RAG in the order they are chunked
+def list_documents(DOCUMENT_DIR, doc_identifier = "ar_fy"):
+    ''' 
+    This function walks the document folder and finds every document used for 
+    RAG.
+   
+    Input:
+    -----------
+        DOCUMENT_DIR: str
+            Path to document folder.
+        
+        doc_identifier: str
+            see docs_to_chunks
+
+    Output:
+    --------
+        documents: list (str, str)
+            list of (file path, year) pairs in os.walk order
+    '''
+    documents = []
+
     for root, dirs, files in os.walk(DOCUMENT_DIR):
         for file in files:
             # Get the full path of the file
@@ -155,18 +506,9 @@ def docs_to_chunks(DOCUMENT_DIR,
             
             year = file_path[idx + len(doc_identifier):].split(".pdf")[0]
 
-            
-            chunks, chunk_dict, sentence_paragraph_pairs = pdf_to_chunks(
-                file_path, 
-                chunking,
-                grouping, 
-                min_chunk_size)
-            
-            all_chunks += chunks
-            all_chunk_dict[year] = chunk_dict
-            all_s_p_pairs.update(sentence_paragraph_pairs)
+            documents.append((file_path, year))
     
-    return all_chunks, all_chunk_dict, all_s_p_pairs
+    return documents
 
 
 # Splits single PDF document into chunks for RAG
@@ -208,11 +550,183 @@ def pdf_to_chunks(pdf_path, chunking, grouping, min_chunk_size):
     # convert pdf to pages
     pages = pdf_to_pages(pdf_path)
 
-    # store paragraphs in a list
-    paragraphs = []
+    # chunk every page on its own
+    page_results = [page_to_chunks(page, 
+                                   idx, 
+                                   chunking, 
+                                   grouping, 
+                                   min_chunk_size) 
+                    for idx, page in enumerate(pages)]
 
-    # store sentencess in a list
-    sentences = []
+    # stitch pages together 
+    return merge_page_chunks(page_results, chunking)
+
+
+# Splits a range of pages of a PDF document into chunks. Used by worker 
+# processes in docs_to_chunks_parallel
+def page_range_to_chunks(task):
+    ''' 
+    This function splits the pages first_page to last_page (exclusive) of a 
+    single pdf document into chunks.
+   
+    Input:
+    -----------
+        task: tuple
+            (pdf_path, first_page, last_page, chunking, grouping, 
+            min_chunk_size), packed in a single tuple so it can be sent to a
+            worker process
+
+    Output:
+    --------
+        page_results: list (tuple)
+            output of page_to_chunks for every page in the range
+    '''
+    pdf_path, first_page, last_page, chunking, grouping, min_chunk_size = task
+
+    # Open the PDF file
+    pdf_document = fitz.open(pdf_path)
+
+    page_results = []
+
+    for idx in range(first_page, last_page):
+        page = pdf_document.load_page(idx).get_text()
+        page_results.append(page_to_chunks(page, 
+                                           idx, 
+                                           chunking, 
+                                           grouping, 
+                                           min_chunk_size))
+
+    pdf_document.close()
+    return page_results
+
+
+# Splits a single page into chunks
+def page_to_chunks(page, idx, chunking, grouping, min_chunk_size):
+    ''' 
+    This function splits a single page into chunks. Pages are independent of 
+    each other, except for the page number which is carried over from earlier 
+    pages by merge_page_chunks.
+   
+    Input:
+    -----------
+        page: str
+            text of a page
+
+        idx: int
+            index of page in pdf document
+
+        chunking: str
+            see pdf_to_chunks
+
+        grouping: int
+            chunks grouped together to make final chunk
+
+        min_chunk_size: int
+            min number of characters in each chunk
+
+    Output:
+    --------
+        per_page_chunks: list (str)
+            each element is text (str) of a chunk
+        
+        per_page_pairs: list (str, str)
+            (sentence, paragraph) pairs, used only when chunking == 's' and 
+            grouping == 1
+        
+        page_number: str or None
+            page number written on the page, None if page is not numbered
+    '''
+    # ensure paragraphs are filtered (larger than min chunk size)
+    per_page_paragraphs =  group(
+        page_to_paragraphs(page, min_chunk_size), 
+        grouping)    
+
+    detected_page_number = detect_page_number(page, idx)
+
+    per_page_pairs = []
+
+    if chunking == 'p':
+        # Paragraphs are the text chunks
+        return per_page_paragraphs, per_page_pairs, detected_page_number
+    
+    # if chunking == s. then sentences are the text chunks
+    per_page_sentences = []
+    
+    # loop through paragraphs to add sentences
+    for paragraph in per_page_paragraphs:
+
+        if chunking == 'f':
+            per_paragraph_sentences = group(
+            paragraph_to_fixedSizeChunks(paragraph, min_chunk_size),
+            grouping)
+
+        else:
+            # ensure sentencess are filtered (larger than min chunk size)
+            per_paragraph_sentences = group(
+                paragraph_to_sentences(paragraph, min_chunk_size),
+                grouping)
+        
+        per_page_sentences += per_paragraph_sentences
+        
+        if (chunking == 's' or chunking == 'f') and grouping == 1:
+            for sentence in per_paragraph_sentences:
+                per_page_pairs.append((sentence, paragraph))
+
+    return per_page_sentences, per_page_pairs, detected_page_number
+
+
+# Finds the page number written on a page
+def detect_page_number(page, idx):
+    ''' 
+    This function finds the page number written at the top or bottom of a 
+    page. Numbers far from the index of the page are ignored, they are 
+    usually not page numbers.
+   
+    Input:
+    -----------
+        page: str
+            text of a page
+
+        idx: int
+            index of page in pdf document
+
+    Output:
+    --------
+        page_number: str or None
+            page number written on the page, None if page is not numbered
+    '''
+    page_number = page[:str(page).find('\n')]
+    page_number_back = str(page)[-3:].strip('\n')
+
+    if str(page_number).isdigit() and abs(idx - int(page_number)) < 15:
+        return page_number
+            
+    elif str(page_number_back).isdigit() and abs(idx - int(page_number_back)) < 15:
+        return page_number_back
+    
+    return None
+
+
+# Stitches chunked pages of a single PDF document together
+def merge_page_chunks(page_results, chunking):
+    ''' 
+    This function stitches the output of page_to_chunks for every page of a 
+    single pdf document together, in page order.
+   
+    Input:
+    -----------
+        page_results: list (tuple)
+            output of page_to_chunks for every page, in page order
+
+        chunking: str
+            see pdf_to_chunks
+
+    Output:
+    --------
+        see pdf_to_chunks
+    '''
+    # store chunks in a list
+    chunks = []
 
     # store chunk : page in a dictionary
     chunk_dict = {}
@@ -222,68 +736,441 @@ def pdf_to_chunks(pdf_path, chunking, grouping, min_chunk_size):
 
     current_page_number = 0
 
-    # loop through pages to add paragraphs
-    for idx, page in enumerate(pages):
+    for per_page_chunks, per_page_pairs, page_number in page_results:
 
-        # ensure paragraphs are filtered (larger than min chunk size)
-        per_page_paragraphs =  group(
-            page_to_paragraphs(page, min_chunk_size), 
-            grouping)    
-        
-        paragraphs += per_page_paragraphs
+        # pages that are not numbered take the page number of the last 
+        # numbered page
+        if page_number is not None:
+            current_page_number = page_number
 
-        page_number = page[:str(page).find('\n')]
-        page_number_back = str(page)[-3:].strip('\n')
+        chunks += per_page_chunks
 
-        if str(page_number).isdigit() and abs(idx - int(page_number)) < 15:
-                current_page_number = page_number
-                
-        elif str(page_number_back).isdigit() and abs(idx - int(page_number_back)) < 15:
-            current_page_number = page_number_back
+        for sentence, paragraph in per_page_pairs:
+            sentence_paragraph_pairs[sentence] = paragraph
+
+        for chunk in per_page_chunks:
+            chunk_dict[chunk] = int(current_page_number)
+
+    return chunks, chunk_dict, sentence_paragraph_pairs
+
+# Span functions ==============================================================
+# Chunks are emitted as (doc, page, start, end) spans into a single text buffer
+# per document instead of copies of the chunk text. The text of a chunk is 
+# buffer[start:end] and is only resolved when it is needed (see utils.corpus).
+
+# MAIN FUNCTION WRAPPER
+def generate_chunk_spans(DOCUMENT_DIR, 
+                         spans_path,
+                         text_dir,
+                         chunking = 's', 
+                         min_chunk_size = 10,
+                         doc_identifier = "ar_fy"):
+    ''' 
+    This function is the span version of generate_chunks. It saves one text 
+    buffer per document and a single spans file, which replace chunks.json, 
+    chunk_pageNum_pairs.json and the sentence : paragraph pairs.
+
+    Grouping is not supported because grouped chunks are not contiguous text.
+   
+    Input:
+    -----------
+        DOCUMENT_DIR, chunking, min_chunk_size, doc_identifier:
+            see generate_chunks
+
+        spans_path: str
+            Path to save spans.
         
-        if chunking == 'p':
-            # Paragraphs are the text chunks
+        text_dir: str
+            Path to folder where text buffers are saved.
 
-            for paragraph in per_page_paragraphs:
-                chunk_dict[paragraph] = int(current_page_number)
-    
+    Output:
+    --------
+        None
+            function saves the following data:
+            """
+            buffers: str
+                text of each document, saved at text_dir/<doc>.txt where 
+                doc is the index of the document, so documents of the same 
+                year do not overwrite each other
+
+            spans: dict
+                {
+                    "documents": [{"year": str, "text_path": str}],
+                    "chunks": [[doc, page, start, end, paragraph]],
+                    "paragraphs": [[doc, start, end]]
+                }
+                chunk IDs and paragraph IDs are list indices. doc is an 
+                index into documents. paragraph is the ID of the paragraph
+                a chunk is from.
+            saved at: spans_path
+            """
+    '''
+    # timed just for curious individuals
+    start = time.time()
+
+    os.makedirs(text_dir, exist_ok = True)
+
+    documents = []
+    all_chunks = []
+    all_paragraphs = []
+
+    for doc, (file_path, year) in enumerate(list_documents(DOCUMENT_DIR, 
+                                                           doc_identifier)):
+
+        buffer, chunks, paragraphs = pdf_to_chunk_spans(file_path, 
+                                                        doc, 
+                                                        chunking, 
+                                                        min_chunk_size)
+        
+        # save text buffer of document. newline = '' writes "\r\n" as it is, 
+        # so the offsets of the spans still point at the same characters
+        text_path = os.path.join(text_dir, f"{doc}.txt")
+        with open(text_path, 'w', encoding = 'utf-8', newline = '') as fp:
+            fp.write(buffer)
+
+        # paragraph IDs are local to the document until now
+        offset = len(all_paragraphs)
+        all_chunks += [(doc, page, chunk_start, chunk_end, paragraph + offset)
+                       for doc, page, chunk_start, chunk_end, paragraph 
+                       in chunks]
+        all_paragraphs += paragraphs
+
+        documents.append({"year": year, "text_path": text_path})
     
-        # if chunking == s. then sentences are the text chunks
-        else:
-            per_page_sentences = []
+    save_json({"documents": documents, 
+               "chunks": all_chunks, 
+               "paragraphs": all_paragraphs}, 
+              spans_path)
+
+    # display useful info for the curious
+    end = time.time()
+    print(end - start, "seconds")
+
+    print("number of chunks:", len(all_chunks))
+
+
+# Splits single PDF document into chunk spans
+def pdf_to_chunk_spans(pdf_path, doc, chunking, min_chunk_size):
+    ''' 
+    This function is the span version of pdf_to_chunks with grouping == 1. 
+    buffer[start:end] of each span is identical to the text of the chunk 
+    produced by pdf_to_chunks.
+   
+    Input:
+    -----------
+        pdf_path: str
+            Path to document.
+
+        doc: int
+            ID of document, added to every span
+
+        chunking: str
+            see pdf_to_chunks
+
+        min_chunk_size: int
+            min number of characters in each chunk
+
+    Output:
+    --------
+        buffer: str
+            text of all pages of the document
+        
+        chunks: list (int, int, int, int, int)
+            (doc, page, start, end, paragraph) span of each chunk, where 
+            paragraph is the index of the chunk's paragraph in paragraphs
+
+        paragraphs: list (int, int, int)
+            (doc, start, end) span of each paragraph
+    '''
+    pages = []
+    chunks = []
+    paragraphs = []
+
+    page_start = 0
+    current_page_number = 0
+
+    for idx, page in enumerate(iter_pdf_pages(pdf_path)):
+
+        pages.append(page)
+        page_end = page_start + len(page)
+
+        # pages that are not numbered take the page number of the last 
+        # numbered page
+        page_number = detect_page_number(page, idx)
+        if page_number is not None:
+            current_page_number = page_number
+
+        # spans are relative to the page, shifted to the buffer below
+        for paragraph_start, paragraph_end in page_to_paragraph_spans(
+                page, 0, len(page), min_chunk_size):
+            
+            paragraph = len(paragraphs)
+            paragraphs.append((doc, 
+                               page_start + paragraph_start, 
+                               page_start + paragraph_end))
+
+            if chunking == 'p':
+                chunk_spans = [(paragraph_start, paragraph_end)]
+
+            elif chunking == 'f':
+                chunk_spans = paragraph_to_fixedSizeChunk_spans(
+                    page, paragraph_start, paragraph_end, min_chunk_size)
             
-            # loop through paragraphs to add sentences
-            for paragraph in per_page_paragraphs:
-
-                if chunking == 'f':
-                    per_paragraph_sentences = group(
-                    paragraph_to_fixedSizeChunks(paragraph, min_chunk_size),
-                    grouping)
-
-                else:
-                    # ensure sentencess are filtered (larger than min chunk size)
-                    per_paragraph_sentences = group(
-                        paragraph_to_sentences(paragraph, min_chunk_size),
-                        grouping)
-                
-                per_page_sentences += per_paragraph_sentences
-                
-                if (chunking == 's' or chunking == 'f') and grouping == 1:
-                    for sentence in per_paragraph_sentences:
-                        sentence_paragraph_pairs[sentence] = paragraph
+            else:
+                chunk_spans = paragraph_to_sentence_spans(
+                    page, paragraph_start, paragraph_end, min_chunk_size)
             
-            sentences += per_page_sentences
+            for chunk_start, chunk_end in chunk_spans:
+                chunks.append((doc, 
+                               int(current_page_number),
+                               page_start + chunk_start, 
+                               page_start + chunk_end,
+                               paragraph))
+        
+        page_start = page_end
+    
+    return "".join(pages), chunks, paragraphs
 
-            for sentence in per_page_sentences:
-                chunk_dict[sentence] = int(current_page_number)
 
-    if chunking == 'p':
-        chunks = paragraphs
+# Span version of page_to_paragraphs
+def page_to_paragraph_spans(text, start, end, min_paragraph_length = 10):
+    """
+    @param text: str, text containing the page
+    @param start: int, start of page in text
+    @param end: int, end of page in text
+    @param min_paragraph_length: int, min number of chars in each paragraph
+
+    @return spans: list, (start, end) of each paragraph in text
+    """
+    spans = []
+
+    # same delimiters and filters as page_to_paragraphs
+    for span_start, span_end in split_span(text, start, end, PARAGRAPH_DELIMITER):
+        span_start, span_end = strip_span(text, span_start, span_end, '•-\t')
+
+        if span_end - span_start >= min_paragraph_length:
+            spans.append((span_start, span_end))
+
+    return spans
+
+# Span version of paragraph_to_sentences
+def paragraph_to_sentence_spans(text, start, end, min_sentence_length = 10):
+    """
+    @param text: str, text containing the paragraph
+    @param start: int, start of paragraph in text
+    @param end: int, end of paragraph in text
+    @param min_sentence_length: int, min number of chars in each sentence
+
+    @return spans: list, (start, end) of each sentence in text
+    """
+    spans = []
+
+    # same delimiters and filters as paragraph_to_sentences
+    for span_start, span_end in split_span(text, start, end, SENTENCE_DELIMITER):
+        span_start, span_end = strip_span(text, span_start, span_end)
+
+        if span_end - span_start >= min_sentence_length:
+            spans.append((span_start, span_end))
+
+    return spans
+
+# Span version of paragraph_to_fixedSizeChunks
+def paragraph_to_fixedSizeChunk_spans(text, start, end, chunk_size):
+    """
+    @param text: str, text containing the paragraph
+    @param start: int, start of paragraph in text
+    @param end: int, end of paragraph in text
+    @param chunk_size: int, number of chars in each chunk before stripping
+
+    @return spans: list, (start, end) of each chunk in text
+    """
+    spans = []
+
+    i = 0
+
+    while chunk_size * (i + 1) < end - start:
+        spans.append(strip_span(text, 
+                                start + chunk_size * i, 
+                                start + chunk_size * (i + 1)))
+        i += 1
+
+    return spans
+
+# Same as re.split on text[start:end] but returns spans instead of strings
+def split_span(text, start, end, pattern):
+    """
+    @param text: str
+    @param start: int, start of text to split
+    @param end: int, end of text to split
+    @param pattern: re.Pattern, delimiter
+
+    @return spans: list, (start, end) of each piece between delimiters
+    """
+    spans = []
+
+    for match in pattern.finditer(text, start, end):
+        spans.append((start, match.start()))
+        start = match.end()
+    
+    spans.append((start, end))
+
+    return spans
+
+# Same as str.strip on text[start:end] but returns a span instead of a string
+def strip_span(text, start, end, chars = None):
+    """
+    @param text: str
+    @param start: int, start of text to strip
+    @param end: int, end of text to strip
+    @param chars: str, characters to strip, None strips white spaces
+
+    @return (start, end): tuple, span of stripped text
+    """
+    if chars is None:
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
     
     else:
-        chunks = sentences
+        while start < end and text[start] in chars:
+            start += 1
+        while end > start and text[end - 1] in chars:
+            end -= 1
+    
+    return start, end
+
+
+# Streaming functions =========================================================
+
+# MAIN FUNCTION WRAPPER
+# Streams chunks of all PDF documents to disk
+def generate_chunks_stream(DOCUMENT_DIR, 
+                           records_path,
+                           chunking = 's', 
+                           grouping = 1, 
+                           min_chunk_size = 10,
+                           doc_identifier = "ar_fy"):
+    ''' 
+    This function is the streaming version of generate_chunks. Chunk records 
+    are appended to a JSON Lines file as soon as each page is chunked, so 
+    peak memory scales with one page rather than with the whole corpus.
+   
+    Input:
+    -----------
+        DOCUMENT_DIR, chunking, grouping, min_chunk_size, doc_identifier:
+            see generate_chunks
+
+        records_path: str
+            Path to save chunk records (JSON Lines).
+
+    Output:
+    --------
+        None
+            function saves one chunk record per line, see stream_pdf_chunks.
+            Read back with json_parser.jsonl_file_to_records.
+    '''
+    # timed just for curious individuals
+    start = time.time()
+
+    records = stream_chunks(DOCUMENT_DIR, 
+                            chunking, 
+                            grouping, 
+                            min_chunk_size, 
+                            doc_identifier)
+
+    n_chunks = save_jsonl(records, records_path)
+
+    # display useful info for the curious
+    end = time.time()
+    print(end - start, "seconds")
+
+    print("number of chunks:", n_chunks)
+
+
+# Yields chunk records of all PDF documents
+def stream_chunks(DOCUMENT_DIR, 
+                  chunking, 
+                  grouping, 
+                  min_chunk_size,
+                  doc_identifier = "ar_fy"):
+    ''' 
+    This function is the streaming version of docs_to_chunks. 
+   
+    Input:
+    -----------
+        see docs_to_chunks
+
+    Output:
+    --------
+        record: dict (generator)
+            see stream_pdf_chunks
+    '''
+    for file_path, year in list_documents(DOCUMENT_DIR, doc_identifier):
+        yield from stream_pdf_chunks(file_path, 
+                                     year, 
+                                     chunking, 
+                                     grouping, 
+                                     min_chunk_size)
+
+
+# Yields chunk records of a single PDF document, page by page
+def stream_pdf_chunks(pdf_path, year, chunking, grouping, min_chunk_size):
+    ''' 
+    This function is the streaming version of pdf_to_chunks. Pages are read 
+    and chunked one at a time.
+   
+    Input:
+    -----------
+        pdf_path: str
+            Path to document.
+
+        year: str
+            year of document, added to every record
+
+        chunking, grouping, min_chunk_size:
+            see pdf_to_chunks
+
+    Output:
+    --------
+        record: dict (generator)
+            {
+                "text": text (str) of chunk,
+                "year": year (str) of document,
+                "page": page number (int) written on the pdf,
+                "paragraph": paragraph (str) the chunk is from, only when 
+                             chunking == 's' or 'f' and grouping == 1. 
+                             None otherwise.
+            }
+    '''
+    current_page_number = 0
+
+    for idx, page in enumerate(iter_pdf_pages(pdf_path)):
+
+        per_page_chunks, per_page_pairs, page_number = page_to_chunks(
+            page, 
+            idx, 
+            chunking, 
+            grouping, 
+            min_chunk_size)
+        
+        # pages that are not numbered take the page number of the last 
+        # numbered page
+        if page_number is not None:
+            current_page_number = page_number
+        
+        # sentence : paragraph pairs are in the same order as the chunks
+        if per_page_pairs:
+            paragraphs = [paragraph for _, paragraph in per_page_pairs]
+        else:
+            paragraphs = [None] * len(per_page_chunks)
+
+        for chunk, paragraph in zip(per_page_chunks, paragraphs):
+            yield {"text": chunk,
+                   "year": year,
+                   "page": int(current_page_number),
+                   "paragraph": paragraph}
 
-    return chunks, chunk_dict, sentence_paragraph_pairs
 
 # Splits PDF documents into pages 
 def pdf_to_pages(pdf_path):
@@ -300,21 +1187,39 @@ def pdf_to_pages(pdf_path):
         pages: list (str)
             each element is text (str) of a page
     '''
+    # store pages in a list
+    return list(iter_pdf_pages(pdf_path))
+
+
+# Yields the pages of a PDF document one at a time
+def iter_pdf_pages(pdf_path):
+    ''' 
+    This function is the streaming version of pdf_to_pages. Only one page is 
+    held in memory at a time.
+   
+    Input:
+    -----------
+        pdf_path: str
+            Path to document.
+
+    Output:
+    --------
+        page: str (generator)
+            text (str) of each page, in page order
+    '''
     # using fitz from PyMuPDF library (superior)
 
     # Open the PDF file
     pdf_document = fitz.open(pdf_path)
 
-    # store pages in a list
-    pages = []
-
-    # Iterate through each page
-    for page_num in range(len(pdf_document)):
-        page = pdf_document.load_page(page_num).get_text()
-        pages.append(page)
-
-    pdf_document.close()
-    return pages
+    try:
+        # Iterate through each page
+        for page_num in range(len(pdf_document)):
+            yield pdf_document.load_page(page_num).get_text()
+    
+    finally:
+        # close document even if the generator is not run to the end
+        pdf_document.close()
 
 
 # Converts PDF documents into single string
@@ -337,19 +1242,26 @@ def pdf_to_text(pdf_path):
     # Open the PDF file
     pdf_document = fitz.open(pdf_path)
 
-    # store pages in a list
-    text = ""
+    # store pages in a list, joined once at the end (repeated += copies the 
+    # whole string for every page)
+    pages = []
 
     # Iterate through each page
     for page_num in range(len(pdf_document)):
         page = pdf_document.load_page(page_num).get_text()
-        text += ("\n" + page)
+        pages.append("\n" + page)
 
     pdf_document.close()
-    return text
+    return "".join(pages)
             
 # Text functions =============================================================
 
+# ('.' or ':') + '\n'  is used as delimiter for paragraphs
+PARAGRAPH_DELIMITER = re.compile('\.\s*\n|:\n')
+
+# '.' and ';' are used as delimiter for sentences
+SENTENCE_DELIMITER = re.compile('\.\s*|;\s*')
+
 # Splits a page into paragraphs
 def page_to_paragraphs(page, min_paragraph_length = 10):
     """
@@ -364,7 +1276,7 @@ def page_to_paragraphs(page, min_paragraph_length = 10):
 
     # use regular expression to split text with delimiters
     # ('.' or ':') + '\n'  is used as delimiter for paragraphs
-    temp_paragraphs = re.split('\.\s*\n|:\n', page)
+    temp_paragraphs = PARAGRAPH_DELIMITER.split(page)
 
     # filter unwanted paragraphs
     for temp_paragraph in temp_paragraphs:
@@ -391,7 +1303,7 @@ def paragraph_to_sentences(paragraph, min_sentence_length = 10):
 
     # use regular expression to split text with delimiters
     # '.' and ';' are used as delimiter for sentences
-    temp_sentences = re.split('\.\s*|;\s*', paragraph)
+    temp_sentences = SENTENCE_DELIMITER.split(paragraph)
 
     # filter unwanted sentences
     for temp_sentence in temp_sentences:
@@ -1,5 +1,6 @@
 from openai import OpenAI
 from IPython.display import display_markdown
+from utils.metadata_store import lookup_metadata
 
 # AGO
 ROLE_AGO = '''Role:
@@ -86,7 +87,8 @@ def generate_prompt(query,
                     best_chunks, 
                     chunking, 
                     sentence_paragraph_pairs = {},
-                    document = "AGO"):
+                    document = "AGO",
+                    chunk_ids = None):
     ''' 
     This function does prompt engineering to generate a prompt for LLM.
    
@@ -95,7 +97,7 @@ def generate_prompt(query,
         query: str
             question by user
 
-        inverted_tree: dictionary
+        inverted_tree: metadata_store.MetadataStore or dictionary
             chunks (str) : meta data formed from content page
 
         best_chunks: list (str)
@@ -110,12 +112,20 @@ def generate_prompt(query,
         document: str
             choose 1 one ["AGO", "NDR"]
 
+        chunk_ids: list (str)
+            stable chunk ID of each of best_chunks, as returned by the 
+            retrievers. Metadata is looked up by ID, so identical chunks of 
+            different years keep their own year. None to look up by text.
+
     Output:
     --------
         prompt: str
             prompt for LLM.
 
     '''
+    if chunk_ids is None:
+        chunk_ids = [None] * len(best_chunks)
+
     # Prompt engineering guidelines follow spiceworks
     # https://www.spiceworks.com/tech/artificial-intelligence/articles/what-is-prompt-engineering/
 
@@ -133,7 +143,7 @@ def generate_prompt(query,
     context = "CONTEXT\n"
 
     # iterate through chunks found from RAG
-    for i, chunk in enumerate(best_chunks):
+    for i, (chunk, chunk_id) in enumerate(zip(best_chunks, chunk_ids)):
 
         # if chunks are sentences
         if chunking == 's':
@@ -147,15 +157,14 @@ def generate_prompt(query,
             paragraph = chunk
         
         # retrieve metadata from data store: year, section of doc, page
-        metadata = inverted_tree[chunk]
+        metadata = lookup_metadata(inverted_tree, chunk, chunk_id)
         
         # year of audit report
-        # year = metadata[0]["year"]
-        year = metadata["year"]
+        year = metadata.year
 
         # some text are assigned page numbers
-        if metadata.get("page", -1) != -1 :
-            page = metadata["page"]
+        if metadata.page is not None:
+            page = metadata.page
         
         # some text appear before 1st page (hence not assigned page numbers)
         else:
@@ -164,11 +173,10 @@ def generate_prompt(query,
         # location refers to the chapter/heading the chunk is under
         # this is extracted from the content pages of the docs.
         # assign location seperately because some docs do not have content page
-        location = metadata.get("location", -1)
+        location = metadata.location_text
 
         # if location exists
-        if location != -1:
-            location = ', '.join(metadata["location"])
+        if location is not None:
 
             # Stitch all contexts together into one string
             context += f"Context {i}:\nYear: {year}\nLocation in document: {location}\nPage number: {page}\nContent: {paragraph}\n\n"
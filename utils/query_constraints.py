@@ -0,0 +1,353 @@
+# Query constraint functions =================================================
+
+# Years and sections mentioned in a question are turned into metadata filters,
+# so retrieval only searches the chunks of those years / sections:
+#   "weakness in access controls from FY2018/19 to FY2020/21"
+#       years: ["2018_19", "2019_20", "2020_21"]
+#   "lapses at the Inland Revenue Authority of Singapore in FY2019"
+#       years: ["2019_20"], sections: ["Inland Revenue Authority of Singapore"]
+# Years use the keys of the documents ("2018_19" is FY2018/19). Sections are
+# headings of the content page tree (complete_tree.json).
+import re
+
+import numpy as np
+
+# one fiscal year: FY2018/19, FY 2018-2019, 2018/19, 2018_19, FY2018, 2018
+def year_pattern(name):
+    """
+    @param name: str, prefix of the group names
+
+    @return pattern: str, groups <name>_fy (FY prefix), <name> (first year) 
+                     and <name>_end (second year of FY2018/19)
+    """
+    return (rf"(?P<{name}_fy>FY\s?)?(?P<{name}>(?:19|20)\d\d)"
+            rf"(?:\s?[/_\-–]\s?(?P<{name}_end>(?:19|20)?\d\d)(?!\d))?")
+
+SINGLE_YEAR = re.compile(r"(?<!\d)" + year_pattern("start"), re.IGNORECASE)
+
+# "from FY2018/19 to FY2020/21", "FY2018/19 - FY2020/21", "between 2018 and 
+# 2020". A dash needs spaces or FY around it, since 2018-2019 is one year.
+YEAR_RANGE = re.compile(
+    r"(?P<between>between\s+)?(?<!\d)" + year_pattern("first")
+    + r"(?P<separator>\s+(?:to|till|until|through|and)\s+|\s+[\-–]\s+"
+    + r"|\s*[\-–]\s*(?=FY))" 
+    + year_pattern("last"),
+    re.IGNORECASE)
+
+# headings that name parts of every report rather than a ministry / body
+GENERIC_HEADINGS = {"summary", "overview", "other observations", "appendices",
+                    "introduction", "annex", "annexes"}
+
+
+def fiscal_year(start):
+    """
+    @param start: int, first calendar year of the fiscal year, e.g. 2018
+
+    @return year: str, document key, e.g. "2018_19"
+    """
+    return f"{start}_{(start + 1) % 100:02d}"
+
+
+# Years ----------------------------------------------------------------------
+def parse_years(question, available_years = None):
+    '''
+    This function finds the fiscal years a question asks about.
+
+    FY2018/19, 2018/19, 2018-2019 and FY2018 all mean "2018_19". A bare
+    calendar year (e.g. "in 2019") is covered by 2 fiscal years, so both
+    "2018_19" and "2019_20" are returned. Ranges ("from FY2018/19 to
+    FY2020/21", "between 2018 and 2020") are expanded.
+
+    Input:
+    -----------
+        question: str
+            question by user
+
+        available_years: list (str)
+            years in the corpus. Years not in the corpus are dropped. None to
+            keep every year.
+
+    Output:
+    --------
+        years: list (str)
+            sorted years, empty if the question does not mention a year
+    '''
+    starts = set()
+
+    # ranges first, then the years they used are removed from the question
+    def add_range(match):
+        # "and" only makes a range after "between"
+        if (match.group("separator").strip().lower() == "and" 
+            and not match.group("between")):
+            return match.group(0)
+        
+        first, last = int(match.group("first")), int(match.group("last"))
+
+        # bare calendar years, see below
+        if not (match.group("first_fy") or match.group("first_end")):
+            first -= 1
+        
+        if first <= last <= first + 50:
+            starts.update(range(first, last + 1))
+        
+        return " "
+
+    question = YEAR_RANGE.sub(add_range, question)
+
+    for match in SINGLE_YEAR.finditer(question):
+        start = int(match.group("start"))
+
+        # FY2018, 2018/19 or 2018-2019 are one fiscal year, a bare 2018 is 
+        # covered by FY2017/18 and FY2018/19
+        if match.group("start_fy") or match.group("start_end"):
+            starts.add(start)
+        else:
+            starts.update((start - 1, start))
+
+    years = sorted(fiscal_year(start) for start in starts)
+
+    if available_years is not None:
+        years = [year for year in years if year in set(available_years)]
+
+    return years
+
+
+# Sections -------------------------------------------------------------------
+def normalize_text(text):
+    """
+    @param text: str
+
+    @return text: str, lowercased words separated by single spaces
+    """
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+def heading_index(tree):
+    '''
+    This function collects the headings of the content page tree that can be
+    used as section filters.
+
+    Input:
+    -----------
+        tree: dictionary
+            content page tree of every year (complete_tree.json)
+
+    Output:
+    --------
+        headings: dict
+            normalised heading (str) : heading (str)
+    '''
+    headings = {}
+
+    def visit(node):
+        if not isinstance(node, dict):
+            return
+
+        for heading, child in node.items():
+            normalized = normalize_text(heading)
+
+            # "PART II : ..." and "SUMMARY" are in every report
+            if (normalized and normalized not in GENERIC_HEADINGS
+                and not normalized.startswith(("part ", "appendix "))):
+                headings.setdefault(normalized, heading)
+
+            visit(child)
+
+    for year in tree:
+        visit(tree[year])
+
+    return headings
+
+
+def parse_sections(question, headings):
+    """
+    @param question: str, question by user
+    @param headings: dict, output of heading_index
+
+    @return sections: list (str), headings named in the question. A heading
+                      inside a longer matched heading is dropped.
+    """
+    normalized_question = f" {normalize_text(question)} "
+
+    matched = [normalized for normalized in headings
+               if f" {normalized} " in normalized_question]
+
+    # "Ministry of Finance" inside "Ministry of Finance and ..." is one match
+    matched = [normalized for normalized in matched
+               if not any(normalized != other and normalized in other
+                          for other in matched)]
+
+    return sorted(headings[normalized] for normalized in matched)
+
+
+# MAIN FUNCTION
+def extract_constraints(question, headings, available_years = None, 
+                        metadata_store = None):
+    '''
+    This function extracts the years and sections a question is about.
+
+    Input:
+    -----------
+        question: str
+            question by user
+
+        headings: dict
+            output of heading_index
+
+        available_years: list (str)
+            years in the corpus, see parse_years
+
+        metadata_store: metadata_store.MetadataStore
+            if given, constraints no chunk satisfies are dropped, see 
+            relax_constraints
+
+    Output:
+    --------
+        constraints: dict
+            {"years": list (str), "sections": list (str)}, empty lists mean
+            no constraint
+    '''
+    constraints = {"years": parse_years(question, available_years),
+                   "sections": parse_sections(question, headings)}
+    
+    if metadata_store is not None:
+        constraints = relax_constraints(constraints, metadata_store)
+
+    return constraints
+
+
+# Filters --------------------------------------------------------------------
+def matching_section_ids(sections, section_table):
+    """
+    @param sections: list (str), headings from extract_constraints
+    @param section_table: metadata_store.SectionTable, sections of the corpus
+
+    @return section_ids: list (int), every section under one of the headings
+    """
+    wanted = {normalize_text(section) for section in sections}
+
+    return [section_id for section_id, path in enumerate(section_table.paths)
+            if any(normalize_text(heading) in wanted for heading in path)]
+
+
+def matching_locations(sections, section_table):
+    """
+    @param sections: list (str), headings from extract_constraints
+    @param section_table: metadata_store.SectionTable, sections of the corpus
+
+    @return locations: list (str), location strings (headings joined with 
+                       ', ', as stored in chroma and elasticsearch) of every 
+                       section under one of the headings
+    """
+    return [section_table.text(section_id) 
+            for section_id in matching_section_ids(sections, section_table)]
+
+
+def relax_constraints(constraints, metadata_store):
+    '''
+    This function drops constraints that no chunk satisfies, so a filter 
+    never leaves retrieval with nothing to search, e.g. a body that was not 
+    audited in the year asked about. Sections are dropped first, then years.
+
+    Input:
+    -----------
+        constraints: dict
+            output of extract_constraints
+
+        metadata_store: metadata_store.MetadataStore
+            metadata of every chunk
+
+    Output:
+    --------
+        constraints: dict
+            same format, with unsatisfiable constraints emptied
+    '''
+    def matches(years, sections):
+        mask = np.ones(len(metadata_store), dtype = bool)
+
+        if years:
+            year_ids = [i for i, year in enumerate(metadata_store.years) 
+                        if year in set(years)]
+            mask &= np.isin(metadata_store.year_ids, year_ids)
+        
+        if sections:
+            section_ids = matching_section_ids(sections, metadata_store.sections)
+            mask &= np.isin(metadata_store.section_ids, section_ids)
+        
+        return mask.any()
+    
+    years, sections = constraints["years"], constraints["sections"]
+
+    if not matches(years, sections):
+        sections = []
+
+        if not matches(years, sections):
+            years = []
+    
+    return {"years": years, "sections": sections}
+
+
+def chroma_where(constraints, section_table = None):
+    '''
+    This function turns constraints into a chroma where filter.
+
+    Input:
+    -----------
+        constraints: dict
+            output of extract_constraints
+
+        section_table: metadata_store.SectionTable
+            sections of the corpus. None to ignore section constraints.
+
+    Output:
+    --------
+        where: dict
+            chroma where filter, None if there is no constraint
+    '''
+    filters = []
+
+    if constraints["years"]:
+        filters.append({"year": {"$in": constraints["years"]}})
+
+    if constraints["sections"] and section_table is not None:
+        locations = matching_locations(constraints["sections"], section_table)
+
+        if locations:
+            filters.append({"location": {"$in": locations}})
+
+    if not filters:
+        return None
+
+    return filters[0] if len(filters) == 1 else {"$and": filters}
+
+
+def elastic_filters(constraints, section_table = None):
+    '''
+    This function turns constraints into elasticsearch filter clauses, for
+    the year and section keyword fields of db_utils.ELASTIC_MAPPING.
+
+    Input:
+    -----------
+        constraints: dict
+            output of extract_constraints
+
+        section_table: metadata_store.SectionTable
+            sections of the corpus. None to ignore section constraints.
+
+    Output:
+    --------
+        filters: list (dict)
+            clauses for bool.filter, empty if there is no constraint
+    '''
+    filters = []
+
+    if constraints["years"]:
+        filters.append({"terms": {"year": constraints["years"]}})
+
+    if constraints["sections"] and section_table is not None:
+        locations = matching_locations(constraints["sections"], section_table)
+
+        if locations:
+            filters.append({"terms": {"section": locations}})
+
+    return filters
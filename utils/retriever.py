@@ -1,15 +1,28 @@
 # langchain libraries
-from langchain.retrievers import EnsembleRetriever
-from langchain_community.retrievers import BM25Retriever
 from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
 from langchain_openai import OpenAIEmbeddings
 
 # huggingface libraries
 from sentence_transformers import CrossEncoder
 
 # import other useful python libraries
+from concurrent.futures import Future
+import collections
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+
 import numpy as np
 
+from utils.corpus import ChunkList
+from utils.db_utils import BM25Index
+from utils.embedding_cache import CachedEmbeddingFunction
+from utils.fusion import weighted_rrf
+
 # retriever functions
 
 # This function takes langchain docs which are class wrappers for strings and 
@@ -41,12 +54,295 @@ def langchain_docs_to_textlist(langchain_docs):
     return textlist
 
 
+# Hybrid retriever -----------------------------------------------------------
+# The BM25 index (db_utils.BM25Index) and the FAISS index are built once, saved
+# to a folder and loaded on later runs, instead of re-embedding every chunk on
+# every query. A saved index is only reused if it was built from the same 
+# chunks and embedding model.
+
+def corpus_fingerprint(chunks, model_name):
+    """
+    @param chunks: list (str), each element is text (str) of a chunk
+    @param model_name: str, embedding model name
+
+    @return fingerprint: str, sha256 hex digest of the model name and chunks
+    """
+    digest = hashlib.sha256(model_name.encode('utf-8'))
+
+    for chunk in chunks:
+        digest.update(b"\x1e" + chunk.encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+class HybridRetriever:
+    '''
+    This class finds the chunks most similar to a query with BM25 and FAISS,
+    fused with weighted reciprocal rank fusion on integer chunk IDs. Chunks 
+    with the same text share the ID of the first one, so a repeated chunk is 
+    returned once and its score is not split. Searches only read the indexes,
+    so one instance can be shared across threads; building and loading are 
+    guarded by a lock.
+
+    Input:
+    -----------
+        chunks: list (str)
+            each element is text (str) of a chunk
+
+        embedding: 
+            LangChain embeddings (e.g. OpenAIEmbeddings or 
+            embedding_cache.CachedEmbeddingFunction) used for chunks and 
+            queries
+
+        model_name: str
+            name of the embedding model, part of the index fingerprint
+
+        index_dir: str
+            folder the indexes are saved to and loaded from. None to keep 
+            them in memory only.
+
+        weights: list (float)
+            weights of BM25 and FAISS in the fusion
+
+        k: int
+            a constant used in the RRF algorithm.
+
+        fingerprint: str
+            corpus_fingerprint of chunks and model_name if already computed
+    '''
+
+    def __init__(self, 
+                 chunks, 
+                 embedding, 
+                 model_name = "text-embedding-3-small",
+                 index_dir = None,
+                 weights = (0.5, 0.5),
+                 k = 60,
+                 fingerprint = None):
+        self.chunks = chunks
+        self.embedding = embedding
+        self.model_name = model_name
+        self.index_dir = index_dir
+        self.weights = list(weights)
+        self.k = k
+
+        self.lock = threading.Lock()
+
+        if fingerprint is None:
+            fingerprint = corpus_fingerprint(chunks, model_name)
+        self.fingerprint = fingerprint
+
+        # chunk ID : ID of the first chunk with the same text
+        first_ids = {}
+        self.first_ids = np.array([first_ids.setdefault(chunk, i) 
+                                   for i, chunk in enumerate(chunks)], 
+                                  dtype = np.int64)
+
+        with self.lock:
+            if not self.load():
+                self.build()
+
+    def load(self):
+        """
+        @return loaded: bool, False if there is no saved index for these 
+                        chunks and embedding model
+        """
+        if self.index_dir is None:
+            return False
+        
+        manifest_path = os.path.join(self.index_dir, "hybrid.json")
+
+        if not os.path.exists(manifest_path):
+            return False
+        
+        with open(manifest_path, 'r') as fp:
+            manifest = json.load(fp)
+
+        if manifest.get("fingerprint") != self.fingerprint:
+            return False
+        
+        self.bm25 = BM25Index.load(os.path.join(self.index_dir, "bm25"))
+
+        # the docstore is pickled by FAISS.save_local, written by build
+        self.faiss = FAISS.load_local(os.path.join(self.index_dir, "faiss"),
+                                      self.embedding,
+                                      allow_dangerous_deserialization = True)
+        return True
+
+    def build(self):
+        """
+        @return None, indexes every chunk and saves the indexes to index_dir
+        """
+        self.bm25 = BM25Index()
+        self.bm25.add(self.chunks)
+
+        # chunk ID in the metadata maps FAISS hits back to chunks
+        self.faiss = FAISS.from_texts(
+            self.chunks, 
+            self.embedding,
+            metadatas = [{"chunk_id": i} for i in range(len(self.chunks))])
+
+        if self.index_dir is None:
+            return
+        
+        self.bm25.save(os.path.join(self.index_dir, "bm25"))
+        self.faiss.save_local(os.path.join(self.index_dir, "faiss"))
+
+        # manifest last, so a half written index is never loaded
+        with open(os.path.join(self.index_dir, "hybrid.json"), 'w') as fp:
+            json.dump({"fingerprint": self.fingerprint, 
+                       "model_name": self.model_name,
+                       "n_chunks": len(self.chunks)}, fp)
+
+    def search_batch(self, queries, top_k):
+        ''' 
+        This function does hybrid search for many queries. Queries are 
+        embedded in one request and searched with one FAISS call and one 
+        sparse BM25 product.
+       
+        Input:
+        -----------
+            queries: list (str)
+                questions by users
+
+            top_k: int
+                both BM25 and FAISS find top_k matches, so each query gets 
+                between top_k and 2 * top_k chunks
+
+        Output:
+        --------
+            results: list (list (str))
+                fused chunks of each query, best first
+        '''
+        if len(queries) == 0:
+            return []
+        
+        bm25_results = self.bm25.search_batch(queries, top_k)
+
+        # FAISS row : chunk ID
+        index_to_docstore_id = self.faiss.index_to_docstore_id
+        docstore = self.faiss.docstore
+
+        # CachedEmbeddingFunction does not cache queries
+        if hasattr(self.embedding, "embed_queries"):
+            query_vectors = self.embedding.embed_queries(queries)
+        else:
+            query_vectors = self.embedding.embed_documents(list(queries))
+
+        query_vectors = np.asarray(query_vectors, dtype = np.float32)
+        _, rows = self.faiss.index.search(query_vectors, top_k)
+
+        results = []
+        for (bm25_ids, _), faiss_rows in zip(bm25_results, rows):
+
+            # FAISS pads missing results with -1
+            faiss_ids = [docstore.search(index_to_docstore_id[row]).metadata["chunk_id"]
+                         for row in faiss_rows.tolist() if row != -1]
+
+            # identical texts are fused as one chunk, like EnsembleRetriever 
+            # which fuses by page_content
+            rankings = [unique_ids(self.first_ids[bm25_ids]), 
+                        unique_ids(self.first_ids[faiss_ids])]
+
+            fused = weighted_rrf(rankings, self.weights, self.k)
+            
+            results.append([self.chunks[chunk_id] for chunk_id, _ in fused])
+        
+        return results
+
+    def search(self, query, top_k):
+        """
+        @param query: str, question by user
+        @param top_k: int, number of matches of BM25 and of FAISS
+
+        @return good_chunks: list (str), fused chunks, best first
+        """
+        return self.search_batch([query], top_k)[0]
+
+
+def unique_ids(ids):
+    """
+    @param ids: numpy array (int), chunk IDs in rank order
+
+    @return ranking: list (int), IDs without repeats, first occurrence kept
+    """
+    return list(dict.fromkeys(ids.tolist()))
+
+
+# fingerprint, index_dir : HybridRetriever, reused across ranking calls
+hybrid_retrievers = {}
+
+# id of the chunks list, index_dir, model_name : HybridRetriever, so the corpus 
+# is not hashed again when ranking is called with the same list. The retriever
+# keeps a reference to the list, so its id is not reused.
+hybrid_retrievers_by_list = {}
+hybrid_retrievers_lock = threading.Lock()
+
+def get_hybrid_retriever(chunks, 
+                         openai_api_key, 
+                         embedding_cache = None, 
+                         index_dir = None,
+                         model_name = "text-embedding-3-small"):
+    """
+    @param chunks: list (str), each element is text (str) of a chunk
+    @param openai_api_key: str, get from OpenAI website
+    @param embedding_cache: embedding_cache.EmbeddingCache, optional
+    @param index_dir: str, folder of the saved indexes, None for in memory
+    @param model_name: str, OpenAI embedding model
+
+    @return retriever: HybridRetriever, built once per chunks and index_dir. 
+                       The same chunks list is not hashed again, so a list 
+                       changed in place is not noticed; pass a new list.
+    """
+    list_key = (id(chunks), index_dir, model_name)
+
+    with hybrid_retrievers_lock:
+        retriever = hybrid_retrievers_by_list.get(list_key)
+
+        if retriever is not None and retriever.chunks is chunks:
+            return retriever
+
+        # fingerprint is computed once here and given to the retriever
+        fingerprint = corpus_fingerprint(chunks, model_name)
+        key = (fingerprint, index_dir)
+        retriever = hybrid_retrievers.get(key)
+
+        if retriever is None:
+            embedding = OpenAIEmbeddings(model = model_name,
+                                         api_key = openai_api_key)
+            
+            if embedding_cache is not None:
+                embedding = CachedEmbeddingFunction(embedding, 
+                                                    embedding_cache, 
+                                                    model_name)
+
+            retriever = HybridRetriever(chunks, 
+                                        embedding, 
+                                        model_name, 
+                                        index_dir,
+                                        fingerprint = fingerprint)
+            hybrid_retrievers[key] = retriever
+        
+        # the retriever of an equal corpus may hold another list, which is 
+        # the one its results are read from
+        if retriever.chunks is chunks:
+            hybrid_retrievers_by_list[list_key] = retriever
+    
+    return retriever
+
+
 # This function finds finds the top k similar chunks to query with hybrid 
 # search. (BM25 and FAISS)
-def ranking(chunks, query, top_k, openai_api_key):
+def ranking(chunks, 
+            query, 
+            top_k, 
+            openai_api_key, 
+            embedding_cache = None, 
+            index_dir = None):
     ''' 
     This function finds finds the top k similar chunks to query with hybrid 
-    search. (BM25 and FAISS)
+    search. (BM25 and FAISS). The indexes are built on the first call and 
+    reused afterwards, see HybridRetriever.
    
     Input:
     -----------
@@ -62,6 +358,14 @@ def ranking(chunks, query, top_k, openai_api_key):
         openai_api_key: str
             get from OpenAI website
 
+        embedding_cache: embedding_cache.EmbeddingCache
+            if provided, chunks and query are only embedded the first time 
+            they are seen
+
+        index_dir: str
+            folder the indexes are saved to, so later runs load them instead
+            of embedding every chunk again. None to keep them in memory.
+
     Output:
     --------
         good_chunks: list (str)
@@ -71,39 +375,340 @@ def ranking(chunks, query, top_k, openai_api_key):
             chunks (langchain_docs objects) that are top_k matches with query
 
     '''
-    chunk_list_1 = chunks
-    chunk_list_2 = chunks.copy()
-    
-    # initialize the bm25 retriever
-    bm25_retriever = BM25Retriever.from_texts(
-        chunk_list_1
-    )
-    bm25_retriever.k = top_k
-
-    # initialize the faiss retriever
-    embedding = OpenAIEmbeddings(model="text-embedding-3-small",
-                                 api_key = openai_api_key)
-    faiss_vectorstore = FAISS.from_texts(
-        chunk_list_2, embedding
-    )
-    faiss_retriever = faiss_vectorstore.as_retriever(search_kwargs={"k": top_k})
-
-    # initialize the ensemble retriever
-    ensemble_retriever = EnsembleRetriever(
-        retrievers=[bm25_retriever, faiss_retriever], weights=[0.5, 0.5]
-    )
+    retriever = get_hybrid_retriever(chunks, 
+                                     openai_api_key, 
+                                     embedding_cache, 
+                                     index_dir)
 
     # do hybrid search, combine with resiprocal rank fusion
-    good_langchain_docs = ensemble_retriever.invoke(query)
-    good_chunks = langchain_docs_to_textlist(good_langchain_docs)
+    good_chunks = retriever.search(query, top_k)
+    good_langchain_docs = [Document(page_content = chunk) for chunk in good_chunks]
 
     # return top k matches 
     return good_chunks, good_langchain_docs
 
 
+# Reranking ------------------------------------------------------------------
+
+# model name : CrossEncoder, so a model is loaded once per process
+cross_encoders = {}
+cross_encoders_lock = threading.Lock()
+
+def get_cross_encoder(model_name, max_length = 512):
+    """
+    @param model_name: str, name of cross encoder model
+    @param max_length: int, maximum number of tokens of a (query, chunk) pair
+
+    @return model: sentence_transformers.CrossEncoder, loaded on first use
+    """
+    with cross_encoders_lock:
+        model = cross_encoders.get((model_name, max_length))
+
+        if model is None:
+            model = CrossEncoder(model_name, max_length = max_length)
+            cross_encoders[(model_name, max_length)] = model
+    
+    return model
+
+
+def select_top_n(good_chunks, scores, top_n = -1):
+    """
+    @param good_chunks: list (str), chunks that were scored
+    @param scores: numpy array (float), score of each chunk
+    @param top_n: int, number of chunks kept, -1 for every chunk
+
+    @return best_chunks: list (str), chunks sorted from best to worst
+    @return sorted_scores: list (float), scores sorted from best to worst
+    """
+    # get index of scores sorted in decreasing order
+    best_idxs = np.argsort(scores)[::-1]
+
+    # initialise output
+    sorted_scores = []
+    best_chunks = []
+
+    # top_n = -1 (default) means provide all top matches
+    # if top_n is incorrectly inputed, then replace wirh default behaviour
+    if top_n > len(good_chunks):
+        top_n = -1
+
+    # loop through sorted indices
+    for k, idx in enumerate(best_idxs):
+        
+        # stop once top_n is reached
+        if k >= top_n and top_n != -1:
+            break
+
+        # append to output
+        best_chunks.append(good_chunks[idx])
+        sorted_scores.append(scores[idx])
+    
+    return best_chunks, sorted_scores
+
+
+# Length bucketed prediction -------------------------------------------------
+# CrossEncoder.predict pads every pair of a batch to the longest pair, so a 20 
+# token sentence next to a paragraph sized chunk costs as much as the 
+# paragraph. Pairs are sorted by token length and cut into buckets of a token 
+# budget, so pairs of a bucket have similar lengths, and scores are put back 
+# in the original order. Chunks are tokenised once (ChunkTokens), only the 
+# query is tokenised per request.
+
+class ChunkTokens:
+    '''
+    This class holds the token IDs of every chunk, without special tokens, as
+    one flat array with offsets. Chunk i has 
+    ids[offsets[i] : offsets[i + 1]].
+
+    Input:
+    -----------
+        chunks: list (str) or corpus.ChunkList
+            each element is text (str) of a chunk. A ChunkList finds the 
+            position of a chunk itself, no dictionary of every chunk is built.
+
+        ids: numpy array (int)
+            token IDs of all chunks, concatenated
+
+        offsets: numpy array (int)
+            start of each chunk in ids, length len(chunks) + 1
+    '''
+
+    def __init__(self, chunks, ids, offsets):
+        self.ids = ids
+        self.offsets = offsets
+
+        # chunk text : position
+        if isinstance(chunks, ChunkList):
+            self.position = chunks.position
+        else:
+            self.position = {chunk: i for i, chunk in enumerate(chunks)}.get
+
+    @classmethod
+    def build(cls, tokenizer, chunks, max_length = 512, batch_size = 1000):
+        """
+        @param tokenizer: transformers tokenizer of the cross encoder
+        @param chunks: list (str), each element is text (str) of a chunk
+        @param max_length: int, tokens kept per chunk (a pair never holds more)
+        @param batch_size: int, chunks tokenised per tokenizer call
+
+        @return chunk_tokens: ChunkTokens
+        """
+        token_lists = []
+
+        for start in range(0, len(chunks), batch_size):
+            # CrossEncoder.predict strips texts before tokenising
+            token_lists.extend(tokenizer(
+                [chunk.strip() for chunk in chunks[start : start + batch_size]],
+                add_special_tokens = False,
+                truncation = True,
+                max_length = max_length)["input_ids"])
+
+        offsets = np.zeros(len(token_lists) + 1, dtype = np.int64)
+        offsets[1:] = np.cumsum([len(tokens) for tokens in token_lists])
+
+        ids = np.fromiter((token for tokens in token_lists for token in tokens),
+                          dtype = np.int32, count = int(offsets[-1]))
+
+        return cls(chunks, ids, offsets)
+
+    def save(self, tokens_dir, fingerprint):
+        """
+        @param tokens_dir: str, folder to save to
+        @param fingerprint: str, e.g. corpus_fingerprint(chunks, model_name)
+
+        @return None
+        """
+        os.makedirs(tokens_dir, exist_ok = True)
+
+        np.save(os.path.join(tokens_dir, "ids.npy"), self.ids)
+        np.save(os.path.join(tokens_dir, "offsets.npy"), self.offsets)
+
+        with open(os.path.join(tokens_dir, "tokens.json"), 'w') as fp:
+            json.dump({"fingerprint": fingerprint}, fp)
+
+    @classmethod
+    def load(cls, tokens_dir, chunks, fingerprint):
+        """
+        @param tokens_dir: str, folder saved by save
+        @param chunks: list (str), chunks the tokens were built from
+        @param fingerprint: str, must match the saved fingerprint
+
+        @return chunk_tokens: ChunkTokens, None if nothing is saved for 
+                              these chunks and model
+        """
+        manifest_path = os.path.join(tokens_dir, "tokens.json")
+
+        if not os.path.exists(manifest_path):
+            return None
+        
+        with open(manifest_path, 'r') as fp:
+            if json.load(fp).get("fingerprint") != fingerprint:
+                return None
+        
+        return cls(chunks, 
+                   np.load(os.path.join(tokens_dir, "ids.npy"), mmap_mode = 'r'),
+                   np.load(os.path.join(tokens_dir, "offsets.npy")))
+
+    def get(self, chunk):
+        """
+        @param chunk: str, text of chunk
+
+        @return ids: list (int), token IDs, None if the chunk is unknown
+        """
+        i = self.position(chunk)
+
+        if i is None:
+            return None
+        
+        return self.ids[self.offsets[i] : self.offsets[i + 1]].tolist()
+
+
+def load_chunk_tokens(model, model_name, chunks, tokens_dir = None):
+    """
+    @param model: sentence_transformers.CrossEncoder
+    @param model_name: str, name of cross encoder model
+    @param chunks: list (str) or corpus.ChunkList, each element is text 
+                   (str) of a chunk
+    @param tokens_dir: str, folder the tokens are saved to, None for memory
+
+    @return chunk_tokens: ChunkTokens, loaded if saved for these chunks and 
+                          model, otherwise built (and saved)
+    """
+    max_length = model.max_length or model.tokenizer.model_max_length
+
+    # a ChunkList is fingerprinted from its buffers, without decoding chunks
+    if isinstance(chunks, ChunkList):
+        fingerprint = chunks.fingerprint(f"{model_name}:{max_length}")
+    else:
+        fingerprint = corpus_fingerprint(chunks, f"{model_name}:{max_length}")
+
+    if tokens_dir is not None:
+        chunk_tokens = ChunkTokens.load(tokens_dir, chunks, fingerprint)
+
+        if chunk_tokens is not None:
+            return chunk_tokens
+    
+    chunk_tokens = ChunkTokens.build(model.tokenizer, chunks, max_length)
+
+    if tokens_dir is not None:
+        chunk_tokens.save(tokens_dir, fingerprint)
+    
+    return chunk_tokens
+
+
+def length_buckets(lengths, max_batch_tokens):
+    """
+    @param lengths: numpy array (int), token length of each pair
+    @param max_batch_tokens: int, padded tokens allowed in a bucket 
+                             (pairs x longest pair)
+
+    @return buckets: list (numpy array (int)), pair indices of each bucket,
+                     shortest pairs first
+    """
+    order = np.argsort(lengths, kind = 'stable')
+
+    buckets, start = [], 0
+
+    for end in range(1, len(order) + 1):
+        # pairs are sorted, so the pair at end - 1 is the longest of the bucket
+        if end == len(order) or (end + 1 - start) * lengths[order[end]] > max_batch_tokens:
+            buckets.append(order[start:end])
+            start = end
+
+    return buckets
+
+
+def predict_bucketed(model, pairs, chunk_tokens = None, max_batch_tokens = 16384):
+    '''
+    This function scores (query, chunk) pairs with a cross encoder, in length
+    buckets. Scores are the same as CrossEncoder.predict.
+   
+    Input:
+    -----------
+        model: sentence_transformers.CrossEncoder
+            cross encoder model. Models without a tokenizer (e.g. a remote 
+            reranker) are called with predict as is.
+
+        pairs: list (str, str)
+            (query, chunk) pairs
+
+        chunk_tokens: ChunkTokens
+            token IDs of the chunks, tokenised at index time. Chunks it does 
+            not know are tokenised here.
+
+        max_batch_tokens: int
+            padded tokens in one forward pass (pairs x longest pair)
+
+    Output:
+    --------
+        scores: numpy array (float)
+            score of each pair, in the order of pairs
+    '''
+    if len(pairs) == 0:
+        return np.zeros(0, dtype = np.float32)
+
+    if not hasattr(model, "tokenizer"):
+        return np.asarray(model.predict(pairs))
+
+    import torch
+
+    tokenizer = model.tokenizer
+    max_length = model.max_length or tokenizer.model_max_length
+
+    def tokenize(text):
+        return tokenizer(text.strip(), add_special_tokens = False)["input_ids"]
+
+    # each distinct query is tokenised once
+    query_ids = {query: tokenize(query) for query in {query for query, _ in pairs}}
+
+    features = []
+    for query, chunk in pairs:
+        chunk_ids = chunk_tokens.get(chunk) if chunk_tokens is not None else None
+        
+        if chunk_ids is None:
+            chunk_ids = tokenize(chunk)
+
+        # special tokens and truncation as in CrossEncoder.predict
+        features.append(tokenizer.prepare_for_model(query_ids[query], 
+                                                    chunk_ids, 
+                                                    truncation = "longest_first",
+                                                    max_length = max_length))
+
+    lengths = np.array([len(feature["input_ids"]) for feature in features])
+
+    activation = getattr(model, "default_activation_function", None)
+    if activation is None:
+        activation = torch.nn.Identity()
+
+    scores = np.zeros(len(pairs), dtype = np.float32)
+
+    model.model.eval()
+
+    with torch.no_grad():
+        for bucket in length_buckets(lengths, max_batch_tokens):
+
+            # padded to the longest pair of the bucket only
+            batch = tokenizer.pad([features[i] for i in bucket], 
+                                  return_tensors = "pt")
+            batch = {name: tensor.to(model.model.device) 
+                     for name, tensor in batch.items()}
+
+            logits = activation(model.model(**batch, return_dict = True).logits)
+
+            # one label: relevance score
+            scores[bucket] = logits[:, 0].float().cpu().numpy()
+
+    return scores
+
+
 # This function finds finds the top n similar chunks to query with cross 
 # encoder.
-def reranking(model_name, good_chunks, query, top_n = -1, model = None):
+def reranking(model_name, 
+              good_chunks, 
+              query, 
+              top_n = -1, 
+              model = None, 
+              chunk_tokens = None):
     '''
     This function finds finds the top n similar chunks to query with cross 
     encoder.
@@ -125,6 +730,9 @@ def reranking(model_name, good_chunks, query, top_n = -1, model = None):
         model: Any
             cross encoder model if provided
 
+        chunk_tokens: ChunkTokens
+            token IDs of the chunks from index time, see predict_bucketed
+
     Output:
     --------
         best_chunks: list (str)
@@ -136,38 +744,256 @@ def reranking(model_name, good_chunks, query, top_n = -1, model = None):
             sorted from best to worst
 
     '''
-    # Initialise cross encoder model
+    # Initialise cross encoder model, loaded once per model name
     if model == None:
-        model = CrossEncoder(model_name, max_length=512, )
+        model = get_cross_encoder(model_name)
 
     # Make a query string for every chunk
     queries = [query for _ in range(len(good_chunks))] 
 
     # Find classification score between query and chunk (trained to be a 
-    # similarity score)
-    scores = model.predict(list(zip(queries, good_chunks)))
+    # similarity score), pairs of similar length are batched together
+    scores = predict_bucketed(model, 
+                              list(zip(queries, good_chunks)), 
+                              chunk_tokens)
 
-    # get index of scores sorted in decreasing order
-    best_idxs = np.argsort(scores)[::-1]
+    return select_top_n(good_chunks, scores, top_n)
 
-    # initialise output
-    sorted_scores = []
-    best_chunks = []
 
-    # top_n = -1 (default) means provide all top matches
-    # if top_n is incorrectly inputed, then replace wirh default behaviour
-    if top_n > len(good_chunks):
-        top_n = -1
+# Reranker service -----------------------------------------------------------
+# Concurrent requests (e.g. flask threads) hand their (query, chunk) pairs to
+# one worker thread that owns the cross encoder. The worker waits a few 
+# milliseconds for more requests and scores them together in one predict 
+# call, instead of many small calls contending for the same model.
 
-    # loop through sorted indices
-    for k, idx in enumerate(best_idxs):
-        
-        # stop once top_n is reached
-        if k >= top_n and top_n != -1:
-            break
+class RerankerService:
+    '''
+    This class scores (query, chunk) pairs of concurrent requests in micro 
+    batches on a dedicated thread.
 
-        # append to output
-        best_chunks.append(good_chunks[idx])
-        sorted_scores.append(scores[idx])
-    
-    return best_chunks, sorted_scores
\ No newline at end of file
+    Input:
+    -----------
+        model: sentence_transformers.CrossEncoder
+            cross encoder model, e.g. get_cross_encoder(model_name)
+
+        max_batch_size: int
+            number of pairs after which a micro batch is scored without 
+            waiting. A request is never split across batches.
+
+        max_wait: float
+            seconds the worker waits for more requests after the first one
+
+        history: int
+            number of recent batches kept for stats
+
+        chunk_tokens: ChunkTokens
+            token IDs of the chunks from index time, see predict_bucketed
+
+        max_batch_tokens: int
+            padded tokens in one forward pass, see predict_bucketed
+    '''
+
+    def __init__(self, 
+                 model, 
+                 max_batch_size = 128, 
+                 max_wait = 0.005, 
+                 history = 1000,
+                 chunk_tokens = None,
+                 max_batch_tokens = 16384):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.chunk_tokens = chunk_tokens
+        self.max_batch_tokens = max_batch_tokens
+
+        # (pairs, future, time enqueued), None stops the worker
+        self.requests = queue.Queue()
+
+        # no request is queued after the None put by close
+        self.close_lock = threading.Lock()
+        self.closed = False
+
+        self.stats_lock = threading.Lock()
+        self.batch_sizes = collections.deque(maxlen = history)
+        self.queue_times = collections.deque(maxlen = history)
+        self.n_requests = 0
+        self.n_batches = 0
+
+        self.worker = threading.Thread(target = self.run, 
+                                       name = "reranker", 
+                                       daemon = True)
+        self.worker.start()
+
+    def submit(self, query, good_chunks):
+        """
+        @param query: str, question by user
+        @param good_chunks: list (str), chunks to score
+
+        @return future: concurrent.futures.Future, resolves to the scores 
+                        (numpy array (float)) of good_chunks, in order. 
+                        Raises RuntimeError if the service is closed.
+        """
+        future = Future()
+        pairs = [(query, chunk) for chunk in good_chunks]
+
+        with self.close_lock:
+            if self.closed:
+                raise RuntimeError("cannot rerank after the reranker service is closed")
+
+            if len(pairs) == 0:
+                future.set_result(np.zeros(0, dtype = np.float32))
+                return future
+
+            self.requests.put((pairs, future, time.perf_counter()))
+
+        return future
+
+    def rerank(self, query, good_chunks, top_n = -1, timeout = None):
+        '''
+        This function finds the top n similar chunks to query, like 
+        reranking, with the pairs scored by the worker.
+       
+        Input:
+        -----------
+            query: str
+                question by user
+
+            good_chunks: list (str)
+                contains top chunks (str) from 1st ranking.
+
+            top_n: int
+                filter chunks among the top_n matches with query
+
+            timeout: float
+                seconds to wait for the scores, None to wait until done
+
+        Output:
+        --------
+            best_chunks: list (str)
+                chunks (str) that are top_n matches with query, best first
+
+            sorted_scores: list (float)
+                similarity scores of the top_n matches, best first
+        '''
+        scores = self.submit(query, good_chunks).result(timeout = timeout)
+
+        return select_top_n(good_chunks, scores, top_n)
+
+    def next_batch(self, first):
+        """
+        @param first: tuple, first request of the batch, (pairs, future, 
+                      time enqueued)
+
+        @return batch: list (tuple), requests gathered within max_wait
+        @return stop: bool, True if close was called while gathering
+        """
+        batch = [first]
+        n_pairs = len(first[0])
+        deadline = time.perf_counter() + self.max_wait
+
+        while n_pairs < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+
+            try:
+                request = self.requests.get(timeout = remaining)
+            except queue.Empty:
+                break
+
+            if request is None:
+                return batch, True
+            
+            batch.append(request)
+            n_pairs += len(request[0])
+
+        return batch, False
+
+    def run(self):
+        """
+        @return None, scores micro batches until close is called
+        """
+        stop = False
+
+        while not stop:
+            first = self.requests.get()
+            if first is None:
+                break
+
+            batch, stop = self.next_batch(first)
+            start = time.perf_counter()
+
+            # cancelled requests are dropped, the others can no longer be 
+            # cancelled, so setting their result cannot fail
+            batch = [request for request in batch 
+                     if request[1].set_running_or_notify_cancel()]
+            
+            if not batch:
+                continue
+
+            pairs = [pair for pairs, _, _ in batch for pair in pairs]
+
+            try:
+                scores = predict_bucketed(self.model, 
+                                          pairs, 
+                                          self.chunk_tokens, 
+                                          self.max_batch_tokens)
+            except Exception as error:
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                continue
+
+            # split the scores back to the requests
+            offset = 0
+            for request_pairs, future, _ in batch:
+                future.set_result(scores[offset : offset + len(request_pairs)])
+                offset += len(request_pairs)
+
+            with self.stats_lock:
+                self.n_requests += len(batch)
+                self.n_batches += 1
+                self.batch_sizes.append(len(pairs))
+                self.queue_times.extend(start - enqueued for _, _, enqueued in batch)
+
+    def stats(self):
+        """
+        @return stats: dict, number of requests and batches, and batch size
+                       (pairs) and queue time (ms) percentiles of recent 
+                       batches
+        """
+        with self.stats_lock:
+            batch_sizes = np.array(self.batch_sizes, dtype = np.float64)
+            queue_times = np.array(self.queue_times, dtype = np.float64) * 1000
+            stats = {"requests": self.n_requests, "batches": self.n_batches}
+
+        for name, values in [("batch_size", batch_sizes), 
+                             ("queue_ms", queue_times)]:
+            if len(values):
+                stats[f"{name}_mean"] = float(values.mean())
+                stats[f"{name}_p50"] = float(np.percentile(values, 50))
+                stats[f"{name}_p99"] = float(np.percentile(values, 99))
+        
+        return stats
+
+    def close(self):
+        """
+        @return None, stops the worker after the requests already queued. 
+                Requests left in the queue fail with RuntimeError.
+        """
+        with self.close_lock:
+            if not self.closed:
+                self.closed = True
+                self.requests.put(None)
+        
+        self.worker.join()
+
+        # nothing is left normally, unless the worker stopped early
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+
+            if request is not None and request[1].set_running_or_notify_cancel():
+                request[1].set_exception(
+                    RuntimeError("reranker service closed before scoring"))
@@ -0,0 +1,166 @@
+# Text analyzer functions ====================================================
+
+# One analyzer for sparse retrieval, used both when chunks are indexed and when
+# queries are searched: lowercase, split on non word characters (punctuation is
+# dropped, so "grant?" matches "grant"), remove stopwords and stem.
+#
+# The elasticsearch mapping (db_utils.ELASTIC_MAPPING) uses the same steps
+# (standard tokenizer, lowercase, _english_ stopwords, snowball english
+# stemmer), so in process BM25 and elasticsearch agree on terms.
+from functools import lru_cache
+import re
+
+import numpy as np
+
+# stemming needs snowballstemmer (same english stemmer as elasticsearch)
+try:
+    import snowballstemmer
+except ImportError:
+    snowballstemmer = None
+
+# elasticsearch _english_ stopwords
+STOPWORDS = frozenset([
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "if", "in",
+    "into", "is", "it", "no", "not", "of", "on", "or", "such", "that", "the",
+    "their", "then", "there", "these", "they", "this", "to", "was", "will",
+    "with"
+])
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+class TextAnalyzer:
+    '''
+    This class turns text into terms and terms into term IDs. Tokens are
+    stemmed through an LRU cache, so each distinct word is stemmed once.
+
+    Input:
+    -----------
+        stopwords: set (str)
+            words dropped from chunks and queries, None to keep every word
+
+        stem: bool
+            stem words. Ignored (no stemming) if snowballstemmer is not
+            installed.
+
+        cache_size: int
+            number of distinct tokens kept in the token cache
+    '''
+
+    def __init__(self, stopwords = STOPWORDS, stem = True, cache_size = 2 ** 18):
+        self.stopwords = frozenset(stopwords) if stopwords is not None else frozenset()
+        self.stem = stem and snowballstemmer is not None
+
+        stemmer = snowballstemmer.stemmer('english') if self.stem else None
+
+        # token (lowercased str) : term (str), None for stopwords
+        def token_to_term(token):
+            if token in self.stopwords:
+                return None
+
+            return stemmer.stemWord(token) if stemmer is not None else token
+
+        self.term = lru_cache(maxsize = cache_size)(token_to_term)
+
+        # term (str) : term ID
+        self.vocabulary = {}
+
+    def config(self):
+        """
+        @return config: dict, arguments to make the same analyzer again
+        """
+        return {"stopwords": sorted(self.stopwords), "stem": self.stem}
+
+    def tokenize(self, text):
+        """
+        @param text: str
+
+        @return tokens: list (str), lowercased words without punctuation
+        """
+        return TOKEN_PATTERN.findall(text.lower())
+
+    def analyze(self, text):
+        """
+        @param text: str
+
+        @return terms: list (str), stemmed words without stopwords
+        """
+        terms = [self.term(token) for token in self.tokenize(text)]
+
+        return [term for term in terms if term is not None]
+
+    def term_ids(self, text, add = False):
+        """
+        @param text: str
+        @param add: bool, give new terms an ID (index time) or drop them
+                    (query time)
+
+        @return term_ids: numpy array (int)
+        """
+        vocabulary = self.vocabulary
+
+        if add:
+            return np.array([vocabulary.setdefault(term, len(vocabulary))
+                             for term in self.analyze(text)], dtype = np.int64)
+
+        return np.array([vocabulary[term] for term in self.analyze(text)
+                         if term in vocabulary], dtype = np.int64)
+
+    def analyze_batch(self, texts):
+        '''
+        This function analyzes many texts at once. Every distinct token is
+        looked up once for the whole batch and mapped back to the texts with
+        numpy, instead of once per occurrence.
+
+        Input:
+        -----------
+            texts: list (str)
+                e.g. every chunk of the corpus
+
+        Output:
+        --------
+            term_ids: numpy array (int)
+                term IDs of all texts, concatenated. New terms get an ID.
+
+            offsets: numpy array (int)
+                terms of text i are term_ids[offsets[i] : offsets[i + 1]]
+        '''
+        token_lists = [self.tokenize(text) for text in texts]
+
+        lengths = np.fromiter((len(tokens) for tokens in token_lists),
+                              dtype = np.int64, count = len(token_lists))
+
+        # distinct tokens of the batch, and the index of each token in them
+        tokens, inverse = np.unique(
+            np.array([token for tokens in token_lists for token in tokens],
+                     dtype = object).astype(str),
+            return_inverse = True)
+
+        # term ID of each distinct token, -1 for stopwords
+        vocabulary = self.vocabulary
+        token_ids = np.full(len(tokens), -1, dtype = np.int64)
+
+        for i, token in enumerate(tokens.tolist()):
+            term = self.term(token)
+            if term is not None:
+                token_ids[i] = vocabulary.setdefault(term, len(vocabulary))
+
+        # drop stopwords, offsets count the kept terms before each text
+        ids = token_ids[inverse]
+        keep = ids != -1
+
+        kept = np.zeros(len(keep) + 1, dtype = np.int64)
+        kept[1:] = np.cumsum(keep)
+
+        bounds = np.zeros(len(texts) + 1, dtype = np.int64)
+        bounds[1:] = np.cumsum(lengths)
+
+        offsets = kept[bounds]
+
+        return ids[keep], offsets
+
+    def cache_info(self):
+        """
+        @return info: functools cache info (hits, misses, maxsize, currsize)
+        """
+        return self.term.cache_info()